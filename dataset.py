@@ -1,8 +1,14 @@
 from enum import Enum, IntEnum
 from dataclasses import dataclass, field
 from os import error
-from typing import Collection, Type, Union, List, Dict, Set
+from typing import Collection, Type, Union, List, Dict, Set, Callable
 from datetime import datetime
+from collections import Counter
+from collections.abc import Sequence
+from bisect import insort
+from array import array
+from sys import getsizeof
+from concurrent.futures import ProcessPoolExecutor
 import copy
 
 class MERGE_TYPE(IntEnum):
@@ -25,7 +31,8 @@ class COLUMN_ERROR_CODE(IntEnum):
 class DATA_ERROR_CODE(IntEnum):
     DATA_CANNOT_CONVERT = 0,
     DATA_TYPE_INCOMPATIBLE = 1,
-    DATA_COLUMNS_INCOMPATIBLE = 2
+    DATA_COLUMNS_INCOMPATIBLE = 2,
+    DATA_DUPLICATE_KEY = 3
 
 class OP_STATUS_CODE(IntEnum):
     OP_SUCCESS = 0,
@@ -64,20 +71,66 @@ class DataColumn:
     type: COLUMN_TYPE
     name: str
 
+class _RecordList(list):
+    ''' A multi-select value read through a DataRecord. Column storage keeps each distinct list once, so values are decoded as
+    copies; changing this copy in place writes it back to the record's row, as changing the stored list used to. '''
+    __slots__ = ("_record", "_key")
+
+    def __init__(self, values, record : "DataRecord", key : str):
+        super().__init__(values)
+        self._record = record
+        self._key = key
+
+    def _write_back(method):
+        def write_back(self, *args):
+            result = method(self, *args)
+            self._record[self._key] = list(self)
+            return result
+        write_back.__name__ = method.__name__
+        return write_back
+
+    append = _write_back(list.append)
+    extend = _write_back(list.extend)
+    insert = _write_back(list.insert)
+    remove = _write_back(list.remove)
+    pop = _write_back(list.pop)
+    clear = _write_back(list.clear)
+    sort = _write_back(list.sort)
+    reverse = _write_back(list.reverse)
+    __setitem__ = _write_back(list.__setitem__)
+    __delitem__ = _write_back(list.__delitem__)
+    __iadd__ = _write_back(list.__iadd__)
+    __imul__ = _write_back(list.__imul__)
+    del _write_back
+
+    def __reduce__(self): # copies and pickles are plain lists, not tied to the row
+        return (list, (list(self),))
+
 @dataclass
 class DataRecord:
-    _column_names: dict # ties name to index
-    _fields: dict # always a dict where index is column index
+    ''' A lightweight view onto a single row of a DataSet. Values live in the dataset's column storage, not in the record,
+    and the column names are the dataset's own, so schema changes never touch records. Slotted, so a record is two references. '''
+    __slots__ = ("_dataset", "_row")
+    _dataset: "DataSet"
+    _row: int # index of the row in each of the dataset's column lists
+
+    @property
+    def _column_names(self) -> dict:
+        ''' Ties name to index; shared with (and owned by) the parent dataset. '''
+        return self._dataset._column_names
 
     def __getitem__(self,key):
-        i = self._column_names.get(key)
+        i = self._dataset._column_names.get(key)
         if i == None:
             return None
-        return self._fields[i]
+        value = self._dataset._data[i][self._row]
+        if value.__class__ is list: # a decoded multi-select value
+            return _RecordList(value, self, key)
+        return value
 
     def __setitem__(self, key, value):
-        i = self._column_names[key]
-        self._fields[i] = value
+        i = self._dataset._column_names[key]
+        self._dataset._set_value(i, self._row, value)
 
     def __eq__(self, o: object) -> bool:
         if not isinstance(o, DataRecord):
@@ -95,22 +148,457 @@ class DataRecord:
 
     def asdict(self):
         record_dict = {}
-        for col_name in self._column_names:
-            col_i = self._column_names[col_name]
-            record_dict[col_name] = self._fields[col_i]
+        data = self._dataset._data
+        for col_name, col_i in self._column_names.items():
+            record_dict[col_name] = data[col_i][self._row]
         return record_dict
 
+class DataRecordList(Sequence):
+    ''' Read-only sequence of DataRecord views over a DataSet's rows. Records are created on access, so holding 
+    the list costs nothing per row. '''
+
+    def __init__(self, dataset : "DataSet"):
+        self._dataset = dataset
+
+    def __len__(self) -> int:
+        return self._dataset._row_count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [DataRecord(self._dataset, row) for row in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return DataRecord(self._dataset, i)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield DataRecord(self._dataset, row)
+
+    def __eq__(self, o: object) -> bool:
+        if not isinstance(o, (list, DataRecordList)):
+            return NotImplemented
+        if len(self) != len(o):
+            return False
+        return all(a == b for a, b in zip(self, o))
+
+class EncodedColumn:
+    ''' Dictionary-encoded storage for SELECT and MULTI_SELECT columns. Each row holds an integer code into the column's
+    dictionary of distinct values, so a value repeated across many rows (an option, or a combination of tags) is stored once.
+    Acts like the list it replaces: reading a row decodes it, and multi-select rows come back as new lists, so a list read
+    from a record has to be assigned back to change the dataset. Codes aren't reused, so the dictionary can keep values
+    which are no longer in any row. '''
+
+    def __init__(self, values = ()):
+        self.codes = array("i")
+        self.values : list = [] # distinct values by code; lists are kept as tuples
+        self._keys : list = [] # the value for each code as _hashable gives it, for comparing rows
+        self._codes_by_key : dict = {}
+        self._list_codes : Set[int] = set()
+        self.extend(values)
+
+    def encode(self, value) -> int:
+        ''' Code for value, adding it to the dictionary if it's new. '''
+        is_list = isinstance(value, list)
+        key = (list, tuple(value)) if is_list else (value.__class__, value)
+        try:
+            code = self._codes_by_key.get(key)
+        except TypeError: # unhashable, e.g. a dict or nested lists
+            key = (value.__class__, _hashable(value))
+            code = self._codes_by_key.get(key)
+        if code is None:
+            code = len(self.values)
+            self._codes_by_key[key] = code
+            self._keys.append(key[1])
+            if is_list:
+                self.values.append(tuple(value))
+                self._list_codes.add(code)
+            else: self.values.append(value)
+        return code
+
+    def decode(self, code : int):
+        if code in self._list_codes: return list(self.values[code])
+        return self.values[code]
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [ self.decode(c) for c in self.codes[i] ]
+        return self.decode(self.codes[i])
+
+    def __setitem__(self, i : int, value):
+        self.codes[i] = self.encode(value)
+
+    def __iter__(self):
+        if not self._list_codes: return map(self.values.__getitem__, self.codes)
+        return map(self.decode, self.codes)
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def extend(self, values):
+        encode = self.encode
+        self.codes.extend([ encode(v) for v in values ])
+
+    def pop(self, i : int = -1):
+        return self.decode(self.codes.pop(i))
+
+    def copy(self) -> "EncodedColumn":
+        clone = EncodedColumn()
+        clone.codes = array("i", self.codes)
+        clone.values = list(self.values)
+        clone._keys = list(self._keys)
+        clone._codes_by_key = dict(self._codes_by_key)
+        clone._list_codes = set(self._list_codes)
+        return clone
+
+    def hashable_values(self):
+        ''' Each row as _hashable would give it, without decoding. '''
+        return map(self._keys.__getitem__, self.codes)
+
+    def value_counts(self) -> Counter:
+        ''' Counts as _count_value would make them, with each distinct value counted once and multiplied up. '''
+        counts = Counter()
+        for code, n in Counter(self.codes).items():
+            v = self.values[code]
+            if code in self._list_codes:
+                for option in v: counts[option] += n
+            else: counts[v] += n
+        return counts
+
+def _filled_column(column_type : COLUMN_TYPE, value, count : int) -> list:
+    ''' Storage for a column of count copies of value. '''
+    if column_type in (COLUMN_TYPE.SELECT, COLUMN_TYPE.MULTI_SELECT):
+        column = EncodedColumn()
+        column.codes = array("i", [column.encode(value)]) * count
+        return column
+    return [value] * count
+
+def _storage_bytes(values) -> int:
+    ''' Rough size of a column's storage: the container and each value it holds other than None. Values referenced from
+    elsewhere (or more than once) are still counted, so this is an upper bound on what freeing it gives back. '''
+    if values is None: return 0
+    if isinstance(values, EncodedColumn):
+        return (getsizeof(values.codes) + getsizeof(values.values) + getsizeof(values._keys) + getsizeof(values._codes_by_key)
+            + sum(map(getsizeof, values.values)))
+    return getsizeof(values) + sum(map(getsizeof, values)) - values.count(None) * getsizeof(None)
+
+def _column_storage(column_type : COLUMN_TYPE, values : list) -> list:
+    ''' Storage for a column's values: dictionary-encoded for select and multi-select columns, otherwise the list itself. '''
+    if column_type in (COLUMN_TYPE.SELECT, COLUMN_TYPE.MULTI_SELECT) and not isinstance(values, EncodedColumn):
+        return EncodedColumn(values)
+    return values
+
+class DataIndex:
+    ''' Secondary index over one column of a DataSet, mapping each value to the (ascending) row numbers which hold it. 
+    Created with DataSet.create_index and kept up to date by the dataset as records are added or changed. '''
+
+    def __init__(self, dataset : "DataSet", unique : bool = False):
+        self._dataset = dataset
+        self.unique = unique
+        self.rows : Dict[object, List[int]] = None # None when the index is stale and must be rebuilt
+
+    def _build(self, values : list):
+        rows = {}
+        for row, v in enumerate(values):
+            bucket = rows.get(v)
+            if bucket is None: rows[v] = [row]
+            elif self.unique: raise DataError(DATA_ERROR_CODE.DATA_DUPLICATE_KEY, f"Duplicate key {v!r} in unique index.")
+            else: bucket.append(row)
+        self.rows = rows
+
+    def _check_insert(self, key, row : int):
+        if self.unique and key in self.rows and self.rows[key] != [row]:
+            raise DataError(DATA_ERROR_CODE.DATA_DUPLICATE_KEY, f"Duplicate key {key!r} in unique index.")
+
+    def _insert(self, key, row : int):
+        bucket = self.rows.get(key)
+        if bucket is None: self.rows[key] = [row]
+        elif bucket[-1] < row: bucket.append(row)
+        else: insort(bucket, row)
+
+    def _remove(self, key, row : int):
+        bucket = self.rows[key]
+        bucket.remove(row)
+        if len(bucket) == 0: del self.rows[key]
+
+    def keys(self):
+        return self.rows.keys()
+
+    def __contains__(self, key) -> bool:
+        return key in self.rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def records(self, key) -> List[DataRecord]:
+        ''' Records whose indexed column equals key (an empty list if there are none). '''
+        return [ DataRecord(self._dataset, row) for row in self.rows.get(key, []) ]
+
+class DateParser:
+    ''' Parses text to datetimes, trying each of formats in order with strptime and then ISO 8601. The order never changes with
+    what has been parsed, so the same text always gives the same date. infer finds the format a column is mostly in, which
+    parse can then try first for that column, so most values take a single strptime. Results are memoised, as the same
+    timestamps tend to repeat. Failed attempts are counted rather than reported. '''
+    cache_size = 100000 # a memo is cleared when it reaches this many entries
+    sample_size = 100
+
+    def __init__(self, formats : "tuple[str]"):
+        self.formats = tuple(formats)
+        self.failed_attempts = 0 # strptime calls which didn't match
+        self.iso_parses = 0 # values which matched none of formats and were parsed as ISO 8601
+        self._orders = { None: self.formats } # formats in the order they're tried, by the format tried first
+        self._caches = {} # memos by the format tried first, as that can change the result for ambiguous text
+
+    def infer(self, values : list) -> str:
+        ''' Tries every format against a sample of values and returns the one which parses the most (the earliest in formats
+        if several do equally well), or None if none of them parsed anything. '''
+        sample = [ v for v in values[:self.sample_size * 2] if isinstance(v, str) and v != "" ][:self.sample_size]
+        best, best_count = None, 0
+        for format in self.formats:
+            count = 0
+            for v in sample:
+                try:
+                    datetime.strptime(v, format)
+                    count += 1
+                except ValueError:
+                    pass
+            if count > best_count:
+                best, best_count = format, count
+        return best
+
+    def parse(self, txt : str, first : str = None) -> datetime:
+        ''' Parses txt, raising ValueError or TypeError if it isn't a date in any of the formats. Given first (one of formats,
+        usually from infer), that format is tried before the others. '''
+        cache = self._caches.get(first)
+        if cache is None:
+            cache = self._caches[first] = {}
+            if first not in self._orders:
+                self._orders[first] = (first,) + tuple(f for f in self.formats if f != first)
+        date_obj = cache.get(txt)
+        if date_obj is not None:
+            return date_obj
+        for format in self._orders[first]:
+            try:
+                date_obj = datetime.strptime(txt, format)
+                break
+            except ValueError: # format doesn't work
+                self.failed_attempts += 1
+        if date_obj is None: # no user-defined formats were successful
+            date_obj = datetime.fromisoformat(txt) # let this one fail with an error, to provide feedback to higher-level functions
+            self.iso_parses += 1
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[txt] = date_obj
+        return date_obj
+
+class DateFormatter:
+    ''' Formats dates as text with the first of formats which works (or ISO 8601 if there are none), memoising results.
+    Failed attempts are counted rather than reported. '''
+    cache_size = 100000
+
+    def __init__(self, formats : "tuple[str]"):
+        self.formats = tuple(formats)
+        self.failed_attempts = 0
+        self._cache = {}
+
+    def format(self, date : datetime) -> str:
+        # equal times in different zones still format differently; plain dates have no zone
+        key = (date, getattr(date, "tzinfo", None))
+        date_str = self._cache.get(key)
+        if date_str is not None:
+            return date_str
+        for format in self.formats:
+            try: # generally provides first format
+                date_str = date.strftime(format)
+                break
+            except ValueError: # format doesn't work
+                self.failed_attempts += 1
+        if date_str is None: # no user-defined formats were successful or provided
+            date_str = date.isoformat()
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[key] = date_str
+        return date_str
+
+class ConversionPlan:
+    ''' Converts values from one column type to another with the converter chosen once, up front, rather than looked up
+    for every value as in DataSet.change_data_type. Values which can't be converted become None and are counted, as in
+    change_column_type. Get one from DataSet.conversion_plan. '''
+    parallel_threshold = 100000 # shorter columns aren't worth sending to worker processes
+
+    def __init__(self, dataset : "DataSet", source_type : COLUMN_TYPE, target_type : COLUMN_TYPE):
+        if target_type not in dataset.CONVERT_DICT.get(source_type, {}):
+            raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE)
+        self.source_type = source_type
+        self.target_type = target_type
+        self.format = dataset.format
+        self._identity = (source_type, target_type) in ((COLUMN_TYPE.TEXT, COLUMN_TYPE.SELECT), (COLUMN_TYPE.SELECT, COLUMN_TYPE.TEXT))
+        self._date_parser : DateParser = None # set when converting text to dates, which infers a format for each column
+        delimiter = dataset.format.multiselect_delimiter
+        if (source_type, target_type) == (COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE):
+            self._date_parser = dataset.date_parser()
+            self._convert = self._date_parser.parse
+        elif (source_type, target_type) == (COLUMN_TYPE.DATE, COLUMN_TYPE.TEXT):
+            self._convert = dataset.date_formatter().format
+        elif (source_type, target_type) == (COLUMN_TYPE.TEXT, COLUMN_TYPE.MULTI_SELECT):
+            self._convert = lambda txt: txt.split(delimiter)
+        elif (source_type, target_type) == (COLUMN_TYPE.MULTI_SELECT, COLUMN_TYPE.TEXT):
+            self._convert = delimiter.join
+        else:
+            self._convert = dataset.CONVERT_DICT[source_type][target_type]
+
+    def convert_value(self, value):
+        ''' Converts a single value, raising DataError if it can't be converted. '''
+        if self._identity:
+            return value
+        try:
+            return self._convert(value)
+        except Exception:
+            raise DataError(DATA_ERROR_CODE.DATA_CANNOT_CONVERT)
+
+    def convert(self, values : list, workers : int = None, first_format : str = None) -> "tuple[list, int]":
+        ''' Converts a whole column. Returns (converted values, number of values which couldn't be converted).
+        Given workers, columns of at least parallel_threshold values are split between that many worker processes. Values are
+        pickled to and from the workers, so this only pays off for slow conversions (e.g. dates tried against several formats).
+        first_format overrides the date format inferred from the column, which is tried first for every value (see infer_format). '''
+        if self._identity:
+            return list(values), 0
+        if isinstance(values, EncodedColumn):
+            return self._convert_encoded(values)
+        if workers != None and workers > 1 and len(values) >= self.parallel_threshold:
+            return self._convert_parallel(values, workers, first_format)
+        convert = self._column_converter(values, first_format)
+        try:
+            return [ convert(v) for v in values ], 0
+        except Exception:
+            pass # something can't be converted; go again, value by value
+        out = []
+        errors = 0
+        for v in values:
+            try:
+                out.append(convert(v))
+            except Exception:
+                out.append(None)
+                errors += 1
+        return out, errors
+
+    def infer_format(self, values : list) -> str:
+        ''' The date format convert tries first for values: the one most of a sample of them are in, or "" if none of the time
+        formats fit. None unless converting text to dates. Passing it back to convert as first_format converts more of the 
+        same column (e.g. later pages of a read) the same way, without inferring again. '''
+        if self._date_parser == None:
+            return None
+        return self._date_parser.infer(values) or ""
+
+    def _column_converter(self, values : list, first_format : str = None) -> Callable:
+        ''' The converter for a whole column. Text to dates tries one format first for every value: first_format if given,
+        otherwise the one inferred from values. '''
+        if self._date_parser == None:
+            return self._convert
+        parse = self._date_parser.parse
+        first = (first_format if first_format != None else self.infer_format(values)) or None
+        return lambda txt: parse(txt, first)
+
+    def _convert_encoded(self, values : EncodedColumn) -> "tuple[list, int]":
+        # each distinct value is converted once
+        converted = []
+        failed = set()
+        for code in range(len(values.values)):
+            try:
+                converted.append(self._convert(values.decode(code)))
+            except Exception:
+                converted.append(None)
+                failed.add(code)
+        errors = sum(1 for c in values.codes if c in failed) if failed else 0
+        return [ converted[c] for c in values.codes ], errors
+
+    def _convert_parallel(self, values : list, workers : int, first_format : str = None) -> "tuple[list, int]":
+        size = -(-len(values) // workers)
+        out = []
+        errors = 0
+        # infer from the whole column here, so every chunk parses ambiguous dates the same way
+        if first_format == None:
+            first_format = self.infer_format(values)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [ executor.submit(_convert_chunk, self.format, self.source_type, self.target_type, values[i:i + size], first_format)
+                for i in range(0, len(values), size) ]
+            for future in futures:
+                chunk, chunk_errors = future.result()
+                out.extend(chunk)
+                errors += chunk_errors
+        return out, errors
+
+def _convert_chunk(format : DataSetFormat, source_type : COLUMN_TYPE, target_type : COLUMN_TYPE, values : list, first_format : str) -> "tuple[list, int]":
+    ''' Runs a ConversionPlan in a worker process. Module level so it can be pickled. '''
+    return DataSet([], format=format).conversion_plan(source_type, target_type).convert(values, first_format=first_format)
+
+class WriteSafeView:
+    ''' Iterates over a dataset as dicts of write-safe values, converting columns listed in types (e.g. DATE -> TEXT) 
+    per row. Nothing is copied, so memory use is about one row whatever the size of the dataset. 
+    Values which can't be converted are written as None and counted in non_critical_errors, as in change_column_type. '''
+
+    def __init__(self, dataset : "DataSet", types : Dict[COLUMN_TYPE,COLUMN_TYPE]):
+        self._dataset = dataset
+        self.columns : List[DataColumn] = []
+        self.converted_columns : List[str] = []
+        self.non_critical_errors = 0
+        self._plan = [] # (column name, column storage, ConversionPlan or None)
+        for col in dataset.columns:
+            values = dataset._data[dataset._column_names[col.name]]
+            if col.type in types:
+                self._plan.append((col.name, values, dataset.conversion_plan(col.type, types[col.type])))
+                self.converted_columns.append(col.name)
+                self.columns.append(DataColumn(types[col.type], col.name))
+            else:
+                self.columns.append(DataColumn(col.type, col.name))
+                self._plan.append((col.name, values, None))
+
+    @property
+    def column_names(self) -> list:
+        return [col.name for col in self.columns]
+
+    def __len__(self) -> int:
+        return self._dataset._row_count
+
+    def __iter__(self):
+        for row in range(self._dataset._row_count):
+            out = {}
+            for name, values, plan in self._plan:
+                v = values[row]
+                if plan is not None:
+                    try:
+                        v = plan.convert_value(v)
+                    except DataError:
+                        self.non_critical_errors += 1
+                        v = None
+                out[name] = v
+            yield out
+
 class DataSet:
+    compact_threshold = 0.5 # see compact
 
     def __init__(self,columns:list,records:list=[],format:DataSetFormat = DataSetFormat()):
         # columns is always a list of DataColumns
         # records can be a list of dicts
         # default time format is identical to Notion's
+        # values are stored column-wise: _data[column index][row index]
         if not isinstance(format, DataSetFormat):
             raise TypeError(format)
         self._columns = []
         self._deleted_column_ids = []
-        self.records : list[DataRecord] = []
+        self._data : list[list] = []
+        self._shared_ids = set() # column ids whose storage is shared with another dataset (copy-on-write)
+        self._unique_counts : dict[int, Counter] = {} # lazily built value counts by column id; see get_uniques
+        self._indexes : dict[int, DataIndex] = {} # secondary indexes by column id; see create_index
+        self._date_parser : DateParser = None
+        self._date_formatter : DateFormatter = None
+        self._date_parser_formats : list = None
+        self._date_formats : dict[str, str] = {} # date format inferred for each column converted from text
+        self._date_format : str = None # the one format all of _date_formats agree on, if they do; see _text_to_date
+        self._row_count = 0
         self._column_names = {}
         self.format = format
         for i in range(0,len(columns)):
@@ -118,6 +606,7 @@ class DataSet:
             new_col = DataColumn(col.type,col.name)
             self._column_names[col.name] = i
             self._columns.append(new_col)
+            self._data.append(_column_storage(col.type, []))
 
         for r in records:
             self.add_record(r)
@@ -139,6 +628,11 @@ class DataSet:
             }
         }
 
+    @property
+    def records(self) -> DataRecordList:
+        ''' Sequence of row views. Indexing and iteration create DataRecords on demand. '''
+        return DataRecordList(self)
+
     def add_records(self, records:list) -> list:
         return [self.add_record(rec) for rec in records]
 
@@ -149,38 +643,38 @@ class DataSet:
         if isinstance(record, dict): 
             r = self._add_record_from_dict(record)
         else:
-            d = self.record_to_dict(record)
-            r = self._add_record_from_dict(d)
+            r = self._add_record_from_record(record)
         return r
 
     def remap(self, map : DataMap) -> OperationStatus:
         ''' Changes column names and types according to the map object, until they all match the desired mapping.
-        Returns a copy of self with columns remapped.
+        Returns a new dataset with columns remapped. Unchanged columns share storage with self until either is written to;
+        only retyped columns are materialised.
         map: A dictionary, with the source_column as key and DataColumn (i.e. target name and type) as value. Also 
         '''
-        clone : DataSet = copy.deepcopy(self)
+        # columns are shared with self rather than copied; either dataset copies a column the first time it writes to it
+        clone = DataSet([], format=copy.deepcopy(self.format))
+        clone._row_count = self._row_count
         type_change_results = {}
 
         missing_map_source = []
         for map_entry in map.columns:
-            if map_entry not in clone.column_names:
+            if map_entry not in self._column_names:
                 missing_map_source.append(map_entry)
-        # needs to happen before clone is modified
 
         for col in self.columns:
+            # columns not in the map don't go anywhere, so they're simply not projected into the clone
+            # unclear what best behaiour is in situation where there's a desired source column that's not in the dataset
+            # most likely this is a problem with /generating/ the mapping or the mapping being outdated, not the remapping process, 
+            # so for now we're simply returning some information on this in the OperationStatus
             if col.name not in map.columns:
-                # it doesn't go anywhere, so delete it
-                # unclear what best behaiour is in situation where there's a desired source column that's not in the dataset
-                # most likely this is a problem with /generating/ the mapping or the mapping being outdated, not the remapping process, 
-                # so for now we're simply returning some information on this in the OperationStatus
-                clone.drop_column(col.name)
-            else:
-                if col.type != map.columns[col.name].type:
-                    type_change_results[col.name] = clone.change_column_type(col.name, map.columns[col.name].type)
-                if map.columns[col.name].name != col.name:
-                    # print( self.column_names )
-                    # print( "Renaming " + col.name + " to " + map.columns[col.name].name )
-                    clone.rename_column(col.name,map.columns[col.name].name) # this could be dangerous - we're modifying what we're looping over
+                continue
+            target = map.columns[col.name]
+            if target.name in clone._column_names:
+                raise ColumnError(COLUMN_ERROR_CODE.COLUMN_ALREADY_EXISTS, target.name)
+            clone._share_column(self, col.name, target.name)
+            if col.type != target.type:
+                type_change_results[col.name] = clone.change_column_type(target.name, target.type)
 
         total_errors = sum([x.non_critical_errors for x in type_change_results.values()])
         result_info = {
@@ -190,6 +684,43 @@ class DataSet:
         }
         return OperationStatus("remap", OP_STATUS_CODE.OP_SUCCESS, non_critical_errors=total_errors,op_returns=result_info)
 
+    def _share_column(self, source : "DataSet", source_name : str, new_name : str):
+        ''' Appends a column to self which uses source's storage for source_name until either side writes to it. '''
+        source_i = source._column_names[source_name]
+        new_i = len(self._columns)
+        self._columns.append(DataColumn(source._columns[source_i].type, new_name))
+        self._data.append(source._data[source_i])
+        self._column_names[new_name] = new_i
+        self._shared_ids.add(new_i)
+        source._shared_ids.add(source_i)
+
+    def _own_column(self, i : int) -> list:
+        ''' Copies shared column storage before it is written to. '''
+        if i in self._shared_ids:
+            self._data[i] = self._data[i].copy()
+            self._shared_ids.discard(i)
+        return self._data[i]
+
+    def _set_column_data(self, i : int, values : list):
+        self._data[i] = _column_storage(self._columns[i].type, values)
+        self._shared_ids.discard(i)
+        self._unique_counts.pop(i, None)
+        if i in self._indexes:
+            self._indexes[i].rows = None # rebuilt on next use
+
+    def _set_value(self, i : int, row : int, value):
+        values = self._own_column(i)
+        index = self._indexes.get(i)
+        if index is not None and index.rows is not None:
+            index._check_insert(value, row)
+            index._remove(values[row], row)
+            index._insert(value, row)
+        counts = self._unique_counts.get(i)
+        if counts is not None:
+            _uncount_value(counts, values[row])
+            _count_value(counts, value)
+        values[row] = value
+
     @property
     def column_names(self) -> list:
         '''Returns current list of column names. Note that this is not the map of column names to indexes.'''
@@ -203,7 +734,7 @@ class DataSet:
     def column_to_list(self, column_name) -> list:
         if column_name not in self._column_names:
             raise ColumnError(COLUMN_ERROR_CODE.COLUMN_NOT_FOUND)
-        return [ record[column_name] for record in self.records ]
+        return list(self._data[self._column_names[column_name]])
 
     def record_to_dict(self, record:DataRecord):
         record_dict = {}
@@ -212,14 +743,63 @@ class DataSet:
         return record_dict
 
     def _add_record_from_dict(self, record):
-        record_fields = {}
+        if self._shared_ids: self._own_all_columns()
+        data = self._data
         for k, v in self._column_names.items():
-            if k in record: record_fields[v] = record[k]
-            else: record_fields[v] = None
+            data[v].append(record.get(k))
             # just ignore any additional fields; fill spaces that don't have a column with None
-        r = DataRecord(self._column_names, record_fields)
-        self.records.append(r)
-        return r
+        return self._commit_row()
+
+    def _add_record_from_record(self, record:DataRecord):
+        if self._shared_ids: self._own_all_columns()
+        data = self._data
+        for k, v in self._column_names.items():
+            data[v].append(record[k])
+        return self._commit_row()
+
+    def _extend_columns(self, column_values : List[list]):
+        ''' Appends rows given column-wise: one equal-length list of values per column, in the order of self.columns. 
+        Used by readers which build whole pages at once. '''
+        column_ids = list(self._column_names.values())
+        if len(column_values) != len(column_ids):
+            raise DataError(DATA_ERROR_CODE.DATA_COLUMNS_INCOMPATIBLE)
+        if len(column_values) == 0: return
+        if self._indexes or self._unique_counts:
+            # keep caches and indexes consistent by going through the per-row path
+            names = list(self._column_names.keys())
+            for row in zip(*column_values):
+                self._add_record_from_dict(dict(zip(names, row)))
+            return
+        if self._shared_ids: self._own_all_columns()
+        n = len(column_values[0])
+        for i, values in zip(column_ids, column_values):
+            if len(values) != n:
+                raise DataError(DATA_ERROR_CODE.DATA_COLUMNS_INCOMPATIBLE)
+        for i, values in zip(column_ids, column_values):
+            self._data[i].extend(values)
+        self._row_count += n
+
+    def _own_all_columns(self):
+        for i in list(self._shared_ids):
+            self._own_column(i)
+
+    def _commit_row(self) -> DataRecord:
+        # storage for dropped columns is not extended; it is replaced wholesale if the column id is reused
+        row = self._row_count
+        if self._indexes:
+            try:
+                for i, index in self._indexes.items():
+                    if index.rows is not None: index._check_insert(self._data[i][-1], row)
+            except DataError:
+                for i in self._column_names.values():
+                    self._data[i].pop() # roll back the half-added row
+                raise
+            for i, index in self._indexes.items():
+                if index.rows is not None: index._insert(self._data[i][-1], row)
+        for i, counts in self._unique_counts.items():
+            _count_value(counts, self._data[i][-1])
+        self._row_count += 1
+        return DataRecord(self, self._row_count - 1)
 
     def get_column_index(self, key) -> int:
         if key not in self._column_names:
@@ -245,8 +825,7 @@ class DataSet:
         self._column_names[new_name] = self._column_names[old_name]
         self._columns[self._column_names[new_name]].name = new_name # rename the actual column object
         del self._column_names[old_name]
-        for record in self.records:
-            record._column_names = self._column_names
+        # storage and value caches are keyed by column id, so nothing else needs to change
 
     def get_next_column_id(self) -> int:
         ''' Gets next available column id. '''
@@ -264,15 +843,13 @@ class DataSet:
         # recycling old column ids to avoid throwing off previous fields in records
         if len(self._columns) == new_column_id:
             self._columns.append(column)
+            self._data.append(None)
         else:
             self._columns[new_column_id] = column
             self._deleted_column_ids.pop()
 
         self._column_names[column.name] = new_column_id
-
-        for record in self.records:
-            record._column_names = self._column_names
-            record._fields[new_column_id] = default_val
+        self._set_column_data(new_column_id, _filled_column(column.type, default_val, self._row_count))
 
     def drop_column(self, column_name: str):
         if column_name not in self._column_names:
@@ -284,18 +861,48 @@ class DataSet:
         # current solution, rather than deleting column and requiring update for each record - just delist it from column names
         del self._column_names[column_name]
         self._deleted_column_ids.append(index)
+        if index in self._shared_ids:
+            # another dataset still uses the storage, so there's nothing to reclaim later; just let go of it
+            self._shared_ids.discard(index)
+            self._data[index] = None
+        self._unique_counts.pop(index, None)
+        self._indexes.pop(index, None)
+        if len(self._deleted_column_ids) > self.compact_threshold * len(self._columns):
+            self.compact()
 
         # simply delisting column is a lot more efficient
         # for record in self.records:
         #     record._column_names = self._column_names
         #     del record._fields[index]
 
-    def change_column_type(self, source_column : str, new_type : COLUMN_TYPE, new_column_name : str = None, inplace = True):
-        ''' Changes column type, modifying in-place by default or creating a new column if given a name. '''
+    def compact(self) -> OperationStatus:
+        ''' Frees the storage of dropped columns and renumbers the remaining column ids so they're contiguous again.
+        drop_column calls this itself once more than compact_threshold of the column ids are dropped ones.
+        Returns the number of columns removed and an estimate of the bytes freed in op_returns. '''
+        dead_ids = set(self._deleted_column_ids)
+        bytes_reclaimed = sum(_storage_bytes(self._data[i]) for i in dead_ids)
+        live_ids = sorted(self._column_names.values())
+        new_ids = { old: new for new, old in enumerate(live_ids) }
+        self._columns = [ self._columns[i] for i in live_ids ]
+        self._data = [ self._data[i] for i in live_ids ]
+        self._column_names = { name: new_ids[i] for name, i in self._column_names.items() }
+        self._shared_ids = { new_ids[i] for i in self._shared_ids }
+        self._unique_counts = { new_ids[i]: counts for i, counts in self._unique_counts.items() }
+        self._indexes = { new_ids[i]: index for i, index in self._indexes.items() }
+        self._deleted_column_ids = []
+        return OperationStatus("compact", OP_STATUS_CODE.OP_SUCCESS, { "columns_removed": len(dead_ids), "bytes_reclaimed": bytes_reclaimed })
+
+    def change_column_type(self, source_column : str, new_type : COLUMN_TYPE, new_column_name : str = None, inplace = True, workers : int = None,
+            first_format : str = None):
+        ''' Changes column type, modifying in-place by default or creating a new column if given a name. 
+        Given workers, large columns are converted in that many worker processes (see ConversionPlan). 
+        Text is converted to dates trying first_format first, or otherwise the format inferred from the column, which is 
+        returned in op_returns["first_format"] so readers can convert later pages of the same column alike. '''
         if source_column not in self._column_names:
             raise ColumnError(COLUMN_ERROR_CODE.COLUMN_NOT_FOUND, source_column)
 
         source_type = self.get_column(source_column).type
+        source_values = self._data[self._column_names[source_column]]
 
         if source_type not in self.CONVERT_DICT:
             raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE)
@@ -328,24 +935,26 @@ class DataSet:
         # else:
         #     dest_column = source_column
 
-        cannot_convert = 0
-
-        for r in self.records:
-            try:
-                r[dest_column] = self.change_data_type(r[source_column], source_type, new_type)
-            except DataError as err:
-                if err.error_code == DATA_ERROR_CODE.DATA_CANNOT_CONVERT:
-                    # this is fine and probably a result of user error or incomplete data
-                    cannot_convert += 1
-                    r[dest_column] = None
-                elif err.error_code == DATA_ERROR_CODE.DATA_TYPE_INCOMPATIBLE:
-                    # this is not fine and shows that our data structures are wack
-                    # it should never actually happen, but could happen if more sophisticated data checking implemented later?
-                    raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE)
+        # values which can't be converted are fine and probably a result of user error or incomplete data; they're counted and set to None
+        plan = self.conversion_plan(source_type, new_type)
+        if first_format == None:
+            first_format = plan.infer_format(source_values)
+        dest_values, cannot_convert = plan.convert(source_values, workers, first_format)
+
+        self._set_column_data(self._column_names[dest_column], dest_values)
+        if first_format != None:
+            self._date_formats[dest_column] = first_format
+            known = set(f for f in self._date_formats.values() if f != "")
+            self._date_format = known.pop() if len(known) == 1 else None
         
-        return OperationStatus("change_column_type", OP_STATUS_CODE.OP_SUCCESS, non_critical_errors=cannot_convert, op_returns={"new_column_name": dest_column})
+        return OperationStatus("change_column_type", OP_STATUS_CODE.OP_SUCCESS, non_critical_errors=cannot_convert, 
+            op_returns={"new_column_name": dest_column, "first_format": first_format})
         # lets us know about failed conversions so we can alert user to possible data loss
 
+    def conversion_plan(self, source_type : COLUMN_TYPE, target_type : COLUMN_TYPE) -> ConversionPlan:
+        ''' A converter between two column types using this dataset's format, for converting many values at once. '''
+        return ConversionPlan(self, source_type, target_type)
+
     # here we're changing data type in the INTERNAL representation
     def change_data_type(self, input: object, input_type : COLUMN_TYPE, output_type: COLUMN_TYPE):
         if input_type not in self.CONVERT_DICT:
@@ -360,12 +969,15 @@ class DataSet:
 
     def make_write_safe(self, types : Dict[COLUMN_TYPE,COLUMN_TYPE]) -> OperationStatus:
         ''' returns copy of dataset with unsafe columns converted to native values (e.g. datetime to string) 
-        and a reference for which columns were thus converted '''
+        and a reference for which columns were thus converted. Columns which don't need converting share storage with self.
+        Writers should prefer write_safe_view, which converts row by row and copies nothing. '''
 
-        clone = copy.deepcopy(self)
+        clone = DataSet([], format=copy.deepcopy(self.format))
+        clone._row_count = self._row_count
 
         unsafe_columns = []
-        for col in clone.columns:
+        for col in self.columns:
+            clone._share_column(self, col.name, col.name)
             if col.type in types:
                 unsafe_columns.append(col.name)
         for unsafe_col in unsafe_columns:
@@ -376,97 +988,125 @@ class DataSet:
 
         return status
 
+    def write_safe_view(self, types : Dict[COLUMN_TYPE,COLUMN_TYPE]) -> "WriteSafeView":
+        ''' Returns a read-only view of the dataset which converts unsafe columns one row at a time as it is iterated. '''
+        return WriteSafeView(self, types)
+
+    def create_index(self, column_name : str, unique : bool = False) -> DataIndex:
+        ''' Builds a persistent index on a column, which is then maintained as records are added or changed and survives renames. 
+        merge, append and NotionWriter.update_table use it instead of rebuilding a key index each time. 
+        A unique index raises a DataError (DATA_DUPLICATE_KEY) on any operation which would duplicate a key. '''
+        i = self.get_column_index(column_name)
+        if self._columns[i].type == COLUMN_TYPE.MULTI_SELECT:
+            raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE, "Can't index a multi-select column.")
+        index = DataIndex(self, unique)
+        index._build(self._data[i])
+        self._indexes[i] = index
+        return index
+
+    def drop_index(self, column_name : str):
+        self._indexes.pop(self.get_column_index(column_name), None)
+
+    def get_index(self, column_name : str) -> DataIndex:
+        ''' Returns the index on a column, or None if the column isn't indexed. '''
+        i = self.get_column_index(column_name)
+        index = self._indexes.get(i)
+        if index is not None and index.rows is None:
+            if self._columns[i].type == COLUMN_TYPE.MULTI_SELECT:
+                raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE, "Can't index a multi-select column.")
+            index._build(self._data[i])
+        return index
+
     def get_uniques(self) -> Dict[str, Set[str]]:
-        ''' Current implementation is extremely inefficient as it calculates the values on-the-fly. 
-            This is a major motivation for adding caching features to the DataSet class. '''
-        return self.calculate_uniques()
+        ''' Unique values for each column, served from a per-column cache which is built on first use and then kept 
+        up to date as records are added or changed. '''
+        return { col_name: set(self._get_unique_counts(col_i)) for col_name, col_i in self._column_names.items() }
+
+    def get_value_counts(self, column_name : str) -> Dict[object, int]:
+        ''' Number of times each value appears in a column. Multi-select values are counted per option. '''
+        return dict(self._get_unique_counts(self.get_column_index(column_name)))
+
+    def _get_unique_counts(self, col_i : int) -> Counter:
+        counts = self._unique_counts.get(col_i)
+        if counts is None:
+            values = self._data[col_i]
+            if isinstance(values, EncodedColumn):
+                counts = values.value_counts()
+            else:
+                counts = Counter()
+                for v in values:
+                    _count_value(counts, v)
+            self._unique_counts[col_i] = counts
+        return counts
 
     def calculate_uniques(self) -> Dict[str, Set[str]]:
-        ''' This is not an efficient method, but there is no more efficient way to do this. Caching will help. '''
+        ''' Recalculates unique values with a full scan of every column. get_uniques serves the same result from a cache. '''
         select_columns : dict[str, Set[str]] = {}
-        for column in self.columns:
-            select_columns[column.name] = set()
-        for record in self.records:
-            for col in select_columns: # i.e. keys
-                vals = select_all(record[col])
-                for val in vals:
-                    select_columns[col].add(val)
+        for col_name, col_i in self._column_names.items():
+            uniques = set()
+            for v in self._data[col_i]:
+                if isinstance(v, list): uniques.update(v)
+                else: uniques.add(v)
+            select_columns[col_name] = uniques
         return select_columns        
 
     def equivalent_to(self, other : 'DataSet', key_column : str = None):
-        ''' Checks if dataset is equivalent to another dataset: i.e. its columns are the same and its records can be matched to exactly one other record in the other dataset. '''
-        # TODO: Add function to determine the optimal index for a key, to optimise when key isn't provided
+        ''' Checks if dataset is equivalent to another dataset: i.e. its columns are the same and its records can be matched to exactly one other record in the other dataset. 
+        Runs in expected O(n) by comparing the multisets of rows; key_column is still validated but no longer needed to pair records up. '''
         if not have_same_columns(self, other): 
-            # print ("Columns differ.")
-            # print (self.columns)
-            # print (other.columns)
             return False
         if key_column != None and (key_column not in self.column_names or key_column not in other.column_names):
             raise ColumnError(COLUMN_ERROR_CODE.COLUMN_NOT_FOUND)
-        if len(self.records) == 0 and len(other.records) == 0: return True # they're both an empty set with the same column spec
-
-        self_indexes = build_all_key_indexes(self)
-        other_indexes = build_all_key_indexes(other)
-
-        if key_column == None:
-            # determine optimal key column (one with most bins)
-            max_bins = 0
-            kc = None
-            for col in self_indexes:
-                if len(self_indexes[col]) != len(other_indexes[col]):
-                    # indexes differ, therefore data is different
-                    # print ("Different indexes.")
-                    return False
-                else:
-                    # same number of bins but might not be the same data
-                    cur_bins = len(self_indexes[col])
-                    if cur_bins > max_bins: 
-                        max_bins = cur_bins
-                        kc = col
-
-        else: kc = key_column
-
-        return self._check_equivalent_to(self_indexes[kc],other_indexes[kc])
-
-    def _check_equivalent_to(self, self_index : dict, other_index : dict):
-        ''' Using a column index generated by build_key_index or build_all_key_indexes to check equivalence of two datasets. '''
-        # check equivalence
-        # TODO: 
-        # appears to only be checking value of first record...
-        for self_key in self_index:
-            # a key doesn't exist in the other index - they're not the same data
-            if self_key not in other_index: 
-                # print ("Key not in other index.")
-                return False
-            # need to use indexes in the other_r section
-            other_records = select_all(other_index[self_key])
-            other_to_check = [x for x in range(len(other_records))]
-            self_records = select_all(self_index[self_key])
-            self_to_check = [x for x in range(len(self_records))]
-            if len(other_to_check) != len(self_to_check): return False
-            # setting up a *list of indexes* to avoid manipulating the record objects inplace
-            self_i_i = 0
-            while self_i_i < len(self_to_check):
-                other_i_i = 0
-                self_i = self_to_check[self_i_i]
-                other_r = None
-                self_r = self_records[self_i]
-                while other_i_i < len(other_to_check):
-                    other_i = other_to_check[other_i_i]
-                    other_r = other_records[other_i]
-                    if other_r == self_r:
-                        other_to_check.remove(other_i)
-                        self_to_check.remove(self_i)
-                        self_i_i = -1 # go to start of new list
-                        break
-                    other_i_i += 1
-                if (len(self_to_check) == 0): break
-                self_i_i += 1
-            if len(self_to_check) > 0 or len(other_to_check) > 0: 
-                # print ("Index length is unequal.")
-                return False 
-            # i.e. there's not exactly 1 match for every record
-        return True
+        if self._row_count != other._row_count: return False
+        if self._row_count == 0: return True # they're both an empty set with the same column spec
+
+        column_names = self.column_names
+        remaining = self._row_counts(column_names)
+        for row in other._normalised_rows(column_names):
+            count = remaining.get(row, 0)
+            if count == 0: return False # row isn't in self, or is in other more times
+            remaining[row] = count - 1
+        return True # same number of rows, and every row in other was matched
+
+    def compare_to(self, other : 'DataSet', max_differences : int = 10) -> OperationStatus:
+        ''' Like equivalent_to, but also reports up to max_differences rows (as dicts) which are only in self or only in other. 
+        Returns the result in op_returns["equivalent"]. '''
+        result_info = { "equivalent": False, "only_in_self": [], "only_in_other": [] }
+        if not have_same_columns(self, other):
+            return OperationStatus("compare_to", OP_STATUS_CODE.OP_SUCCESS, result_info)
+
+        column_names = self.column_names
+        self_counts = self._row_counts(column_names)
+        other_counts = other._row_counts(column_names)
+        only_in_self = self_counts - other_counts
+        only_in_other = other_counts - self_counts
+
+        result_info["equivalent"] = len(only_in_self) == 0 and len(only_in_other) == 0
+        for dest, diff, ds in (("only_in_self", only_in_self, self), ("only_in_other", only_in_other, other)):
+            # report the original records, in dataset order
+            for record, row in zip(ds.records, ds._normalised_rows(column_names)):
+                if len(result_info[dest]) >= max_differences: break
+                if diff.get(row, 0) > 0:
+                    diff[row] -= 1
+                    result_info[dest].append(record.asdict())
+
+        return OperationStatus("compare_to", OP_STATUS_CODE.OP_SUCCESS, result_info)
+
+    def _normalised_rows(self, column_names : list):
+        ''' Yields each row as a hashable tuple of values, in the order given by column_names. '''
+        columns = []
+        for name in column_names:
+            values = self._data[self._column_names[name]]
+            if isinstance(values, EncodedColumn):
+                values = values.hashable_values()
+            elif any(isinstance(v, (list, dict, set)) for v in values):
+                values = [_hashable(v) for v in values]
+            columns.append(values)
+        if len(columns) == 0: return iter([()] * self._row_count)
+        return zip(*columns)
+
+    def _row_counts(self, column_names : list) -> Counter:
+        return Counter(self._normalised_rows(column_names))
 
     def find_optimal_index(self):
         for column in self.column_names:
@@ -479,33 +1119,29 @@ class DataSet:
     def _text_to_multiselect(self, txt:str):
         return txt.split(self.format.multiselect_delimiter)
 
+    def date_parser(self) -> DateParser:
+        ''' Parses text to dates with this dataset's time formats. Kept (with its memo and counters) while the formats stay the same. '''
+        formats = self.format.time_formats
+        if self._date_parser == None or self._date_parser_formats != formats:
+            self._date_parser = DateParser(formats)
+            self._date_parser_formats = list(formats) # compared as lists, so checking costs no tuple per call
+            self._date_formats, self._date_format = {}, None # inferred from the old formats
+        return self._date_parser
+
+    def date_formatter(self) -> DateFormatter:
+        ''' Formats dates as text with this dataset's time formats. Kept while the formats stay the same. '''
+        formats = tuple(self.format.time_formats)
+        if self._date_formatter == None or self._date_formatter.formats != formats:
+            self._date_formatter = DateFormatter(formats)
+        return self._date_formatter
+
     def _text_to_date(self, txt):
-        date_obj : datetime = None
-        for format in self.format.time_formats:
-            try:
-                date_obj = datetime.strptime(txt,format)
-                break
-            except ValueError: # format doesn't work
-                print ("Format " + format + " unsuccessful in text_to_date.")
-                pass
-        if date_obj == None: # no user-defined formats were successful
-            date_obj = datetime.fromisoformat(txt)
-            # let this one fail with an error, to provide feedback to higher-level functions
-        return date_obj
+        # a single value has no column, so an inferred format is only used when every converted column agreed on it
+        parser = self.date_parser()
+        return parser.parse(txt, self._date_format)
 
     def _date_to_text(self, date : datetime):
-        date_str : str = None
-        for format in self.format.time_formats:
-            try: # generally provides first format
-                date_str = date.strftime(format)
-                break
-            except ValueError: # format doesn't work
-                print ("Format " + format + " unsuccessful in date_to_text.")
-                pass
-        if date_str == None: # no user-defined formats were successful or provided
-            date_str = date.isoformat()
-            # let this one fail with an error, to provide feedback to higher-level functions
-        return date_str
+        return self.date_formatter().format(date)
 
     def _multiselect_to_text(self, multi_select: list):
         return self.format.multiselect_delimiter.join(multi_select)
@@ -514,6 +1150,22 @@ class DataSet:
         return select
         # difference between select and text is largely determined by external (i.e. data source) representations, not the data itself
 
+def _hashable(value):
+    ''' Converts (possibly nested) lists, dicts and sets to tuples and frozensets so values can be hashed for comparison. '''
+    if isinstance(value, list): return tuple(_hashable(v) for v in value)
+    if isinstance(value, dict): return tuple((k, _hashable(v)) for k, v in sorted(value.items()))
+    if isinstance(value, set): return frozenset(_hashable(v) for v in value)
+    return value
+
+def _count_value(counts : Counter, value):
+    if isinstance(value, list): counts.update(value)
+    else: counts[value] += 1
+
+def _uncount_value(counts : Counter, value):
+    for v in select_all(value):
+        counts[v] -= 1
+        if counts[v] <= 0: del counts[v]
+
 def select_first_or_only(input):
     if isinstance(input, list):
         return input[0]
@@ -590,10 +1242,10 @@ def merge(left : DataSet, right : DataSet, left_key : str, right_key : str, over
 
     new_set = combine_columns(left, right, left_join, right_join, inner_join)
 
-    index_left = build_key_index(left, left_key)
-    index_right = build_key_index(right, right_key)
-    left_keys = set(k for k in index_left.keys())
-    right_keys = set(k for k in index_right.keys())
+    index_left = key_index(left, left_key)
+    index_right = key_index(right, right_key)
+    left_keys = set(index_left.keys())
+    right_keys = set(index_right.keys())
 
     if inner_join:
         for k in left_keys.intersection(right_keys):
@@ -603,12 +1255,8 @@ def merge(left : DataSet, right : DataSet, left_key : str, right_key : str, over
             # removed force_uniques option for making result of operations unpredictable
             # (it makes result dependent on order of storage of records)
             #
-            # if force_uniques:
-            #     lrs = [select_first_or_only(index_left[k])]
-            #     rrs = [select_first_or_only(index_right[k])]
-            # else:
-            lrs = select_all(index_left[k])
-            rrs = select_all(index_right[k])
+            lrs = index_left.records(k)
+            rrs = index_right.records(k)
 
             for lr in lrs:
                 for rr in rrs:        
@@ -617,41 +1265,41 @@ def merge(left : DataSet, right : DataSet, left_key : str, right_key : str, over
 
     if left_join:
         for k in left_keys.difference(right_keys):
-            for record in select_all(index_left[k]):
+            for record in index_left.records(k):
                 new_set.add_record(record)
 
     if right_join:
         for k in right_keys.difference(left_keys):
-            for record in select_all(index_right[k]):
+            for record in index_right.records(k):
                 new_set.add_record(record)
 
     return new_set
 
-def merge_records(left: DataRecord, right: DataRecord, dataset:DataSet, overwrite=False):
+def merge_records(left: DataRecord, right: DataRecord, dataset:DataSet, overwrite=False) -> dict:
+    ''' Returns the merged fields as a dict, ready for dataset.add_record. '''
     new_fields = {}
 
     for col_name in dataset.column_names:
-        i = dataset.get_column_index(col_name)
         if col_name in left._column_names and col_name in right._column_names:
             # in both sources
             right_val = right[col_name]
             left_val = left[col_name]
             if (left_val != None and right_val == None) or overwrite:
-                new_fields[i] = left_val
-            else: new_fields[i] = right_val # note this includes scenario where both are None
+                new_fields[col_name] = left_val
+            else: new_fields[col_name] = right_val # note this includes scenario where both are None
         elif col_name in left._column_names:
             # only in left
             left_val = left[col_name]
-            new_fields[i] = left_val
+            new_fields[col_name] = left_val
         elif col_name in right._column_names:
             # only in right
             right_val = right[col_name]
-            new_fields[i] = right_val
+            new_fields[col_name] = right_val
         else:
             # in neither
-            new_fields[i] = None
+            new_fields[col_name] = None
 
-    return DataRecord(dataset._column_names, new_fields)
+    return new_fields
 
 def have_same_columns(left: DataSet, right: DataSet) -> bool:
     ''' Returns true if columns are identical between two datasets. '''
@@ -668,20 +1316,20 @@ def have_same_columns(left: DataSet, right: DataSet) -> bool:
 
 def append(left: DataSet, right: DataSet, left_key: str, right_key: str, ignore_duplicates: bool = False):
 
-    index_left = build_key_index(left, left_key)
-    index_right = build_key_index(right, right_key)
+    index_left = key_index(left, left_key)
+    index_right = key_index(right, right_key)
     new_set = DataSet(right.columns) # make a new, empty dataset with only the valid columns from 1
-    for k in index_right:
-        for r in select_all(index_right[k]):
+    for k in index_right.keys():
+        for r in index_right.records(k):
             new_set.add_record(r)
         # insert all right data records
-    for k in index_left:
+    for k in index_left.keys():
         if k not in index_right or (k in index_right and not ignore_duplicates):
             if ignore_duplicates: 
-                r = select_first_or_only(index_left[k])
+                r = index_left.records(k)[0]
                 new_set.add_record(r)
             else:
-                for r in select_all(index_left[k]):
+                for r in index_left.records(k):
                     new_set.add_record(r)
             # add left data records where there's no matching key in right or if duplicates are allowed
     return new_set
@@ -692,6 +1340,14 @@ def new_append(left: DataSet, right: DataSet, left_join: bool = True, right_join
     ds.add_records(right.records)
     return ds
         
+def key_index(ds : DataSet, key_col : str) -> DataIndex:
+    ''' Returns the dataset's persistent index on key_col if it has one, otherwise builds a temporary one. '''
+    index = ds.get_index(key_col)
+    if index is None:
+        index = DataIndex(ds)
+        index._build(ds._data[ds.get_column_index(key_col)])
+    return index
+
 def build_key_index(ds:DataSet, key_col : str):
     index = {}
     for r in ds.records:
@@ -4,7 +4,120 @@ from os.path import *
 from typing import Callable
 import json
 
+class JsonRecordStream:
+    ''' Incrementally parses a JSON export of the form {"header": {...}, "records": [ RECORD ... ]}. 
+    The header is parsed on opening; records are then decoded one at a time from a bounded buffer, so memory use 
+    depends on the page size rather than the size of the file. '''
+
+    chunk_size = 1 << 16
+
+    def __init__(self, f):
+        self._f = f
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self._first_record = True
+        self._fallback_records = None # used if records come before the header in the file
+        self.header = None
+        self.done = False
+        self._read_to_records()
+
+    def _fill(self) -> bool:
+        ''' Reads another chunk into the buffer, dropping what's already been consumed. Returns False at end of file. '''
+        if self._eof: return False
+        chunk = self._f.read(self.chunk_size)
+        if chunk == "":
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _peek(self) -> str:
+        ''' Skips whitespace and returns the next character, or "" at end of file. '''
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in " \t\n\r":
+                self._pos += 1
+            if self._pos < len(self._buf): return self._buf[self._pos]
+            if not self._fill(): return ""
+
+    def _expect(self, ch : str):
+        if self._peek() != ch:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, f"Expected '{ch}' in JSON file.")
+        self._pos += 1
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number or literal at the end of the buffer might continue in the next chunk
+                if end < len(self._buf) or not self._fill():
+                    self._pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Invalid JSON in file.")
+
+    def _read_to_records(self):
+        self._expect("{")
+        while self._peek() != "}":
+            key = self._decode_value()
+            self._expect(":")
+            if key == "records":
+                if self.header is None:
+                    self._read_whole_file()
+                    return
+                self._expect("[")
+                return
+            value = self._decode_value()
+            if key == "header":
+                self.header = value
+            if self._peek() == ",": self._pos += 1
+        if self.header is None:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "No header found in JSON file.")
+        self.done = True # no records array
+
+    def _read_whole_file(self):
+        self._f.seek(0)
+        raw_json = json.load(self._f)
+        if "header" not in raw_json:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "No header found in JSON file.")
+        self.header = raw_json["header"]
+        self._fallback_records = iter(raw_json["records"])
+
+    def _next_record(self) -> dict:
+        ''' Returns the next record, or None once the records array has ended. '''
+        if self._fallback_records is not None:
+            return next(self._fallback_records, None)
+        if self._peek() == "]":
+            self._pos += 1
+            return None
+        if not self._first_record:
+            self._expect(",")
+        self._first_record = False
+        return self._decode_value()
+
+    def read(self, limit : int = -1) -> List[dict]:
+        ''' Returns up to limit records (all remaining records if limit is -1), setting done once there are none left. '''
+        records = []
+        while not self.done and (limit < 0 or len(records) < limit):
+            record = self._next_record()
+            if record is None:
+                self.done = True
+                break
+            records.append(record)
+        return records
+
+@dataclass
 class JsonSyncHandle(SyncHandle):
+    ''' Holds the open file and parser position between pages of a JSON read, and the date format inferred for each date
+    column from the first page, so every page parses dates the same way. '''
+
+    handle : JsonRecordStream
+    date_formats : dict = None
+
     def __init_subclass__(cls) -> None:
         return super().__init_subclass__()
     
@@ -13,7 +126,46 @@ class JsonSyncHandle(SyncHandle):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self.close()
+
+    def close(self):
+        if self.handle != None:
+            self.handle._f.close()
+            self.handle = None
+
+def make_header(dataset : DataSet) -> dict:
+    ''' Header describing a dataset's columns and format, shared by the JSON and NDJSON formats. '''
+    column_dict = {}
+    for col in dataset.columns:
+        column_dict[col.name] = int(col.type) # original types, so dates are read back in as dates
+    format_as_dict = { "multiselect_delimiter": dataset.format.multiselect_delimiter, "time_formats": dataset.format.time_formats }
+    return {
+        "columns": column_dict,
+        "format": format_as_dict
+    }
+
+def parse_header(header : dict) -> "tuple[List[DataColumn], List[str], DataSetFormat]":
+    ''' Reads a header written by make_header. Returns the columns to load records with (dates as TEXT, since they're stored as strings), 
+    the names of the date columns to convert afterwards, and the dataset format. '''
+    format_raw = header["format"]
+    format_obj = DataSetFormat( multiselect_delimiter= format_raw["multiselect_delimiter"], time_formats=format_raw["time_formats"] )
+
+    columns_raw : dict = header["columns"]
+    
+    date_cols = []
+    columns_obj = []
+
+    for col in columns_raw:
+        if COLUMN_TYPE(columns_raw[col]) == COLUMN_TYPE.DATE:
+            columns_obj.append(DataColumn(COLUMN_TYPE.TEXT, col))
+            date_cols.append(col)
+        else:
+            columns_obj.append(DataColumn(COLUMN_TYPE(columns_raw[col]), col))
+    return columns_obj, date_cols, format_obj
+
+def _dumps_indented(obj, level : int) -> str:
+    ''' json.dumps with indent=4, shifted right by level indents so it can be nested in a larger document. '''
+    return json.dumps(obj, indent=4).replace("\n", "\n" + "    " * level)
 
 class JsonWriter(SourceWriter):
     ''' Write records to a JSON file. '''
@@ -37,33 +189,19 @@ class JsonWriter(SourceWriter):
 
     def _create_table(self, dataset: DataSet, callback : Callable = None):
         ''' Sync function which is basis for async and sync methods. '''
-        clone = copy.deepcopy(dataset)
-
-        column_dict = {}
+        safe_view = dataset.write_safe_view({ COLUMN_TYPE.DATE: COLUMN_TYPE.TEXT })
 
-        date_columns = []
-        for col in clone.columns:
-            column_dict[col.name] = int(col.type)
-            if col.type == COLUMN_TYPE.DATE:
-                date_columns.append(col.name)
-        for date_col in date_columns:
-            clone.change_column_type(date_col, COLUMN_TYPE.TEXT)
-        
-        format_as_dict = { "multiselect_delimiter": clone.format.multiselect_delimiter, "time_formats": clone.format.time_formats }
-
-        records_list = [ r.asdict() for r in clone.records ]
-        
-        json_obj = {
-            "header": {
-                "columns": column_dict,
-                "format": format_as_dict
-            },
-            "records": records_list
-        }
+        header = make_header(dataset)
 
+        # written piece by piece (with the same layout as json.dump(..., indent=4)) so records are never all in memory at once
         try:
             with open(self.path, 'w', encoding="utf-8") as f:
-                json.dump(json_obj, f, indent=4)
+                f.write('{\n    "header": ' + _dumps_indented(header, 1) + ',\n    "records": [')
+                first = True
+                for r in safe_view:
+                    f.write(('\n' if first else ',\n') + '        ' + _dumps_indented(r, 2))
+                    first = False
+                f.write(']\n}' if first else '\n    ]\n}')
         except:
             raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
 
@@ -97,35 +235,39 @@ class JsonReader(SourceReader):
     def read_records_sync(self, limit: int = -1, next_iterator: SyncHandle = None) -> SyncHandle:
         return self._read_records(limit, next_iterator)
         
-    def _read_records(self, limit : int = -1, next_iterator = None) -> DataSet:
-        # open file
+    def _read_records(self, limit : int = -1, next_iterator : JsonSyncHandle = None) -> JsonSyncHandle:
+        ''' Reads the next page of up to limit records (or everything left if limit is -1). The header is parsed on the first call 
+        and the parser position is carried in the returned handle. '''
+        f = None
         try:
-            with open(self.path, 'r', encoding="utf-8") as f:
-                raw_json = json.load(f)
+            if next_iterator == None:
+                f = open(self.path, 'r', encoding="utf-8")
+                stream = JsonRecordStream(f)
+                date_formats = {}
+            else:
+                if next_iterator.handle == None:
+                    raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "JSON handle has already been read to the end or closed.")
+                stream = next_iterator.handle
+                date_formats = next_iterator.date_formats
+            records = stream.read(limit)
+        except SyncError:
+            if f != None: f.close()
+            raise
         except:
+            if f != None: f.close()
             raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Error reading file in.")
 
-        format_raw = raw_json["header"]["format"]
-        format_obj = DataSetFormat( multiselect_delimiter= format_raw["multiselect_delimiter"], time_formats=format_raw["time_formats"] )
-
-        columns_raw : dict = raw_json["header"]["columns"]
-        
-        date_cols = []
-
-        for col in columns_raw:
-            if COLUMN_TYPE(columns_raw[col]) == COLUMN_TYPE.DATE:
-                columns_raw[col] = COLUMN_TYPE.TEXT
-                date_cols.append(col)
-
-        columns_obj = [ DataColumn(COLUMN_TYPE(columns_raw[col]), col) for col in columns_raw ]
-
-        records = raw_json["records"]
-        if limit >= 1:
-            records = records[:limit]
+        columns_obj, date_cols, format_obj = parse_header(stream.header)
 
         ds = DataSet(columns_obj, records=records, format=format_obj)
         
         for date_col in date_cols:
-            ds.change_column_type(date_col, COLUMN_TYPE.DATE) # reformat all dates in the file to actually be datetime objects
+            # reformat all dates in the file to actually be datetime objects
+            status = ds.change_column_type(date_col, COLUMN_TYPE.DATE, first_format=date_formats.get(date_col))
+            date_formats[date_col] = status.op_returns["first_format"]
+
+        if stream.done:
+            stream._f.close()
+            stream = None
 
-        return JsonSyncHandle(ds, DATA_SOURCE.JSON, None, True) # there's no meaningful handle available for JSON, so just dump everything out
\ No newline at end of file
+        return JsonSyncHandle(ds, DATA_SOURCE.JSON, stream, stream == None, date_formats=date_formats)
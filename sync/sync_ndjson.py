@@ -0,0 +1,230 @@
+from .sync_types import *
+from .sync_json import make_header, parse_header
+import os
+from os.path import *
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+from io import BufferedReader
+import json
+
+# Newline-delimited JSON: the first line is a header (as in the JSON format), then one compact record per line.
+# {"columns": {"COLUMN_NAME": COLUMN_TYPE ...}, "format": {...}}
+# {"COLUMN_NAME": VALUE ...}
+# ...
+# Because every record is a line of its own, files can be appended to, read from any line-aligned byte offset
+# and split into chunks which are parsed in parallel.
+
+def _dumps_compact(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def _read_header_line(f : BufferedReader) -> dict:
+    line = f.readline()
+    if line.strip() == b"":
+        raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "No header found in NDJSON file.")
+    return json.loads(line)
+
+def _parse_lines(path : str, start : int, end : int, column_names : List[str]) -> List[list]:
+    ''' Parses records in the byte range [start, end) of a file, which must begin and end on line boundaries.
+    Returns values column-wise, to keep what's passed back between processes small. Module level so it can run in a worker process. '''
+    column_values = [ [] for _ in column_names ]
+    with open(path, "rb") as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if line == b"": break
+            if line.strip() == b"": continue
+            record = json.loads(line)
+            for values, name in zip(column_values, column_names):
+                values.append(record.get(name))
+    return column_values
+
+@dataclass
+class NdjsonSyncHandle(SyncHandle):
+    ''' Holds the open file between pages. offset is the byte position of the next unread record, which can be saved
+    and passed back to NdjsonReader.read_records_sync to resume a read later. '''
+
+    handle : BufferedReader
+    offset : int = 0
+    header : dict = None
+    date_formats : dict = None # inferred for each date column from the first page, so every page parses dates alike
+
+    def __init_subclass__(cls) -> None:
+        return super().__init_subclass__()
+
+    def __enter__(self):
+        # No setup required right now.
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.handle != None:
+            self.handle.close()
+            self.handle = None
+
+class NdjsonWriter(SourceWriter):
+    ''' Write records to a newline-delimited JSON file. '''
+    def __init__(self, table_spec : TableSpec):
+        if "file_path" not in table_spec.parameters:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No path parameter found when initialising NdjsonWriter.")
+        dir_path = os.getcwd()
+        if "absolute_path" in table_spec.parameters:
+            dir_path = table_spec.parameters["absolute_path"]
+        self.path = join(dir_path, table_spec.parameters["file_path"])
+
+    def _write_records(self, f, dataset : DataSet):
+        for r in dataset.write_safe_view({ COLUMN_TYPE.DATE: COLUMN_TYPE.TEXT }):
+            f.write(_dumps_compact(r) + "\n")
+
+    def _create_table(self, dataset : DataSet, callback : Callable = None):
+        try:
+            with open(self.path, 'w', encoding="utf-8") as f:
+                f.write(_dumps_compact(make_header(dataset)) + "\n")
+                self._write_records(f, dataset)
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        return callback
+
+    def _append_records(self, records : list, dataset : DataSet, callback : Callable = None):
+        ''' Appends records (records of dataset) to the end of the file, creating it (with a header) if it doesn't exist yet.
+        The dataset's columns and format must match the header of an existing file, as that's what the file is read back with. '''
+        appended = DataSet(dataset.columns, records, format=dataset.format)
+        if not exists(self.path) or getsize(self.path) == 0:
+            return self._create_table(appended, callback)
+        try:
+            with open(self.path, 'rb') as f:
+                header = _read_header_line(f)
+            expected = json.loads(_dumps_compact(make_header(appended))) # as it would read back from the file
+            if header["columns"] != expected["columns"]:
+                raise SyncError(SYNC_ERROR_CODE.INCORRECT_SOURCE, "Dataset columns don't match the NDJSON file being appended to.")
+            if header["format"] != expected["format"]:
+                raise SyncError(SYNC_ERROR_CODE.INCORRECT_SOURCE, "Dataset format (delimiter or time formats) doesn't match the NDJSON file being appended to.")
+            with open(self.path, 'a', encoding="utf-8") as f:
+                self._write_records(f, appended)
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        return callback
+
+    async def create_table(self, dataset: DataSet, callback : Callable = None):
+        ''' Write an NDJSON file from given dataset. This will overwrite any existing file at the given file path. '''
+        return self._create_table(dataset, callback)
+
+    def create_table_sync(self, dataset: DataSet, callback : Callable = None):
+        return self._create_table(dataset, callback)
+
+    async def append_records(self, records : list, dataset: DataSet, callback : Callable = None):
+        return self._append_records(records, dataset, callback)
+
+    def append_records_sync(self, records : list, dataset: DataSet, callback : Callable = None):
+        return self._append_records(records, dataset, callback)
+
+class NdjsonReader(SourceReader):
+    ''' Read records from a newline-delimited JSON file. '''
+    def __init__(self, table_spec : TableSpec):
+        if "file_path" not in table_spec.parameters:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No path parameter found when initialising NdjsonReader.")
+        self.path = join(os.getcwd(), table_spec.parameters["file_path"])
+
+    def get_columns(self) -> List[DataColumn]:
+        try:
+            with open(self.path, 'rb') as f:
+                header = _read_header_line(f)
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        columns, date_cols, _ = parse_header(header)
+        return [ DataColumn(COLUMN_TYPE.DATE, col.name) if col.name in date_cols else col for col in columns ]
+
+    def _make_dataset(self, header : dict, column_values : List[list], date_formats : dict) -> DataSet:
+        ''' Builds a page's dataset. date_formats has the date format to try first for each date column, and gets the one
+        inferred for any column it doesn't have yet. '''
+        columns, date_cols, format = parse_header(header)
+        ds = DataSet(columns, format=format)
+        ds._extend_columns(column_values)
+        for date_col in date_cols:
+            status = ds.change_column_type(date_col, COLUMN_TYPE.DATE, first_format=date_formats.get(date_col))
+            date_formats[date_col] = status.op_returns["first_format"]
+        return ds
+
+    def _read_records(self, limit : int = -1, next_iterator : NdjsonSyncHandle = None, offset : int = None) -> NdjsonSyncHandle:
+        ''' Reads the next page of up to limit records. Without next_iterator, reading starts from the first record,
+        or from offset (a handle's offset from an earlier read) if one is given. '''
+        try:
+            if next_iterator == None:
+                f = open(self.path, 'rb')
+                header = _read_header_line(f)
+                date_formats = {}
+                if offset != None and offset > f.tell():
+                    f.seek(offset)
+            else:
+                if next_iterator.handle == None:
+                    raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "NDJSON handle has already been read to the end or closed.")
+                f = next_iterator.handle
+                header = next_iterator.header
+                date_formats = next_iterator.date_formats
+
+            column_names = list(header["columns"].keys())
+            column_values = [ [] for _ in column_names ]
+            done = False
+            cur_it = 0
+            while cur_it < limit or limit == -1:
+                line = f.readline()
+                if line == b"":
+                    done = True
+                    break
+                if line.strip() == b"": continue
+                record = json.loads(line)
+                for values, name in zip(column_values, column_names):
+                    values.append(record.get(name))
+                cur_it += 1
+            offset = f.tell()
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        except ValueError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Invalid JSON in NDJSON file.")
+
+        if done:
+            f.close()
+            f = None
+
+        return NdjsonSyncHandle(self._make_dataset(header, column_values, date_formats), DATA_SOURCE.NDJSON, f, done, offset=offset, header=header,
+            date_formats=date_formats)
+
+    async def read_records(self, limit : int = -1, next_iterator : NdjsonSyncHandle = None, offset : int = None) -> NdjsonSyncHandle:
+        return self._read_records(limit, next_iterator, offset)
+
+    def read_records_sync(self, limit : int = -1, next_iterator : NdjsonSyncHandle = None, offset : int = None) -> NdjsonSyncHandle:
+        return self._read_records(limit, next_iterator, offset)
+
+    def read_all_records_parallel(self, workers : int = None, chunk_count : int = None) -> DataSet:
+        ''' Reads the whole file by splitting it into line-aligned byte ranges and parsing them in a pool of worker processes.
+        Records keep their order in the file. chunk_count defaults to the number of workers. '''
+        try:
+            with open(self.path, 'rb') as f:
+                header = _read_header_line(f)
+                start = f.tell()
+                end = f.seek(0, os.SEEK_END)
+                chunk_count = chunk_count or workers or os.cpu_count() or 1
+                boundaries = [start]
+                for i in range(1, chunk_count):
+                    f.seek(max(start + (end - start) * i // chunk_count, boundaries[-1]))
+                    f.readline() # move to the start of the next line
+                    boundaries.append(min(f.tell(), end))
+                boundaries.append(end)
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+
+        column_names = list(header["columns"].keys())
+        ranges = [ (a, b) for a, b in zip(boundaries, boundaries[1:]) if b > a ]
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [ executor.submit(_parse_lines, self.path, a, b, column_names) for a, b in ranges ]
+                chunks = [ future.result() for future in futures ]
+        except ValueError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Invalid JSON in NDJSON file.")
+
+        column_values = [ [] for _ in column_names ]
+        for chunk in chunks:
+            for values, chunk_values in zip(column_values, chunk):
+                values.extend(chunk_values)
+        return self._make_dataset(header, column_values, {})
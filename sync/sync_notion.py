@@ -1,13 +1,488 @@
 from turtle import update
 from .sync_types import *
+from .sync_snapshot import SnapshotReader, SnapshotWriter
 from ..dataset import COLUMN_TYPE, DataSet
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import asyncio
+import functools
+import random
+import threading
+import time
 import uuid
 import json
+import weakref
 from typing import Callable
+from os.path import exists
 
 select_color_list = ["orange", "yellow", "green", "blue", "purple", "pink", "red"]
 notion_version = "2021-08-16"
+notion_api_url = "https://api.notion.com/v1"
+
+class RateLimiter:
+    ''' Token bucket allowing rate requests per second on average, in bursts of up to burst requests. Thread safe, so one limiter 
+    can be shared by every session using the same integration. rate=None turns off the limit, though pauses still apply. '''
+    def __init__(self, rate : float = 3.0, burst : int = 5, clock : Callable[[], float] = time.monotonic, sleep : Callable[[float], None] = time.sleep) -> None:
+        self.rate = rate # Notion's documented average limit is 3 requests per second
+        self.burst = burst
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._paused_until = float("-inf")
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        ''' Takes a token, waiting until one is free and any pause is over. Returns the seconds spent waiting. '''
+        with self._lock:
+            now = self._clock()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate != None:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= 1 # below zero, the token is reserved for when it's refilled
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def pause(self, seconds : float):
+        ''' Holds back every request for seconds, e.g. after the API says to retry later. '''
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
+
+class RetryPolicy:
+    ''' When and how long to wait before retrying a Notion request. Rate limited (429) responses are always retried, after 
+    their Retry-After time if given. Server errors and dropped connections are only retried for requests which are safe to repeat,
+    as a page creation may have gone through. Otherwise the delay is exponential backoff with full jitter. '''
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_retries : int = 5, base_delay : float = 0.5, max_delay : float = 30.0, seed : int = None) -> None:
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+
+    def idempotent(self, method : str, path : str) -> bool:
+        return method in ("GET", "PATCH") or path.endswith("/query") or path == "/search"
+
+    def should_retry(self, method : str, path : str, response : requests.Response, attempt : int) -> bool:
+        if attempt >= self.max_retries:
+            return False
+        if response != None and response.status_code == 429:
+            return True
+        if response == None or response.status_code in self.retry_statuses:
+            return self.idempotent(method, path)
+        return False
+
+    def delay(self, attempt : int, response : requests.Response = None) -> float:
+        retry_after = _retry_after(response)
+        if retry_after != None:
+            return retry_after
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def _retry_after(response : requests.Response) -> float:
+    ''' Seconds to wait from a Retry-After header (in seconds or as an HTTP date), or None if there isn't a usable one. '''
+    if response == None or "Retry-After" not in response.headers:
+        return None
+    value = response.headers["Retry-After"]
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+@dataclass
+class _SchemaEntry:
+    columns : List[DataColumn]
+    last_edited_time : str
+    etag : str
+    checked : float # clock time the entry was last fetched or confirmed
+
+class SchemaCache:
+    ''' Columns of Notion databases by id. Entries are trusted for ttl seconds; after that the next lookup asks the server again,
+    but keeps the cached columns if the database's ETag or last_edited_time shows it hasn't changed. '''
+    def __init__(self, ttl : float = 300.0, clock : Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self._clock = clock
+        self._entries : Dict[str, _SchemaEntry] = {}
+        self._lock = threading.Lock() # also held while fetching, so concurrent misses make one request
+
+    @staticmethod
+    def _key(table_id : str) -> str:
+        return table_id.replace('-', '')
+
+    def columns(self, table_id : str, fetch : Callable[[dict], requests.Response], parse : Callable[[dict], List[DataColumn]]) -> List[DataColumn]:
+        ''' Cached columns of table_id (as new DataColumns, so callers can change them). On a miss or an expired entry, 
+        fetch is called with any conditional request headers and parse turns the database object into columns. '''
+        key = SchemaCache._key(table_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            now = self._clock()
+            if entry != None and now - entry.checked < self.ttl:
+                return [ DataColumn(col.type, col.name) for col in entry.columns ]
+            headers = { "If-None-Match": entry.etag } if entry != None and entry.etag != None else {}
+            res = fetch(headers)
+            if entry != None and res.status_code == 304:
+                entry.checked = now
+            elif res.status_code != 200:
+                raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+            else:
+                json = res.json()
+                last_edited_time = json.get("last_edited_time")
+                if entry != None and last_edited_time != None and last_edited_time == entry.last_edited_time:
+                    entry.checked = now
+                    entry.etag = res.headers.get("ETag")
+                else:
+                    entry = self._entries[key] = _SchemaEntry(parse(json), last_edited_time, res.headers.get("ETag"), now)
+            return [ DataColumn(col.type, col.name) for col in entry.columns ]
+
+    def store(self, table_id : str, columns : List[DataColumn], last_edited_time : str = None, etag : str = None):
+        ''' Adds columns which were fetched some other way, e.g. along with the rest of the database object. '''
+        with self._lock:
+            self._entries[SchemaCache._key(table_id)] = _SchemaEntry([ DataColumn(col.type, col.name) for col in columns ], last_edited_time, etag, self._clock())
+
+    def invalidate(self, table_id : str = None):
+        ''' Drops the entry for table_id, or every entry if no id is given. '''
+        with self._lock:
+            if table_id == None:
+                self._entries.clear()
+            else:
+                self._entries.pop(SchemaCache._key(table_id), None)
+
+class TableCatalogue:
+    ''' Databases in a workspace by id. The full list comes from a paginated search and is kept for ttl seconds; tables
+    fetched one at a time are added as they're seen. Lookups return copies, as writers update their TableSpec's columns. '''
+    def __init__(self, ttl : float = 300.0, clock : Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self._clock = clock
+        self._tables : Dict[str, "tuple[TableSpec, float]"] = {} # (spec, time added) by id
+        self._listed : float = None # time of the last full listing
+        self._lock = threading.Lock()
+
+    def _fresh(self, checked : float) -> bool:
+        return checked != None and self._clock() - checked < self.ttl
+
+    def get(self, table_id : str) -> TableSpec:
+        ''' The table with the given id if it's known and fresh, otherwise None. '''
+        with self._lock:
+            entry = self._tables.get(SchemaCache._key(table_id))
+            if entry == None or not self._fresh(entry[1]):
+                return None
+            return copy.deepcopy(entry[0])
+
+    def add(self, spec : TableSpec):
+        with self._lock:
+            self._tables[SchemaCache._key(spec.parameters["id"])] = (copy.deepcopy(spec), self._clock())
+
+    def tables(self, list_all : Callable[[], List[TableSpec]]) -> List[TableSpec]:
+        ''' Every table, calling list_all to refresh the list if it's missing or expired. '''
+        with self._lock:
+            if not self._fresh(self._listed):
+                specs = list_all()
+                now = self._clock()
+                self._tables = { SchemaCache._key(spec.parameters["id"]): (spec, now) for spec in specs }
+                self._listed = now
+            return [ copy.deepcopy(spec) for spec, _ in self._tables.values() ]
+
+    def invalidate(self):
+        with self._lock:
+            self._tables.clear()
+            self._listed = None
+
+@dataclass
+class _KeyIndex:
+    ids : Dict[object, List[str]] = field(default_factory=dict) # page ids by key value
+    checked : Dict[object, float] = field(default_factory=dict) # clock time each key was looked up
+    complete : float = None # clock time the whole table was last read, if it has been
+
+class PageIndex:
+    ''' Page ids of database records by the value of a key column, so records can be found without querying for each one.
+    Entries are trusted for ttl seconds. After a whole table has been read, keys missing from it are known to have no pages,
+    until a writer on the same session adds a page to the table. '''
+    def __init__(self, ttl : float = 300.0, clock : Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self._clock = clock
+        self._indexes : Dict["tuple[str, str]", _KeyIndex] = {} # by (table, key column)
+        self._lock = threading.Lock()
+
+    def _fresh(self, checked : float) -> bool:
+        return checked != None and self._clock() - checked < self.ttl
+
+    def get(self, table_id : str, key_col : str, keys : list) -> "tuple[Dict[object, List[str]], list]":
+        ''' Returns (page ids by key for the keys that are known, keys which have to be looked up). '''
+        found, missing = {}, []
+        with self._lock:
+            index = self._indexes.get((SchemaCache._key(table_id), key_col))
+            for key in keys:
+                if index != None and key in index.ids and self._fresh(index.checked[key]):
+                    found[key] = list(index.ids[key])
+                elif index != None and self._fresh(index.complete):
+                    found[key] = []
+                else:
+                    missing.append(key)
+        return found, missing
+
+    def store(self, table_id : str, key_col : str, ids_by_key : Dict[object, List[str]], complete : bool = False):
+        ''' Adds the page ids found for some keys (an empty list for keys with no pages), or for every key if complete. '''
+        with self._lock:
+            now = self._clock()
+            name = (SchemaCache._key(table_id), key_col)
+            if complete or name not in self._indexes:
+                self._indexes[name] = _KeyIndex(complete=now if complete else None)
+            index = self._indexes[name]
+            for key, ids in ids_by_key.items():
+                index.ids[key] = list(ids)
+                index.checked[key] = now
+
+    def invalidate(self, table_id : str = None):
+        ''' Drops the entries for table_id, or every entry if no id is given. '''
+        with self._lock:
+            if table_id == None:
+                self._indexes.clear()
+            else:
+                for name in [ name for name in self._indexes if name[0] == SchemaCache._key(table_id) ]:
+                    del self._indexes[name]
+
+@dataclass
+class NotionMetrics:
+    ''' Counters for a NotionSession. Times are in seconds. '''
+    requests : int = 0 # sent, including retries
+    retries : int = 0
+    throttled_responses : int = 0 # 429 responses
+    throttled_seconds : float = 0.0 # waiting on the rate limiter, including pauses after 429s
+    backoff_seconds : float = 0.0 # waiting before retrying other failures
+
+class NotionSession:
+    ''' Keep-alive HTTP session for the Notion API with a connection pool, authorisation and default headers.
+    Readers and writers given the same session reuse its connections instead of opening one per request.
+    The async methods run at most concurrency requests at once (per event loop), each on a worker thread.
+    Every request waits on rate_limiter and failed requests are retried according to retry; see metrics for how long that took.
+    Readers and writers sharing a session also share its schema_cache, table_catalogue and page_index. '''
+    def __init__(self, api_key : str, pool_size : int = 10, headers : dict = None, base_url : str = notion_api_url, verify = True, concurrency : int = 3,
+        rate_limiter : RateLimiter = None, retry : RetryPolicy = None, schema_cache : SchemaCache = None, table_catalogue : TableCatalogue = None,
+        page_index : PageIndex = None) -> None:
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter if rate_limiter != None else RateLimiter()
+        self.retry = retry if retry != None else RetryPolicy()
+        self.schema_cache = schema_cache if schema_cache != None else SchemaCache()
+        self.table_catalogue = table_catalogue if table_catalogue != None else TableCatalogue()
+        self.page_index = page_index if page_index != None else PageIndex()
+        self.metrics = NotionMetrics()
+        self._metrics_lock = threading.Lock()
+        self._executor : ThreadPoolExecutor = None
+        self._semaphores = weakref.WeakKeyDictionary() # by event loop, as a semaphore can only be used from one
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(pool_size, concurrency))
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._session.auth = BearerAuth(api_key)
+        self._session.headers.update({"Notion-Version": notion_version})
+        if headers != None:
+            self._session.headers.update(headers)
+        self.verify = verify # passed per request, as requests lets REQUESTS_CA_BUNDLE override Session.verify
+
+    def request(self, method : str, path : str, json : dict = None, headers : dict = None) -> requests.Response:
+        ''' Sends a request to path (e.g. "/pages"), relative to base_url. Returns the last response once retries run out;
+        raises the connection error if the last attempt couldn't connect. '''
+        attempt = 0
+        while True:
+            waited = self.rate_limiter.acquire()
+            response, error = None, None
+            try:
+                response = self._session.request(method, self.base_url + path, json=json, headers=headers, verify=self.verify)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                error = err
+            with self._metrics_lock:
+                self.metrics.requests += 1
+                self.metrics.throttled_seconds += waited
+            if not self.retry.should_retry(method, path, response, attempt):
+                if error != None:
+                    raise error
+                return response
+            delay = self.retry.delay(attempt, response)
+            attempt += 1
+            if response != None and response.status_code == 429:
+                self.rate_limiter.pause(delay) # the limit is per integration, so every request backs off
+                with self._metrics_lock:
+                    self.metrics.retries += 1
+                    self.metrics.throttled_responses += 1
+            else:
+                with self._metrics_lock:
+                    self.metrics.retries += 1
+                    self.metrics.backoff_seconds += delay
+                time.sleep(delay)
+
+    def get(self, path : str, headers : dict = None) -> requests.Response:
+        return self.request("GET", path, headers=headers)
+
+    def post(self, path : str, json : dict = None) -> requests.Response:
+        return self.request("POST", path, json)
+
+    def patch(self, path : str, json : dict = None) -> requests.Response:
+        return self.request("PATCH", path, json)
+
+    async def request_async(self, method : str, path : str, json : dict = None) -> requests.Response:
+        ''' Awaitable version of request. Waits for a free slot if concurrency requests are already in flight. '''
+        return await self.call_async(self.request, method, path, json)
+
+    async def call_async(self, fn : Callable, *args):
+        ''' Runs a blocking function which makes requests on this session on a worker thread, in one of the concurrency slots. '''
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore == None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.concurrency)
+        if self._executor == None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="notion")
+        async with semaphore:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args))
+
+    async def get_async(self, path : str) -> requests.Response:
+        return await self.request_async("GET", path)
+
+    async def post_async(self, path : str, json : dict = None) -> requests.Response:
+        return await self.request_async("POST", path, json)
+
+    async def patch_async(self, path : str, json : dict = None) -> requests.Response:
+        return await self.request_async("PATCH", path, json)
+
+    def close(self):
+        if self._executor != None:
+            self._executor.shutdown()
+            self._executor = None
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+class _NotionClient:
+    ''' Shared session handling for NotionReader and NotionWriter. Sessions the client creates are kept one per api key and
+    closed by close() or on leaving a with block; a session passed in is left for its owner to close. '''
+    _session : NotionSession = None
+    _sessions : Dict[str, NotionSession] = None # the sessions created here, by api key
+
+    @property
+    def session(self) -> NotionSession:
+        ''' The session requests are sent through, created on first use if one wasn't passed in. '''
+        if self._session == None or self._session.api_key != self.api_key:
+            replaced = self._session
+            self._session = self._own_session(self.api_key)
+            if replaced != None and self._sessions.get(replaced.api_key) is replaced:
+                del self._sessions[replaced.api_key]
+                replaced.close()
+        return self._session
+
+    def _session_for(self, api_key : str) -> NotionSession:
+        if api_key == None or api_key == self.api_key:
+            return self.session
+        return self._own_session(api_key)
+
+    def _own_session(self, api_key : str) -> NotionSession:
+        if self._sessions == None:
+            self._sessions = {}
+        if api_key not in self._sessions:
+            self._sessions[api_key] = NotionSession(api_key)
+        return self._sessions[api_key]
+
+    def close(self):
+        ''' Closes the sessions this client created. It can still be used afterwards; new sessions are created as needed. '''
+        sessions, self._sessions = self._sessions or {}, None
+        for session in sessions.values():
+            if session is self._session:
+                self._session = None
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def _page_key(value):
+    ''' A key value as pages are looked up by: Notion trims the text it's given, so keys are compared stripped. '''
+    return value.strip() if isinstance(value, str) else value
+
+def run_sync(coroutine):
+    ''' Runs a coroutine to completion from synchronous code. If this thread already has a running event loop,
+    the coroutine runs on its own loop in a helper thread instead. '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+async def gather_each(calls : list, on_done : Callable[[int], None] = None) -> "tuple[list, dict]":
+    ''' Runs calls (functions returning awaitables) concurrently. Returns their results in the order of calls, with None
+    for calls which failed, and the errors of failed calls as SyncErrors by position. on_done is given the number of
+    calls finished so far each time one finishes. '''
+    errors = {}
+    finished = 0
+    async def run(i : int, call : Callable):
+        nonlocal finished
+        try:
+            return await call()
+        except SyncError as err:
+            errors[i] = err
+        except requests.RequestException as err:
+            errors[i] = SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, str(err))
+        finally:
+            finished += 1
+            if on_done != None: on_done(finished)
+    results = await asyncio.gather(*(run(i, call) for i, call in enumerate(calls)))
+    return list(results), errors
+
+class _Stage:
+    ''' A stage of a pipeline: calls started as their inputs become known and run concurrently. Errors are collected as SyncErrors
+    by the key each call was started with, and on_done is given the stage each time a call finishes. '''
+    def __init__(self, code : SYNC_STATUS_CODE, on_done : Callable[["_Stage"], None]) -> None:
+        self.code = code
+        self.on_done = on_done
+        self.started = 0
+        self.finished = 0
+        self.errors = {}
+        self._tasks = []
+        self._last = {} # the last task started for each value of after
+
+    def start(self, key, call : Callable, after = None):
+        ''' Starts call, keeping its result or error under key, which should be unique within the stage. Calls started with the
+        same after value (e.g. a page id) run one at a time, in the order they were started. '''
+        self.started += 1
+        previous = self._last.get(after) if after != None else None
+        task = asyncio.ensure_future(self._run(key, call, previous))
+        if after != None:
+            self._last[after] = task
+        self._tasks.append(task)
+
+    async def _run(self, key, call : Callable, previous : asyncio.Future = None):
+        try:
+            if previous != None:
+                await asyncio.wait([ previous ])
+            return key, await call()
+        except SyncError as err:
+            self.errors[key] = err
+        except requests.RequestException as err:
+            self.errors[key] = SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, str(err))
+        finally:
+            self.finished += 1
+            self.on_done(self)
+
+    async def wait(self) -> list:
+        ''' Waits for every call started so far; returns (key, result) for those which succeeded. '''
+        results = await asyncio.gather(*self._tasks)
+        return [ result for result in results if result != None ]
 
 def make_property_date(ds : DataSet, col_name: str, uvs : Dict[str, Set[str]]):
     return {"date": {}}
@@ -75,6 +550,16 @@ def make_value_date(id : str, value : datetime):
         }
     }
 
+def comparable_value(type : COLUMN_TYPE, value):
+    ''' Normalises value the way Notion stores it, so a local value can be compared with one read back from Notion. '''
+    if type == COLUMN_TYPE.MULTI_SELECT:
+        return [ option for option in (value or []) if option != "" and option != None ]
+    if type == COLUMN_TYPE.DATE and isinstance(value, datetime):
+        return value.astimezone().replace(microsecond=0)
+    if value == "": # Notion reads empty text back as ""
+        return None
+    return value
+
 def make_filter_text(property_name: str, value : str):
     return {
         "property": property_name,
@@ -146,7 +631,7 @@ class NotionSyncHandle(SyncHandle):
     def __exit__(self, exc_type, exc_val, exc_tb):
         pass
 
-class NotionWriter(SourceWriter):
+class NotionWriter(SourceWriter, _NotionClient):
     '''Write records to Notion.'''
 
     make_property_strategies = {
@@ -163,11 +648,19 @@ class NotionWriter(SourceWriter):
         COLUMN_TYPE.MULTI_SELECT: make_value_multiselect,
     }
 
-    def __init__(self, api_key : str = None) -> None:
+    def __init__(self, api_key : str = None, session : NotionSession = None) -> None:
         self.api_key = None
         self.table = None
         if api_key != None:
             self.api_key = api_key
+        elif session != None:
+            self.api_key = session.api_key
+        self._session = session
+
+    def _reader(self) -> "NotionReader":
+        nr = NotionReader(self.api_key, session=self.session)
+        nr.set_table(self.table)
+        return nr
 
     def set_table(self, table : TableSpec):
         self.table = table
@@ -183,7 +676,7 @@ class NotionWriter(SourceWriter):
             parent = {"type": "workspace", "workspace": True}
         title = { "plain_text": spec.name, "annotations": make_annotation(), "type": "text", "text": {"content": spec.name} }
         data = { "parent": parent, "title": [title], "properties": NotionWriter.extract_properties(dataset)}
-        res = requests.post("https://api.notion.com/v1/databases", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
+        res = self.session.post("/databases", json=data)
         json = res.json()
         if res.status_code != 200:
             raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, message=json)
@@ -194,14 +687,20 @@ class NotionWriter(SourceWriter):
         return spec_out
 
     async def write_records(self, dataset : DataSet, limit: int = -1, next_iterator : NotionSyncHandle = None) -> NotionSyncHandle:
-        return self._write_records(dataset, limit, next_iterator)
+        ''' Writes up to limit records as new pages, concurrently (up to the session's concurrency). The handle's records are
+        the created pages in record order, with None for records which failed; params["errors"] has their SyncErrors by record index. '''
+        start_i, end_i = self._write_range(dataset, limit, next_iterator)
+        calls = [ functools.partial(self._write_record_async, dataset, dataset.records[i]) for i in range(start_i, end_i) ]
+        results, errors = await gather_each(calls)
+        errors = { start_i + i: err for i, err in errors.items() }
+        done = end_i >= len(dataset.records)
+        return NotionSyncHandle(results, DATA_SOURCE.NOTION, "", done, params={"last_written": end_i - 1, "errors": errors})
 
     def write_records_sync(self, dataset : DataSet, limit: int = -1, next_iterator : NotionSyncHandle = None) -> NotionSyncHandle:
-        return self._write_records(dataset, limit, next_iterator)
-
-    def _write_records(self, dataset : DataSet, limit: int = -1, next_iterator : NotionSyncHandle = None) -> NotionSyncHandle:
-        results = []
+        ''' Synchronous version of write_records; the pages are still written concurrently. '''
+        return run_sync(self.write_records(dataset, limit, next_iterator))
 
+    def _write_range(self, dataset : DataSet, limit: int = -1, next_iterator : NotionSyncHandle = None) -> "tuple[int, int]":
         record_count = len(dataset.records)
 
         start_i : int = 0
@@ -214,24 +713,9 @@ class NotionWriter(SourceWriter):
         
         if end_i > record_count or limit < 0:
             end_i = record_count
-        
-        last_written_out = 0
-        for i in range(start_i, end_i):
-            record = dataset.records[i]
-            try:
-                write_result = self._write_record(dataset, record)
-                results.append(write_result)
-                last_written_out = i
-            except SyncError as err:
-                print(err)
-
-        done = False
-        if last_written_out >= record_count - 1:
-            done = True
-
-        return NotionSyncHandle(results, DATA_SOURCE.NOTION, "", done, params={"last_written": last_written_out})            
+        return start_i, end_i
 
-    def _write_record(self, dataset : DataSet, record : DataRecord) -> dict:
+    def _page_data(self, dataset : DataSet, record : DataRecord) -> dict:
         property_dict = {}
 
         if self.table == None:
@@ -245,7 +729,7 @@ class NotionWriter(SourceWriter):
                 if record[col.name] != None:
                     property_dict[col.name] = NotionWriter.make_value_strategies[col.type]( col_id, record[col.name] )
 
-        data = {
+        return {
             "parent": {
                 "type": "database_id",
                 "database_id": self.table.parameters["id"]
@@ -253,94 +737,136 @@ class NotionWriter(SourceWriter):
             "properties": property_dict
         }
 
-        res = requests.post("https://api.notion.com/v1/pages", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
+    async def _write_record_async(self, dataset : DataSet, record : DataRecord) -> dict:
+        res = await self.session.post_async("/pages", json=self._page_data(dataset, record))
+        self.session.page_index.invalidate(self.table.parameters["id"])
         if res.status_code != 200:
             raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
         return res.json()
 
-
-    def update_table(self, left : DataSet, primary_key : str, loop_callback : Callable[[SyncStatus], None]):
-        nr = NotionReader(self.api_key)
-        nr.set_table(self.table)
-
-        # print("Starting to read records from dataset.")
-        handle = nr.read_records_sync(100, include_ids=True)
-        right = handle.records
-        loop_callback(SyncStatus(-1, len(right.records), SYNC_STATUS_CODE.READING_SOURCE))
-
-        while not handle.done:
-            handle = nr.read_records_sync(100, next_iterator=handle, include_ids=True)
-            right.add_records(handle.records.records)
-            loop_callback(SyncStatus(-1, len(right.records), SYNC_STATUS_CODE.READING_SOURCE))
-
-        lki = build_key_index(left,primary_key)
-
-        full_outer_records = merge(left, right, primary_key, primary_key, overwrite=True)
-        left_col_names = set(left.column_names)
-        right_col_names = set(right.column_names)
-        new_col_names = list(left_col_names.difference(right_col_names))
-
-        # print("Found " + len(new_records.records) + " new records and " + len(update_records.records) + " records to update.")
-    
-        if ("notion_page_id" in new_col_names):
-            new_col_names.remove("notion_page_id")
-
-        # print("Updating columns.")
-        self.update_columns(left, new_col_names, self.table.parameters["primary_key"])
-
-        ncs = nr.get_columns()
-        ncs.append( DataColumn(COLUMN_TYPE.TEXT, "notion_page_id") )
-        notion_columns = nr.get_columns_as_dict()
-
+    def update_table(self, left : DataSet, primary_key : str, loop_callback : Callable[[SyncStatus], None], mirror : "NotionMirror" = None) -> OperationStatus:
+        ''' Synchronous version of update_table_async. '''
+        return run_sync(self.update_table_async(left, primary_key, loop_callback, mirror))
+
+    async def update_table_async(self, left : DataSet, primary_key : str, loop_callback : Callable[[SyncStatus], None], mirror : "NotionMirror" = None) -> OperationStatus:
+        ''' Makes the Notion table match left: records whose primary key isn't in Notion yet are created, and existing pages are updated.
+        An existing page is only patched if one of its properties differs from left, and then only with the properties that changed;
+        op_returns counts the records created, patched and skipped (unchanged).
+        The stages overlap: each page of the table is compared with left as soon as it's read, and its patches start while the next
+        page is read. Creates start once the whole table has been read, as only then is it known which keys are missing.
+        Requests are sent concurrently (up to the session's concurrency). A failed request doesn't stop the others;
+        op_returns["errors"] has the SyncError for each failed record by its row index in left. Rows of left with the same key
+        as one page patch it one after another, in row order.
+        With a mirror of this table, only pages edited since its last pull are read from Notion instead of the whole table.
+        An index on left's primary_key (see DataSet.create_index) is used if there is one; left itself isn't changed. '''
+        nr = self._reader()
+
+        # new columns are added first, so records can be compared and written as soon as they're read
+        notion_names = set(col.name for col in await nr.get_columns_async())
+        new_col_names = [ name for name in left.column_names if name not in notion_names and name != "notion_page_id" ]
+        await self.update_columns_async(left, new_col_names, self.table.parameters["primary_key"])
+
+        ncs = await nr.get_columns_async()
+        notion_columns = { col.name: col for col in ncs }
         new_records = DataSet(ncs)
-        update_records = DataSet(ncs)
-
-        for record in full_outer_records.records:
-            if record["notion_page_id"] == None:
-                new_records.add_record(record)
-            elif record[primary_key] in lki:
-                update_records.add_record(record)
-
-        new_records.drop_column("notion_page_id")
-
-        # print("Writing " + str(len(new_records.records)) + " new records.")
-        # each record is its own api call, so a limit of 1 is the same as running larger limits in Notion
-        total_new_records = len(new_records.records)
-        new_records_written = 0
-        total_update_records = len(update_records.records)
-
-        loop_callback(SyncStatus(total_new_records, new_records_written, SYNC_STATUS_CODE.WRITING_SOURCE))
-        write_handle = self.write_records_sync(new_records, 1)
-        new_records_written += 1
-
-        while not write_handle.done:
-            loop_callback(SyncStatus(total_new_records, new_records_written, SYNC_STATUS_CODE.WRITING_SOURCE))
-            write_handle = self.write_records_sync(new_records, 1, write_handle)
-            new_records_written += 1
-
-        loop_callback(SyncStatus(total_new_records, new_records_written, SYNC_STATUS_CODE.WRITING_SOURCE)) # to report completion
-
-        update_records_done = 0
-
-        # print ("Starting update of " + str(len(update_records.records)) + " records.")
-        for record in update_records.records:
-            self.update_record_by_id(record, update_records, record["notion_page_id"], notion_columns)
-            update_records_done += 1
-            loop_callback(SyncStatus(total_update_records, update_records_done, SYNC_STATUS_CODE.UPDATING_SOURCE))
-
-    def update_record_by_id(self, record : DataRecord, dataset : DataSet, id : str, notion_columns : dict[str,DataColumn] = None):
-        if notion_columns == None:
-            nr = NotionReader(self.api_key)
-            nr.set_table(self.table)
-            n_cols = nr.get_columns_as_dict()
+        update_records = DataSet(ncs + [ DataColumn(COLUMN_TYPE.TEXT, "notion_page_id") ])
+
+        # rows of left by key, normalised as keys read from Notion are. An index left already has is used, but none is added,
+        # as left would then have to maintain it through every later change
+        local_rows = {}
+        lki = left.get_index(primary_key)
+        if lki != None:
+            for key, rows in lki.rows.items():
+                local_rows.setdefault(_page_key(key), []).extend(rows)
         else:
-            n_cols = notion_columns
+            if left.get_column(primary_key).type == COLUMN_TYPE.MULTI_SELECT:
+                raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE, "Can't use a multi-select column as a primary key.")
+            for row, key in enumerate(left.column_to_list(primary_key)):
+                local_rows.setdefault(_page_key(key), []).append(row)
+
+        reading = True
+        def report(stage : _Stage):
+            total = -1 if reading and stage.code == SYNC_STATUS_CODE.UPDATING_SOURCE else stage.started
+            loop_callback(SyncStatus(total, stage.finished, stage.code))
+        creates = _Stage(SYNC_STATUS_CODE.WRITING_SOURCE, report)
+        updates = _Stage(SYNC_STATUS_CODE.UPDATING_SOURCE, report)
+
+        ids_by_key = {} # every remote page by key, for the session's page index
+        compared = 0
+        read_count = 0
+        async for page in self._remote_pages(nr, mirror):
+            for remote in page.records:
+                key = _page_key(remote[primary_key])
+                ids_by_key.setdefault(key, []).append(remote["notion_page_id"])
+                for row in local_rows.get(key, []):
+                    record = update_records.add_record(merge_records(DataRecord(left, row), remote, update_records, overwrite=True))
+                    compared += 1
+                    # only pages with a property that differs from what Notion has are patched, and only with those properties.
+                    # The key already matches (stripped), so padding on the local key isn't a change.
+                    changed = [ name for name in self._changed_columns(record, update_records, remote, notion_columns) if name != primary_key ]
+                    if len(changed) > 0:
+                        updates.start(row, functools.partial(self.update_record_by_id_async, record, update_records, remote["notion_page_id"], notion_columns, changed),
+                            after=remote["notion_page_id"])
+            read_count += len(page.records)
+            loop_callback(SyncStatus(-1, read_count, SYNC_STATUS_CODE.READING_SOURCE))
+        reading = False
+
+        for key, rows in local_rows.items():
+            if key in ids_by_key:
+                continue
+            for row in rows:
+                record = new_records.add_record(DataRecord(left, row))
+                creates.start(row, functools.partial(self._write_record_async, new_records, record))
+
+        created = await creates.wait()
+        await updates.wait()
+        for row, page in created:
+            ids_by_key.setdefault(_page_key(DataRecord(left, row)[primary_key]), []).append(page["id"])
+        self.session.page_index.store(self.table.parameters["id"], primary_key, ids_by_key, complete=True)
+
+        report(creates)
+        report(updates)
+        errors = { **creates.errors, **updates.errors }
+        result_info = {
+            "created": creates.started - len(creates.errors),
+            "patched": updates.started - len(updates.errors),
+            "skipped": compared - updates.started,
+            "errors": errors
+        }
+        status = OP_STATUS_CODE.OP_SUCCESS if len(errors) == 0 else OP_STATUS_CODE.OP_FAILURE
+        return OperationStatus("update_table", status, result_info, non_critical_errors=len(errors))
+
+    async def _remote_pages(self, nr : "NotionReader", mirror : "NotionMirror" = None):
+        ''' The records in the Notion table (with page ids) a page at a time, as they're read. '''
+        if mirror != None:
+            await mirror.pull_async()
+            yield mirror.records
+            return
+        handle = await nr.read_records(100, include_ids=True)
+        yield handle.records
+        while not handle.done:
+            handle = await nr.read_records(100, next_iterator=handle, include_ids=True)
+            yield handle.records
 
+    def _changed_columns(self, record : DataRecord, dataset : DataSet, remote : DataRecord, n_cols : dict[str,DataColumn]) -> List[str]:
+        ''' Names of the columns _update_data would send for record whose values differ from remote, the page as read from Notion. '''
+        changed = []
+        for column in dataset.columns:
+            if column.name not in n_cols or column.type != n_cols[column.name].type:
+                continue
+            if comparable_value(column.type, record[column.name]) != comparable_value(column.type, remote[column.name]):
+                changed.append(column.name)
+        return changed
+
+    def _update_data(self, record : DataRecord, dataset : DataSet, n_cols : dict[str,DataColumn], columns : List[str] = None) -> dict:
+        ''' Page properties for record; all of them, or only those in columns if given. '''
         properties = {}
 
         for column in dataset.columns:
             if column.name not in n_cols:
                 continue
+            if columns != None and column.name not in columns:
+                continue
             if column.type != n_cols[column.name].type:
                 continue
             col_id = self.table.parameters["columns"][column.name]
@@ -349,56 +875,97 @@ class NotionWriter(SourceWriter):
             else: 
                 properties[column.name] = NotionWriter.make_value_strategies[column.type](col_id,record[column.name])
 
-        data = {"properties": properties}
+        return {"properties": properties}
 
-        res = requests.patch(f"https://api.notion.com/v1/pages/{id}", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
+    def update_record_by_id(self, record : DataRecord, dataset : DataSet, id : str, notion_columns : dict[str,DataColumn] = None, columns : List[str] = None):
+        if notion_columns == None:
+            n_cols = self._reader().get_columns_as_dict()
+        else:
+            n_cols = notion_columns
+
+        res = self.session.patch(f"/pages/{id}", json=self._update_data(record, dataset, n_cols, columns))
+        if res.status_code != 200:
+                raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+
+    async def update_record_by_id_async(self, record : DataRecord, dataset : DataSet, id : str, notion_columns : dict[str,DataColumn] = None, columns : List[str] = None):
+        if notion_columns == None:
+            n_cols = { col.name: col for col in await self._reader().get_columns_async() }
+        else:
+            n_cols = notion_columns
+
+        res = await self.session.patch_async(f"/pages/{id}", json=self._update_data(record, dataset, n_cols, columns))
         if res.status_code != 200:
                 raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
 
     def update_record(self, record : DataRecord, dataset : DataSet, key_column : str, key_val : object, update_all : bool = True):
         ''' Note: has complex behaviour where two records share the same key column. '''
-        nr = NotionReader(self.api_key)
-        nr.set_table(self.table)
+        nr = self._reader()
 
-        record_ids = nr.find_record_ids(key_column, key_val)
+        record_ids = nr.resolve_page_ids(key_column, [key_val])[key_val]
         if len(record_ids) == 0:
             raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "Couldn't find record in NotionReader.update_record.")
 
-        notion_columns = nr.get_columns_as_dict()
-
-        properties = {}
-
-        for column in dataset.columns:
-            if column.name not in notion_columns:
-                continue
-            if column.type != notion_columns[column.name].type:
-                continue
-            col_id = self.table.parameters["columns"][column.name]
-            if (self.table.parameters["primary_key"] == column.name):
-                properties[column.name] = make_value_title(col_id, record[column.name])
-            else: 
-                properties[column.name] = NotionWriter.make_value_strategies[column.type](col_id,record[column.name])
-
-        data = {"properties": properties}
+        data = self._update_data(record, dataset, nr.get_columns_as_dict())
 
         if update_all and len(record_ids) > 1:
             for id in record_ids:
-                res = requests.patch(f"https://api.notion.com/v1/pages/{id}", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
+                res = self.session.patch(f"/pages/{id}", json=data)
                 if res.status_code != 200:
                     raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
         else:
             id = record_ids[0]
-            res = requests.patch(f"https://api.notion.com/v1/pages/{id}", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
+            res = self.session.patch(f"/pages/{id}", json=data)
             if res.status_code != 200:
                     raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
 
+    def update_records(self, key_col : str, dataset : DataSet, update_all : bool = True) -> OperationStatus:
+        ''' Synchronous version of update_records_async. '''
+        return run_sync(self.update_records_async(key_col, dataset, update_all))
+
+    async def update_records_async(self, key_col : str, dataset : DataSet, update_all : bool = True) -> OperationStatus:
+        ''' update_record for every record in dataset. The pages are found together (see NotionReader.resolve_page_ids) rather than
+        with a query per record, then patched concurrently. op_returns has the number of pages "updated", the keys with no page
+        ("not_found"), and the SyncError for each failed record by key ("errors"). '''
+        nr = self._reader()
+        n_cols = { col.name: col for col in await nr.get_columns_async() }
+        ids_by_key = await self.session.call_async(nr.resolve_page_ids, key_col, dataset.column_to_list(key_col))
+
+        calls, keys, not_found = [], [], []
+        for record in dataset.records:
+            key = record[key_col]
+            record_ids = ids_by_key[key]
+            if len(record_ids) == 0:
+                not_found.append(key)
+                continue
+            for id in (record_ids if update_all else record_ids[:1]):
+                calls.append(functools.partial(self.update_record_by_id_async, record, dataset, id, n_cols))
+                keys.append(key)
+
+        _, update_errors = await gather_each(calls)
+        errors = { keys[i]: err for i, err in update_errors.items() }
+        status = OP_STATUS_CODE.OP_SUCCESS if len(errors) == 0 and len(not_found) == 0 else OP_STATUS_CODE.OP_FAILURE
+        return OperationStatus("update_records", status, { "updated": len(calls) - len(update_errors), "not_found": not_found, "errors": errors },
+            non_critical_errors=len(errors) + len(not_found))
+
     def update_columns(self, dataset : DataSet, columns : list[str], title_column : str = None):
-        ''' Update database table with columns from dataset. This both appends new columns and modifies existing columns. '''
-        
+        ''' Update database table with columns from dataset. This both appends new columns and modifies existing columns. 
+        Nothing is sent if none of columns are in dataset. '''
+        data = self._columns_data(dataset, columns, title_column)
+        if len(data["properties"]) == 0:
+            return
+        self._columns_updated(self.session.patch("/databases/" + self.table.parameters["id"], json=data))
+
+    async def update_columns_async(self, dataset : DataSet, columns : list[str], title_column : str = None):
+        data = self._columns_data(dataset, columns, title_column)
+        if len(data["properties"]) == 0:
+            return
+        self._columns_updated(await self.session.patch_async("/databases/" + self.table.parameters["id"], json=data))
+
+    def _columns_data(self, dataset : DataSet, columns : list[str], title_column : str = None) -> dict:
         if self.table == None:
             raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "Table not set in NotionWriter.append_columns")
-
-        database_id = self.table.parameters["id"]
+        if len(columns) == 0:
+            return { "properties": {} } # spares extract_properties a pass over every column
 
         property_object = NotionWriter.extract_properties(dataset, infer_title=False, title_column=title_column)
 
@@ -411,15 +978,16 @@ class NotionWriter(SourceWriter):
         for k, v in property_object.items():
             if k in column_names:
                 data["properties"][k] = v
+        return data
 
-        res = requests.patch("https://api.notion.com/v1/databases/" + database_id, json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
-        
+    def _columns_updated(self, res : requests.Response):
         if res.status_code != 200:
             raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
 
         json = res.json()
 
         self.table.parameters["columns"] = get_notion_property_ids(json)
+        self.session.schema_cache.invalidate(self.table.parameters["id"])
 
     @staticmethod
     def extract_properties(ds : DataSet, infer_title = True, title_column = None) -> dict:
@@ -435,16 +1003,20 @@ class NotionWriter(SourceWriter):
                 out[column.name] = NotionWriter.make_property_strategies[column.type](ds, column.name, uniques)
         return out
 
-class NotionReader(SourceReader):
+class NotionReader(SourceReader, _NotionClient):
     '''Read records from Notion.'''
-    def __init__(self, api_key : str = None) -> None:
+    def __init__(self, api_key : str = None, session : NotionSession = None) -> None:
         self.api_key = None
         self.table = None
         if api_key != None:
             self.api_key = api_key
+        elif session != None:
+            self.api_key = session.api_key
+        self._session = session
         self.type_map = {
             "title": COLUMN_TYPE.TEXT,
             "rich_text": COLUMN_TYPE.TEXT,
+            "select": COLUMN_TYPE.SELECT,
             "multi_select": COLUMN_TYPE.MULTI_SELECT,
             "date": COLUMN_TYPE.DATE,
             "created_time": COLUMN_TYPE.DATE
@@ -452,6 +1024,7 @@ class NotionReader(SourceReader):
         self.read_strategies = {
             'title': self._map_notion_text,
             'rich_text': self._map_notion_text,
+            'select': self._map_notion_select,
             'multi_select': self._map_notion_multiselect,
             'date': self._map_notion_date,
             'created_time': self._map_notion_created_time
@@ -466,10 +1039,15 @@ class NotionReader(SourceReader):
     def set_table(self, table : TableSpec):
         self.table = table
 
-    def get_columns(self):
+    def get_columns(self) -> List[DataColumn]:
+        ''' Columns of the table, from the session's schema cache where possible. '''
         if self.table == None:
             raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No table set when reading records from Notion.")
-        return self.get_column_spec(self.api_key, self.table.parameters["id"])
+        table_id = self.table.parameters["id"]
+        return self.session.schema_cache.columns(table_id, lambda headers: self.session.get(f"/databases/{table_id}", headers), self._parse_columns)
+
+    async def get_columns_async(self) -> List[DataColumn]:
+        return await self.session.call_async(self.get_columns)
 
     def get_columns_as_dict(self) -> dict[str,DataColumn]:
         columns = self.get_columns()
@@ -484,19 +1062,48 @@ class NotionReader(SourceReader):
         return self.get_records(self.api_key, self.table.parameters["id"], self.get_columns(), number=limit, iterator=next_iterator, include_ids = include_ids)
 
     async def read_records(self, limit: int = -1, next_iterator: NotionSyncHandle = None, mapping: DataMap = None, include_ids : bool = False) -> NotionSyncHandle:
-        return self._read_records(limit = limit, next_iterator = next_iterator, mapping = mapping, include_ids = include_ids)
+        ''' Reads a page of records. The table's columns are fetched at the same time as the records. '''
+        if self.table == None:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No table set when reading records from Notion.")
+        columns, json = await asyncio.gather(self.get_columns_async(), 
+            self.query_database_async(self.api_key, self.table.parameters["id"], number=limit, iterator=next_iterator))
+        return self._records_handle(json, columns, include_ids)
 
     def read_records_sync(self, limit: int = -1, next_iterator: NotionSyncHandle = None, mapping: DataMap = None, include_ids : bool = False) -> NotionSyncHandle:
         return self._read_records(limit = limit, next_iterator = next_iterator, mapping = mapping, include_ids = include_ids)
 
+    def read_records_since(self, since : str = None, limit : int = 100, next_iterator : NotionSyncHandle = None) -> NotionSyncHandle:
+        ''' Reads a page of the records edited at or after since (an ISO 8601 time, as in a page's last_edited_time), oldest edit first.
+        since=None reads every record. Records have notion_page_id and notion_last_edited_time columns.
+        Notion rounds edit times to the minute, so records edited at since itself are returned again. '''
+        if self.table == None:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No table set when reading records from Notion.")
+        record_filter = None
+        if since != None:
+            record_filter = { "timestamp": "last_edited_time", "last_edited_time": { "on_or_after": since } }
+        sorts = [ { "timestamp": "last_edited_time", "direction": "ascending" } ]
+        json = self.query_database(self.api_key, self.table.parameters["id"], limit, next_iterator, record_filter, sorts)
+        return self._records_handle(json, self.get_columns(), include_ids=True, include_edited_time=True)
+
     def get_table_parents(self) -> "list[TableSpec]":
         ''' Gets possible parents for a table - i.e. pages that are available in Notion. '''
         if self.api_key == None:
             raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "API key not set in NotionReader.")
-        data = { "filter": {"property": "object", "value": "page"} }
-        res = requests.post("https://api.notion.com/v1/search", json=data, auth=BearerAuth(self.api_key), headers={"Notion-Version": notion_version})
-        json = res.json()
-        return [self._parse_page_result(page) for page in json["results"]]
+        return [self._parse_page_result(page) for page in self._search_all(self.session, "page")]
+
+    def _search_all(self, session : NotionSession, object_type : str) -> List[dict]:
+        ''' Every search result of object_type ("page" or "database"), following the pagination cursor. '''
+        data = { "filter": {"property": "object", "value": object_type}, "page_size": 100 }
+        results = []
+        while True:
+            res = session.post("/search", json=data)
+            if res.status_code != 200:
+                raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+            json = res.json()
+            results.extend(json["results"])
+            if not json.get("has_more") or json.get("next_cursor") == None:
+                return results
+            data["start_cursor"] = json["next_cursor"]
 
     def _parse_page_result(self, page) -> "List[TableSpec]":
         title = ""
@@ -508,36 +1115,52 @@ class NotionReader(SourceReader):
         return TableSpec(DATA_SOURCE.NOTION, {"parent_id": page["id"]}, title)
 
     def get_tables(self) -> "list[TableSpec]":
+        ''' Every database shared with the integration, from the session's table catalogue where possible. '''
         if self.api_key == None:
             raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "API key not set in NotionReader.")
-        return self.get_databases(self.api_key)
+        return self.session.table_catalogue.tables(lambda: self.get_databases(self.api_key))
 
     def get_table(self, id:str) -> TableSpec:
-        tables = self.get_tables()
-        for table in tables:
-            if table.parameters["id"].replace('-','') == id.replace('-',''): # normalise ids
-                return table
-        return None
+        ''' Looks up one database by id, or returns None if it doesn't exist or isn't shared with the integration.
+        Uses the table catalogue if it has the table, otherwise fetches it directly (also filling the schema cache). '''
+        if self.api_key == None:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "API key not set in NotionReader.")
+        spec = self.session.table_catalogue.get(id)
+        if spec != None:
+            return spec
+        res = self.session.get(f"/databases/{id}")
+        if res.status_code in (400, 404): # malformed or unknown id
+            return None
+        if res.status_code != 200:
+            raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+        json = res.json()
+        spec = self._parse_database_result(json)
+        self.session.table_catalogue.add(spec)
+        self.session.schema_cache.store(json["id"], self._parse_columns(json), json.get("last_edited_time"), res.headers.get("ETag"))
+        return spec
 
     def get_databases(self, api_key : str):
-        data = { "filter": {"property": "object", "value": "database"} }
-        res = requests.post("https://api.notion.com/v1/search", json=data, auth=BearerAuth(api_key), headers={"Notion-Version": notion_version})
-        json = res.json()
-        return [self._parse_database_result(x) for x in json["results"]]
+        ''' Lists every database shared with the integration, bypassing the table catalogue. '''
+        return [self._parse_database_result(x) for x in self._search_all(self._session_for(api_key), "database")]
 
     def get_records(self, api_key: str, table_id: str, column_info: list, number=100, iterator : NotionSyncHandle = None, record_filter : dict = None, include_ids=False) -> NotionSyncHandle:
         json = self.query_database(api_key, table_id, number, iterator, record_filter)
+        return self._records_handle(json, column_info, include_ids)
+
+    def _records_handle(self, json : dict, column_info : list, include_ids : bool = False, include_edited_time : bool = False) -> NotionSyncHandle:
         it = None
         done = False
         if json["has_more"]:
             it = json["next_cursor"]
         else:
             done = True
-        records = [ self._map_record(record, column_info, include_ids) for record in json["results"] ]
+        records = [ self._map_record(record, column_info, include_ids, include_edited_time) for record in json["results"] ]
 
         final_info = copy.deepcopy(column_info)
         if include_ids:
             final_info.append( DataColumn(COLUMN_TYPE.TEXT, "notion_page_id") )
+        if include_edited_time:
+            final_info.append( DataColumn(COLUMN_TYPE.TEXT, "notion_last_edited_time") ) # kept as text so it compares exactly
 
         return NotionSyncHandle( DataSet(final_info, records), DATA_SOURCE.NOTION, handle=it, done=done )
 
@@ -555,6 +1178,55 @@ class NotionReader(SourceReader):
             out_ids.append(page["id"])
         return out_ids
 
+    def resolve_page_ids(self, key_col : str, keys : list = None, batch_size : int = 100) -> Dict[object, List[str]]:
+        ''' Page ids of the records with each of keys in key_col, as { key: [ids] } with an empty list for keys with no pages.
+        Keys already in the session's page_index aren't looked up again. The rest are looked up with one query (and its pages)
+        per batch_size keys, OR-ing the filters find_record_ids would use. Without keys, the whole table is read once and every
+        key is returned. '''
+        if self.table == None:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No table set when resolving page ids in Notion.")
+        table_id = self.table.parameters["id"]
+        key_column = next(( col for col in self.get_columns() if col.name == key_col ), None)
+        if key_column == None or key_column.type not in (COLUMN_TYPE.TEXT, COLUMN_TYPE.SELECT, COLUMN_TYPE.DATE):
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, f"{key_col} isn't a text, select or date column in Notion.")
+
+        def group(pages : List[dict]) -> Dict[object, List[str]]:
+            ids_by_key = {}
+            for page in pages:
+                key = _page_key(self._map_record(page, [ key_column ])[key_col])
+                ids_by_key.setdefault(key, []).append(page["id"])
+            return ids_by_key
+
+        if keys == None:
+            ids_by_key = group(self._query_all())
+            self.session.page_index.store(table_id, key_col, ids_by_key, complete=True)
+            return ids_by_key
+
+        wanted = list(dict.fromkeys( _page_key(key) for key in keys if key != None ))
+        found, missing = self.session.page_index.get(table_id, key_col, wanted)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            filters = [ self.filter_strategies[key_column.type](key_col, key) for key in batch ]
+            ids_by_key = group(self._query_all(filters[0] if len(filters) == 1 else { "or": filters }))
+            ids_by_key = { key: ids_by_key.get(key, []) for key in batch }
+            self.session.page_index.store(table_id, key_col, ids_by_key)
+            found.update(ids_by_key)
+        return { key: found.get(_page_key(key), []) for key in keys }
+
+    def _query_all(self, record_filter : dict = None) -> List[dict]:
+        ''' Every page of the table matching record_filter, following the pagination cursor. '''
+        data = self._query_data(100, None, record_filter)
+        results = []
+        while True:
+            res = self.session.post(f"/databases/{self.table.parameters['id']}/query", json=data)
+            if res.status_code != 200:
+                raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+            json = res.json()
+            results.extend(json["results"])
+            if not json.get("has_more") or json.get("next_cursor") == None:
+                return results
+            data["start_cursor"] = json["next_cursor"]
+
     def _find_records_raw(self, key_col : str, key_val : object, columns : list[DataColumn]) -> dict:
         data_column = next( filter(lambda col : col.name == key_col, columns))
         if isinstance(key_val, str):
@@ -563,28 +1235,39 @@ class NotionReader(SourceReader):
         
         return self.query_database(self.api_key, self.table.parameters["id"], record_filter=fil)
 
-    def query_database(self, api_key:str, table_id:str, number=100, iterator : NotionSyncHandle = None, record_filter : dict = None) -> dict:
+    def query_database(self, api_key:str, table_id:str, number=100, iterator : NotionSyncHandle = None, record_filter : dict = None, sorts : list = None) -> dict:
         ''' A lower-level function which plugs directly into the Notion query api and provides the interface for the generic functions with Notion. '''
-        url = f"https://api.notion.com/v1/databases/{table_id}/query"
-        data = {"page_size": number}
-        if iterator is not None: data["start_cursor"] = iterator.handle
-        if record_filter is not None: data["filter"] = record_filter # deliberately not doing anything fancy as Notion's filter syntax is complex and better off just building queries that fit Notion
-        res = requests.post(url, json=data, auth=BearerAuth(api_key), headers={"Notion-Version": notion_version})
+        res = self._session_for(api_key).post(f"/databases/{table_id}/query", json=self._query_data(number, iterator, record_filter, sorts))
+        if res.status_code != 200:
+            raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
+        return res.json()
+
+    async def query_database_async(self, api_key:str, table_id:str, number=100, iterator : NotionSyncHandle = None, record_filter : dict = None) -> dict:
+        res = await self._session_for(api_key).post_async(f"/databases/{table_id}/query", json=self._query_data(number, iterator, record_filter))
         if res.status_code != 200:
             raise SyncError(SYNC_ERROR_CODE.REQUEST_REJECTED, res.json())
         return res.json()
+
+    def _query_data(self, number=100, iterator : NotionSyncHandle = None, record_filter : dict = None, sorts : list = None) -> dict:
+        data = {"page_size": number}
+        if iterator is not None: data["start_cursor"] = iterator.handle
+        if record_filter is not None: data["filter"] = record_filter # deliberately not doing anything fancy as Notion's filter syntax is complex and better off just building queries that fit Notion
+        if sorts is not None: data["sorts"] = sorts
+        return data
         
     def get_record_types(self):
         pass
 
     def get_column_spec(self, api_key, id) -> List[DataColumn]:
-        url = f"https://api.notion.com/v1/databases/{id}"
-        res = requests.get(url, auth=BearerAuth(api_key), headers={"Notion-Version": notion_version})
-        json = res.json()
-        return [ self._map_column(k,json["properties"][k]) for k in json["properties"] ]
+        ''' Fetches the columns of a database, bypassing the schema cache. '''
+        res = self._session_for(api_key).get(f"/databases/{id}")
+        return self._parse_columns(res.json())
+
+    def _parse_columns(self, database : dict) -> List[DataColumn]:
+        return [ self._map_column(k,database["properties"][k]) for k in database["properties"] ]
 
     def _parse_database_result(self, result) -> TableSpec:
-        name = result["title"][0]["text"]["content"]
+        name = result["title"][0]["text"]["content"] if len(result["title"]) > 0 else "" # untitled databases have no title text
         params = {'name': name, 'id': result["id"], 'primary_key': get_notion_primary_key(result), 'columns': get_notion_property_ids(result)}
         return TableSpec(DATA_SOURCE.NOTION, parameters=params, name=name)
 
@@ -595,7 +1278,7 @@ class NotionReader(SourceReader):
             col_type = COLUMN_TYPE.TEXT
         return DataColumn(col_type, column_name)
     
-    def _map_record(self, record:dict, columns:list, include_ids:bool=False):
+    def _map_record(self, record:dict, columns:list, include_ids:bool=False, include_edited_time:bool=False):
         out_dict = {}
         column_names = [ col.name for col in columns ]
         for k in column_names:
@@ -610,6 +1293,8 @@ class NotionReader(SourceReader):
                 out_dict[k] = None
         if include_ids:
             out_dict["notion_page_id"] = record["id"]
+        if include_edited_time:
+            out_dict["notion_last_edited_time"] = record.get("last_edited_time")
         return out_dict
 
     def _map_notion_text(self, prop):
@@ -628,8 +1313,88 @@ class NotionReader(SourceReader):
             return None
         return datetime.fromisoformat(prop["date"]["start"])
 
+    def _map_notion_select(self, prop):
+        return None if prop["select"] == None else prop["select"]["name"]
+
     def _map_notion_multiselect(self, prop):
         return [ r["name"] for r in prop["multi_select"] ]
 
     def _map_notion_created_time(self, prop):
-        return prop["created_time"]
\ No newline at end of file
+        return prop["created_time"]
+
+class NotionMirror:
+    ''' A local copy of a Notion table, saved as a snapshot file at path. Each pull only fetches the pages edited since the latest
+    edit already in the mirror (its watermark), and folds them in by page id. Pages deleted or archived in Notion can't be seen
+    by an incremental pull, so they stay in the mirror until pull(full=True) rebuilds it. A change to the table's columns also
+    makes the next pull a full one. '''
+    id_column = "notion_page_id"
+    edited_column = "notion_last_edited_time"
+
+    def __init__(self, reader : NotionReader, path : str, page_size : int = 100) -> None:
+        self.reader = reader
+        self.path = path
+        self.page_size = page_size
+        self._records : DataSet = None
+
+    @property
+    def records(self) -> DataSet:
+        ''' The mirrored records, loaded from path on first use. None if nothing has been pulled yet. '''
+        if self._records == None and exists(self.path):
+            self._records = SnapshotReader(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": self.path}, "mirror")).read_all_records_sync(-1)
+            self._records.create_index(self.id_column, unique=True)
+        return self._records
+
+    @property
+    def watermark(self) -> str:
+        ''' The latest last_edited_time in the mirror, or None if it's empty. '''
+        if self.records == None:
+            return None
+        times = [ t for t in self.records.get_value_counts(self.edited_column) if t != None ]
+        return max(times) if len(times) > 0 else None
+
+    def _mirror_columns(self, columns : List[DataColumn]) -> List[DataColumn]:
+        return columns + [ DataColumn(COLUMN_TYPE.TEXT, self.id_column), DataColumn(COLUMN_TYPE.TEXT, self.edited_column) ]
+
+    def pull(self, full : bool = False) -> OperationStatus:
+        ''' Brings the mirror up to date and saves it. op_returns has the number of records fetched, added and updated (changed), 
+        whether this was a full pull, and the new watermark. '''
+        columns = self._mirror_columns(self.reader.get_columns())
+        mirror = self.records
+        if mirror != None and [ (c.name, c.type) for c in mirror.columns ] != [ (c.name, c.type) for c in columns ]:
+            full = True
+        since = None if full else self.watermark
+        if since == None:
+            mirror = DataSet(columns)
+            mirror.create_index(self.id_column, unique=True)
+        index = mirror.get_index(self.id_column)
+        names = mirror.column_names
+
+        fetched, added, updated = 0, 0, 0
+        handle = None
+        while handle == None or not handle.done:
+            handle = self.reader.read_records_since(since, self.page_size, handle)
+            for record in handle.records.records:
+                fetched += 1
+                existing = index.records(record[self.id_column])
+                if len(existing) == 0:
+                    mirror.add_record(record)
+                    added += 1
+                    continue
+                target = existing[0]
+                changed = [ name for name in names if target[name] != record[name] ]
+                for name in changed:
+                    target[name] = record[name]
+                if len(changed) > 0:
+                    updated += 1
+
+        self._records = mirror
+        self.save()
+        return OperationStatus("pull", OP_STATUS_CODE.OP_SUCCESS, { "fetched": fetched, "added": added, "updated": updated, "full": since == None, "watermark": self.watermark })
+
+    async def pull_async(self, full : bool = False) -> OperationStatus:
+        ''' Awaitable version of pull, which runs on the reader's session like its other requests. '''
+        return await self.reader.session.call_async(self.pull, full)
+
+    def save(self):
+        if self._records != None:
+            SnapshotWriter(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": self.path}, "mirror")).create_table_sync(self._records)
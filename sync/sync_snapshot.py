@@ -0,0 +1,310 @@
+from .sync_types import *
+from .sync_json import make_header, parse_header
+import os
+from os.path import *
+from typing import Callable
+from array import array
+from contextlib import ExitStack
+from datetime import date, datetime, timedelta, timezone
+from itertools import accumulate
+import json
+import mmap
+import struct
+import sys
+
+# Binary snapshot of a DataSet, stored column by column so it can be memory mapped and read without parsing.
+# MAGIC | header length (uint32, little endian) | header (UTF-8 JSON) | column buffers...
+# The header is the JSON format's header plus:
+#   "row_count": number of records
+#   "byteorder": byte order of the integer buffers
+#   "layout": { "COLUMN_NAME": { "encoding": ENCODING, "buffers": [ [typecode, offset, length] ... ] } }
+# where buffer offsets are relative to the end of the header and typecode is an array module typecode ("B" for raw bytes).
+#
+# Encodings (chosen per column when the snapshot is written):
+#   text        string offsets (q, rows + 1), UTF-8 bytes[, null flags (B)]
+#   datetime    microseconds since 1970-01-01 (q) of naive datetimes, _NULL_TIME for None
+#   datetime_tz as datetime, plus UTC offsets in seconds (i), _NULL_OFFSET for naive values
+#   date        days since 1970-01-01 (i) of dates without a time, _NULL_DAY for None
+#   dict        dictionary offsets (q), dictionary UTF-8 bytes, codes (i), _NULL_CODE for None
+#   dict_list   dictionary offsets (q), dictionary UTF-8 bytes, row offsets into codes (q, rows + 1), codes (i)[, null flags (B)]
+#   json        as text, but each value is JSON; used for columns holding values of other types. Values JSON can't hold
+#               (e.g. a DATE column mixing dates and datetimes) raise a DataError rather than being written as strings
+
+_MAGIC = b"ANCSNAP1"
+_NULL_TIME = -(1 << 63)
+_NULL_OFFSET = -(1 << 31)
+_NULL_CODE = -1
+_NULL_DAY = -(1 << 31)
+_EPOCH = datetime(1970, 1, 1)
+_EPOCH_DAY = _EPOCH.toordinal()
+_ALIGNMENT = 8
+
+def _encode_strings(values : List[str]) -> "tuple[array, bytes]":
+    encoded = [ v.encode("utf-8") for v in values ]
+    return array("q", accumulate(map(len, encoded), initial=0)), b"".join(encoded)
+
+def _decode_strings(offsets, blob, start : int, end : int) -> List[str]:
+    ''' Decodes strings start to end from a string table. ASCII data (the common case) is decoded in one go and sliced. '''
+    offs = offsets[start:end + 1].tolist()
+    if len(offs) < 2: return []
+    base = offs[0]
+    chunk = bytes(blob[base:offs[-1]])
+    if chunk.isascii():
+        text = chunk.decode("ascii")
+        return [ text[a - base:b - base] for a, b in zip(offs, offs[1:]) ]
+    return [ chunk[a - base:b - base].decode("utf-8") for a, b in zip(offs, offs[1:]) ]
+
+def _null_flags(values : list):
+    if all(v is not None for v in values): return None
+    return array("B", (v is None for v in values))
+
+def _build_dictionary(values) -> "tuple[dict, List[str]]":
+    codes = {}
+    for v in values:
+        if v not in codes: codes[v] = len(codes)
+    return codes, list(codes)
+
+def _encode_column(column : DataColumn, values : list) -> "tuple[str, list]":
+    ''' Returns the encoding chosen for a column and its buffers (arrays, or bytes for typecode "B"). '''
+    present = [ v for v in values if v is not None ]
+    if column.type == COLUMN_TYPE.DATE and all(isinstance(v, datetime) for v in present):
+        micros = array("q", (_NULL_TIME if v is None else (v.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1) for v in values))
+        if all(v.tzinfo is None for v in present):
+            return "datetime", [micros]
+        offsets = array("i", (_NULL_OFFSET if v is None or v.utcoffset() is None else int(v.utcoffset().total_seconds()) for v in values))
+        return "datetime_tz", [micros, offsets]
+    if column.type == COLUMN_TYPE.DATE and all(type(v) is date for v in present):
+        return "date", [array("i", (_NULL_DAY if v is None else v.toordinal() - _EPOCH_DAY for v in values))]
+    if column.type == COLUMN_TYPE.SELECT and all(isinstance(v, str) for v in present):
+        lookup, dictionary = _build_dictionary(present)
+        return "dict", [*_encode_strings(dictionary), array("i", (_NULL_CODE if v is None else lookup[v] for v in values))]
+    if column.type == COLUMN_TYPE.MULTI_SELECT and all(isinstance(v, list) and all(isinstance(o, str) for o in v) for v in present):
+        lookup, dictionary = _build_dictionary(o for v in present for o in v)
+        row_offsets = array("q", accumulate((0 if v is None else len(v) for v in values), initial=0))
+        codes = array("i", (lookup[o] for v in present for o in v))
+        buffers = [*_encode_strings(dictionary), row_offsets, codes]
+        nulls = _null_flags(values)
+        return "dict_list", buffers if nulls is None else buffers + [nulls]
+    if all(isinstance(v, str) for v in present):
+        encoding, strings = "text", [ "" if v is None else v for v in values ]
+    else:
+        try:
+            encoding, strings = "json", [ "" if v is None else json.dumps(v, ensure_ascii=False) for v in values ]
+        except TypeError as err:
+            raise DataError(DATA_ERROR_CODE.DATA_TYPE_INCOMPATIBLE, f"Can't write column {column.name} to a snapshot: {err}")
+    buffers = list(_encode_strings(strings))
+    nulls = _null_flags(values)
+    return encoding, buffers if nulls is None else buffers + [nulls]
+
+def _apply_nulls(values : list, nulls, start : int, end : int) -> list:
+    if nulls is not None:
+        for row, flag in enumerate(nulls[start:end].tolist()):
+            if flag: values[row] = None
+    return values
+
+def _decode_column(encoding : str, buffers : list, start : int, end : int, dictionary : List[str] = None) -> list:
+    ''' Decodes rows start to end of a column. dictionary is the already-decoded dictionary of a dict or dict_list column. '''
+    if encoding == "datetime":
+        return [ None if v == _NULL_TIME else _EPOCH + timedelta(microseconds=v) for v in buffers[0][start:end].tolist() ]
+    if encoding == "datetime_tz":
+        zones = {}
+        values = []
+        for v, o in zip(buffers[0][start:end].tolist(), buffers[1][start:end].tolist()):
+            if v == _NULL_TIME:
+                values.append(None)
+                continue
+            d = _EPOCH + timedelta(microseconds=v)
+            if o != _NULL_OFFSET:
+                if o not in zones: zones[o] = timezone(timedelta(seconds=o))
+                d = d.replace(tzinfo=zones[o])
+            values.append(d)
+        return values
+    if encoding == "date":
+        return [ None if v == _NULL_DAY else date.fromordinal(v + _EPOCH_DAY) for v in buffers[0][start:end].tolist() ]
+    if encoding == "dict":
+        return [ None if c == _NULL_CODE else dictionary[c] for c in buffers[2][start:end].tolist() ]
+    if encoding == "dict_list":
+        offs = buffers[2][start:end + 1].tolist()
+        codes = buffers[3][offs[0]:offs[-1]].tolist() if offs else []
+        base = offs[0] if offs else 0
+        values = [ [ dictionary[c] for c in codes[a - base:b - base] ] for a, b in zip(offs, offs[1:]) ]
+        return _apply_nulls(values, buffers[4] if len(buffers) > 4 else None, start, end)
+    values = _decode_strings(buffers[0], buffers[1], start, end)
+    if encoding == "json":
+        values = [ json.loads(v) if v != "" else v for v in values ]
+    return _apply_nulls(values, buffers[2] if len(buffers) > 2 else None, start, end)
+
+@dataclass
+class SnapshotSyncHandle(SyncHandle):
+    ''' Holds the memory mapped snapshot between pages. row is the index of the next unread record. '''
+
+    handle : mmap.mmap
+    header : dict = None
+    row : int = 0
+    file : object = None
+    dictionaries : dict = None # decoded dictionaries of dict and dict_list columns, by column name
+
+    def __init_subclass__(cls) -> None:
+        return super().__init_subclass__()
+
+    def __enter__(self):
+        # No setup required right now.
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self.handle != None:
+            self.handle.close()
+            self.handle = None
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+class SnapshotWriter(SourceWriter):
+    ''' Write a dataset to a binary snapshot file. '''
+    def __init__(self, table_spec : TableSpec):
+        if "file_path" not in table_spec.parameters:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No path parameter found when initialising SnapshotWriter.")
+        dir_path = os.getcwd()
+        if "absolute_path" in table_spec.parameters:
+            dir_path = table_spec.parameters["absolute_path"]
+        self.path = join(dir_path, table_spec.parameters["file_path"])
+
+    def _create_table(self, dataset : DataSet, callback : Callable = None):
+        ''' Writes to a temporary file which then replaces the target, so readers with the old snapshot mapped are unaffected. '''
+        header = make_header(dataset)
+        header["row_count"] = dataset._row_count
+        header["byteorder"] = sys.byteorder
+        header["layout"] = {}
+        sections = []
+        position = 0
+        for col in dataset.columns:
+            encoding, buffers = _encode_column(col, dataset._data[dataset._column_names[col.name]])
+            specs = []
+            for buffer in buffers:
+                data = buffer if isinstance(buffer, bytes) else buffer.tobytes()
+                typecode = "B" if isinstance(buffer, bytes) else buffer.typecode
+                padding = -len(data) % _ALIGNMENT
+                specs.append([typecode, position, len(data)])
+                sections.append(data + b"\0" * padding)
+                position += len(data) + padding
+            header["layout"][col.name] = { "encoding": encoding, "buffers": specs }
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        header_bytes += b" " * (-(len(_MAGIC) + 4 + len(header_bytes)) % _ALIGNMENT)
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(_MAGIC)
+                f.write(struct.pack("<I", len(header_bytes)))
+                f.write(header_bytes)
+                for section in sections:
+                    f.write(section)
+            os.replace(temp_path, self.path)
+        except OSError:
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        return callback
+
+    async def create_table(self, dataset: DataSet, callback : Callable = None):
+        ''' Write a snapshot of the given dataset. This will overwrite any existing file at the given file path. '''
+        return self._create_table(dataset, callback)
+
+    def create_table_sync(self, dataset: DataSet, callback : Callable = None):
+        return self._create_table(dataset, callback)
+
+class SnapshotReader(SourceReader):
+    ''' Read records from a binary snapshot file. Opening a snapshot only parses its header;
+    records are decoded straight from the memory mapped file a page at a time. '''
+    def __init__(self, table_spec : TableSpec):
+        if "file_path" not in table_spec.parameters:
+            raise SyncError(SYNC_ERROR_CODE.PARAMETER_NOT_FOUND, "No path parameter found when initialising SnapshotReader.")
+        self.path = join(os.getcwd(), table_spec.parameters["file_path"])
+
+    def _open(self) -> SnapshotSyncHandle:
+        f = None
+        try:
+            f = open(self.path, 'rb')
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            if f != None: f.close()
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        handle = SnapshotSyncHandle(None, DATA_SOURCE.SNAPSHOT, mm, False, file=f, dictionaries={})
+        try:
+            if mm[:len(_MAGIC)] != _MAGIC:
+                raise SyncError(SYNC_ERROR_CODE.INCORRECT_SOURCE, "File is not a snapshot.")
+            header_length = struct.unpack_from("<I", mm, len(_MAGIC))[0]
+            header_start = len(_MAGIC) + 4
+            handle.header = json.loads(mm[header_start:header_start + header_length])
+            handle.header["data_start"] = header_start + header_length
+        except SyncError:
+            handle.close()
+            raise
+        except (ValueError, struct.error):
+            handle.close()
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Invalid snapshot header.")
+        return handle
+
+    def get_columns(self) -> List[DataColumn]:
+        with self._open() as handle:
+            columns, date_cols, _ = parse_header(handle.header)
+        return [ DataColumn(COLUMN_TYPE.DATE, col.name) if col.name in date_cols else col for col in columns ]
+
+    def _buffer(self, stack : ExitStack, handle : SnapshotSyncHandle, typecode : str, offset : int, length : int):
+        ''' A view of one buffer in the mapped file. Views are released when stack exits, as the map can't be closed while they exist. '''
+        start = handle.header["data_start"] + offset
+        view = stack.enter_context(memoryview(handle.handle)[start:start + length])
+        if typecode == "B": return view
+        if handle.header["byteorder"] != sys.byteorder:
+            swapped = array(typecode)
+            swapped.frombytes(view)
+            swapped.byteswap()
+            return swapped
+        return stack.enter_context(view.cast(typecode))
+
+    def _read_records(self, limit : int = -1, next_iterator : SnapshotSyncHandle = None) -> SnapshotSyncHandle:
+        ''' Reads the next page of up to limit records (or everything left if limit is -1). '''
+        if next_iterator == None:
+            handle = self._open()
+        else:
+            if next_iterator.handle == None:
+                raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Snapshot handle has already been read to the end or closed.")
+            handle = next_iterator
+        header = handle.header
+        start = handle.row
+        end = header["row_count"] if limit == -1 else min(start + limit, header["row_count"])
+
+        columns, date_cols, format = parse_header(header)
+        columns = [ DataColumn(COLUMN_TYPE.DATE, col.name) if col.name in date_cols else col for col in columns ]
+        column_values = []
+        try:
+            with ExitStack() as stack:
+                for col in columns:
+                    layout = header["layout"][col.name]
+                    buffers = [ self._buffer(stack, handle, *spec) for spec in layout["buffers"] ]
+                    dictionary = None
+                    if layout["encoding"] in ("dict", "dict_list"):
+                        if col.name not in handle.dictionaries:
+                            handle.dictionaries[col.name] = _decode_strings(buffers[0], buffers[1], 0, len(buffers[0]) - 1)
+                        dictionary = handle.dictionaries[col.name]
+                    column_values.append(_decode_column(layout["encoding"], buffers, start, end, dictionary))
+        except (ValueError, KeyError, IndexError, TypeError):
+            handle.close()
+            raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "Invalid snapshot data.")
+
+        ds = DataSet(columns, format=format)
+        ds._extend_columns(column_values)
+        done = end >= header["row_count"]
+        if done: handle.close()
+        return SnapshotSyncHandle(ds, DATA_SOURCE.SNAPSHOT, handle.handle, done, header=header, row=end, file=handle.file, dictionaries=handle.dictionaries)
+
+    def _read_all_records(self, page_size) -> DataSet:
+        # the whole snapshot is mapped anyway, so decode it in one pass rather than page by page
+        return self._read_records(-1).records
+
+    async def read_records(self, limit : int = -1, next_iterator : SnapshotSyncHandle = None) -> SnapshotSyncHandle:
+        return self._read_records(limit, next_iterator)
+
+    def read_records_sync(self, limit : int = -1, next_iterator : SnapshotSyncHandle = None) -> SnapshotSyncHandle:
+        return self._read_records(limit, next_iterator)
@@ -2,13 +2,82 @@ from .sync_types import *
 import os
 from os.path import *
 from typing import Callable
+from io import TextIOWrapper
 import csv
 
+class TsvReadPlan:
+    ''' The resolved schema for a TSV read: which field of each row feeds which output column, and the ConversionPlan which
+    converts it. Compiled once from the header and mapping, then reused for every page. '''
+
+    def __init__(self, header : List[str], mapping : DataMap = None):
+        if mapping is None: # assume all columns are strings
+            self.columns = [ DataColumn(COLUMN_TYPE.TEXT, my_f) for my_f in header ]
+            self.format = DataSetFormat()
+            self.positions = list(range(len(header)))
+            self.plans = [ None ] * len(header)
+            self.missing_sources = []
+            return
+
+        self.format = mapping.format
+        converter_source = DataSet([], format=self.format) # provides the format-aware conversion plans
+        header_positions = { name: i for i, name in enumerate(header) }
+        self.columns = []
+        self.positions = []
+        self.plans = []
+        self.missing_sources = [ name for name in mapping.columns if name not in header_positions ]
+        for name in header:
+            if name not in mapping.columns:
+                continue # not in the mapping, so it's dropped
+            target = mapping.columns[name]
+            self.columns.append(DataColumn(target.type, target.name))
+            self.positions.append(header_positions[name])
+            if target.type == COLUMN_TYPE.TEXT:
+                self.plans.append(None)
+            elif target.type in converter_source.CONVERT_DICT[COLUMN_TYPE.TEXT]:
+                self.plans.append(converter_source.conversion_plan(COLUMN_TYPE.TEXT, target.type))
+            else:
+                raise ColumnError(COLUMN_ERROR_CODE.COLUMN_TYPE_INCOMPATIBLE, name)
+
+    def read_page(self, reader, limit : int = -1, first_formats : list = None) -> "tuple[DataSet, bool, int]":
+        ''' Reads up to limit rows from a csv reader into a new DataSet. Returns the dataset, whether the reader is exhausted
+        and how many values couldn't be converted (they become None, as in DataSet.change_column_type). first_formats has the
+        date format to try first for each column; columns without one yet get the format inferred from this page. '''
+        column_values = [ [] for _ in self.columns ]
+        fields = list(zip(column_values, self.positions))
+        done = False
+        cur_it = 0
+        while cur_it < limit or limit == -1:
+            row = next(reader, None)
+            if row == None:
+                done = True
+                break
+            width = len(row)
+            for values, position in fields:
+                values.append(row[position] if position < width else None)
+            cur_it += 1
+        errors = 0
+        for i, plan in enumerate(self.plans):
+            if plan is None:
+                continue
+            if first_formats[i] == None:
+                first_formats[i] = plan.infer_format(column_values[i])
+            column_values[i], column_errors = plan.convert(column_values[i], first_format=first_formats[i])
+            errors += column_errors
+        ds = DataSet(self.columns, format=self.format)
+        ds._extend_columns(column_values)
+        return ds, done, errors
+
 @dataclass 
 class TsvSyncHandle(SyncHandle):
-    ''' Be aware that handles may open unmanaged resources, such as sockets or file handles and therefore require at minimum an __exit__ function to be implemented. '''
+    ''' Be aware that handles may open unmanaged resources, such as sockets or file handles and therefore require at minimum an __exit__ function to be implemented. 
+    The open file, its csv reader and the compiled read plan are carried between pages, so paging through a file is a single pass. 
+    So are the date formats inferred from the first page, so every page parses dates the same way. '''
 
-    handle : csv.DictReader
+    handle : TextIOWrapper
+    reader : object = None # csv reader positioned at the next record
+    plan : TsvReadPlan = None
+    first_formats : list = None # date format to try first for each column of the plan
+    conversion_errors : int = 0 # values which couldn't be converted, over every page read so far
 
     def __init_subclass__(cls) -> None:
         return super().__init_subclass__()
@@ -18,8 +87,12 @@ class TsvSyncHandle(SyncHandle):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
         if self.handle != None:
             self.handle.close()
+            self.handle = None
 
 class TsvWriter(SourceWriter):
     ''' Write records to a TSV file. '''
@@ -44,14 +117,13 @@ class TsvWriter(SourceWriter):
             COLUMN_TYPE.SELECT: COLUMN_TYPE.TEXT
         }
 
-        safe_ds = dataset.make_write_safe(conversions).op_returns["safe_data"]
-        record_list = [r.asdict() for r in safe_ds.records]
+        safe_view = dataset.write_safe_view(conversions)
 
         try:
             with open(self.path, 'w', encoding="utf-8") as f:
-                writer = csv.DictWriter(f, dataset.column_names, delimiter="\t")
+                writer = csv.DictWriter(f, safe_view.column_names, delimiter="\t")
                 writer.writeheader()
-                for r in record_list:
+                for r in safe_view: # converted one row at a time
                     writer.writerow(r)
         except:
             raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
@@ -84,42 +156,40 @@ class TsvReader(SourceReader):
             raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
 
     def _read_records(self, limit : int = -1, next_iterator : TsvSyncHandle = None, mapping : DataMap = None) -> TsvSyncHandle:
-        if mapping is None: # assume all columns are strings
-            cols = [ DataColumn(COLUMN_TYPE.TEXT, my_f) for my_f in self._read_header() ]
-            ds_format = DataSetFormat()
-        else: 
-            cols = [ DataColumn(COLUMN_TYPE.TEXT, my_f) for my_f in mapping.columns ]
-            ds_format = mapping.format
-
-        text_dataset = DataSet(cols, format=ds_format)
-        
+        ''' Reads the next page of records. Columns are matched to the mapping by header name; later pages reuse the 
+        reader and plan from next_iterator, so the mapping only needs to be given on the first call. '''
+        opened = None # closed again here if the first page fails
         try:
             if next_iterator == None:
-                f = open(self.path, 'r', encoding="utf-8")
-                reader = csv.DictReader(f, delimiter="\t", fieldnames=text_dataset.column_names)
-                next(reader)
-                # point to first record
+                f = opened = open(self.path, 'r', encoding="utf-8")
+                reader = csv.reader(f, delimiter="\t")
+                header = next(reader, [])
+                plan = TsvReadPlan(header, mapping)
+                first_formats = [ None ] * len(plan.columns)
+                errors = 0
             else:
+                if next_iterator.reader == None:
+                    raise SyncError(SYNC_ERROR_CODE.FILE_ERROR, "TSV handle has already been read to the end or closed.")
                 f = next_iterator.handle
-                reader = csv.DictReader(f, delimiter="\t", fieldnames=text_dataset.column_names)
-
-            done = False
-            cur_it = 0
-            while cur_it < limit or limit == -1:
-                cur_record = next(reader, None)
-                if cur_record == None:
-                    f.close()
-                    f = None
-                    done = True
-                    break
-                text_dataset.add_record(cur_record)
-                cur_it += 1
-        except:
+                reader = next_iterator.reader
+                plan = next_iterator.plan
+                first_formats = next_iterator.first_formats
+                errors = next_iterator.conversion_errors
+
+            ds, done, page_errors = plan.read_page(reader, limit, first_formats)
+            if done:
+                f.close()
+                f = None
+                reader = None
+        except (OSError, csv.Error):
+            if opened != None: opened.close()
             raise SyncError(SYNC_ERROR_CODE.FILE_ERROR)
+        except Exception:
+            if opened != None: opened.close()
+            raise
         
-        if mapping is not None: ds = text_dataset.remap(mapping).op_returns["remapped_data"]
-        else: ds = text_dataset
-        return TsvSyncHandle(ds, DATA_SOURCE.TSV, f, done)
+        return TsvSyncHandle(ds, DATA_SOURCE.TSV, f, done, reader=reader, plan=plan, first_formats=first_formats,
+            conversion_errors=errors + page_errors)
 
     async def read_records(self, limit : int = -1, next_iterator = None, mapping : DataMap = None) -> TsvSyncHandle:
         return self._read_records(limit, next_iterator, mapping)
@@ -9,7 +9,9 @@ class DATA_SOURCE(IntEnum):
     JSON = 0,
     TSV = 1,
     ANKI = 2,
-    NOTION = 3
+    NOTION = 3,
+    NDJSON = 4,
+    SNAPSHOT = 5
 
 class SYNC_ERROR_CODE(IntEnum):
     PARAMETER_NOT_FOUND = 0,
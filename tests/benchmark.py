@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+# Run it one folder *above* the core folder (e.g. ./benchmark.py remap), or from a checkout as python tests/benchmark.py remap.
+# Input files are found relative to this file either way.
+
+import sys
+import types
+from os.path import abspath, dirname
+try:
+    import core
+except ImportError: # run from a checkout, so load the folder above this one as the core package
+    core = types.ModuleType("core")
+    core.__path__ = [ dirname(dirname(abspath(__file__))) ]
+    sys.modules["core"] = core
+
+from core.dataset import *
+from core.sync.sync_tsv import *
+from core.sync.sync_json import *
+from core.sync.sync_snapshot import *
+from core.sync.sync_notion import NotionReader, NotionWriter
+from core.tests.fake_notion import FakeNotionApi, FakeNotionServer
+from datetime import datetime, timedelta, timezone
+from os.path import dirname, exists, join, realpath
+import argparse
+import copy
+import json
+import platform
+import random
+import os
+import tempfile
+import time
+import tracemalloc
+
+input_dir = join(dirname(realpath(__file__)), "test_input")
+
+def input_path(file_name : str) -> str:
+    return join(input_dir, file_name)
+
+def measure(fn : Callable, *args, **kwargs):
+    ''' Runs fn once, returning (seconds taken, peak bytes allocated during the call, result). '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+def report(name : str, seconds : float, peak_bytes : int):
+    print(f"{name:<40} {seconds * 1000:>10.1f} ms {peak_bytes / 1024:>12.1f} KiB")
+
+def read_tsv_text(file_name : str) -> DataSet:
+    reader = TsvReader(TableSpec(DATA_SOURCE.TSV, {"file_path": input_path(file_name)}, file_name))
+    return reader.read_all_records_sync(-1)
+
+def read_json(file_name : str) -> DataSet:
+    reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": input_path(file_name)}, file_name))
+    return reader.read_all_records_sync(-1)
+
+def _deepcopy_remap(ds : DataSet, map : DataMap) -> DataSet:
+    ''' DataSet.remap before copy-on-write column sharing. '''
+    clone : DataSet = copy.deepcopy(ds)
+    for col in ds.columns:
+        if col.name not in map.columns:
+            clone.drop_column(col.name)
+        else:
+            if col.type != map.columns[col.name].type:
+                clone.change_column_type(col.name, map.columns[col.name].type)
+            if map.columns[col.name].name != col.name:
+                clone.rename_column(col.name, map.columns[col.name].name)
+    return clone
+
+def bench_remap(parsed : argparse.Namespace):
+    ds = read_tsv_text("tsv_big_read.tsv")
+    ds.format = DataSetFormat(time_formats=["%b %d, %Y %I:%M %p"])
+    print(f"tsv_big_read.tsv: {len(ds.records)} records")
+
+    maps = {
+        "projection (rename + drop)": DataMap({
+            "id": DataColumn(COLUMN_TYPE.TEXT, "key"),
+            "multiselect": DataColumn(COLUMN_TYPE.TEXT, "tags"),
+            "select": DataColumn(COLUMN_TYPE.TEXT, "select")
+        }, ds.format),
+        "projection + retype": DataMap({
+            "id": DataColumn(COLUMN_TYPE.TEXT, "key"),
+            "date": DataColumn(COLUMN_TYPE.DATE, "date"),
+            "multiselect": DataColumn(COLUMN_TYPE.MULTI_SELECT, "tags"),
+            "select": DataColumn(COLUMN_TYPE.SELECT, "select")
+        }, ds.format)
+    }
+
+    for map_name, map in maps.items():
+        print(map_name)
+        report("  deepcopy remap (before)", *measure(_deepcopy_remap, ds, map)[:2])
+        report("  copy-on-write remap (after)", *measure(ds.remap, map)[:2])
+
+def _binned_equivalent_to(left : DataSet, right : DataSet, key_column : str) -> bool:
+    ''' DataSet.equivalent_to before multiset hashing, pairing records within key bins. '''
+    left_index = build_key_index(left, key_column)
+    right_index = build_key_index(right, key_column)
+    for key in left_index:
+        if key not in right_index: return False
+        right_records = list(select_all(right_index[key]))
+        left_records = select_all(left_index[key])
+        if len(left_records) != len(right_records): return False
+        for record in left_records:
+            for i, other in enumerate(right_records):
+                if other == record:
+                    del right_records[i]
+                    break
+            else: return False
+    return True
+
+def bench_equivalent_to(parsed : argparse.Namespace):
+    ds = read_json("chinese_sample_large.json")
+    ds.change_column_type("Tags", COLUMN_TYPE.TEXT) # Tags has a few dozen distinct values, so makes a low cardinality key
+    copies = parsed.copies
+    big = DataSet(ds.columns, format=ds.format)
+    for _ in range(copies):
+        big.add_records(ds.records)
+    order = list(range(len(big.records)))
+    random.Random(0).shuffle(order)
+    shuffled = DataSet(big.columns, [ big.records[i] for i in order ], format=big.format)
+    print(f"chinese_sample_large.json x{copies}: {len(big.records)} records vs shuffled copy")
+
+    for key in ("Hanzi", "Tags"):
+        print(f"key column {key}")
+        seconds, peak, result = measure(_binned_equivalent_to, big, shuffled, key)
+        report(f"  key bins (before) -> {result}", seconds, peak)
+        seconds, peak, result = measure(big.equivalent_to, shuffled, key)
+        report(f"  multiset hash (after) -> {result}", seconds, peak)
+
+def _read_tsv_paged(file_name : str, page_size : int, mapping : DataMap = None) -> int:
+    ''' Pages through a file, discarding each page once it's read, and returns the number of records seen. '''
+    reader = TsvReader(TableSpec(DATA_SOURCE.TSV, {"file_path": input_path(file_name)}, file_name))
+    with reader.read_records_sync(page_size, mapping=mapping) as handle:
+        total = len(handle.records.records)
+        while not handle.done:
+            handle = reader.read_records_sync(page_size, next_iterator=handle)
+            total += len(handle.records.records)
+    return total
+
+def bench_tsv_read(parsed : argparse.Namespace):
+    mapping = DataMap({
+        "id": DataColumn(COLUMN_TYPE.TEXT, "id"),
+        "date": DataColumn(COLUMN_TYPE.TEXT, "date"),
+        "multiselect": DataColumn(COLUMN_TYPE.MULTI_SELECT, "multiselect"),
+        "select": DataColumn(COLUMN_TYPE.SELECT, "select"),
+        "bad_data": DataColumn(COLUMN_TYPE.TEXT, "bad_data")
+    }, DataSetFormat())
+    print("tsv_big_read.tsv paged reads")
+    for map_name, map in (("no mapping", None), ("with mapping", mapping)):
+        print(map_name)
+        for page_size in (10, 100, 10000):
+            seconds, peak, total = measure(_read_tsv_paged, "tsv_big_read.tsv", page_size, map)
+            report(f"  page size {page_size} ({total} records)", seconds, peak)
+
+def _open_snapshot_page(reader : SnapshotReader, page_size : int) -> int:
+    with reader.read_records_sync(page_size) as handle:
+        return len(handle.records.records)
+
+def bench_snapshot(parsed : argparse.Namespace):
+    ds = read_json("chinese_sample_large.json")
+    big = DataSet(ds.columns, format=ds.format)
+    for _ in range(parsed.copies):
+        big.add_records(ds.records)
+    print(f"chinese_sample_large.json x{parsed.copies}: {len(big.records)} records")
+
+    with tempfile.TemporaryDirectory() as dir:
+        json_spec = TableSpec(DATA_SOURCE.JSON, {"file_path": join(dir, "big.json")}, "big")
+        snapshot_spec = TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": join(dir, "big.snap")}, "big")
+        report("  write JSON", *measure(JsonWriter(json_spec).create_table_sync, big)[:2])
+        report("  write snapshot", *measure(SnapshotWriter(snapshot_spec).create_table_sync, big)[:2])
+        print(f"  JSON {os.path.getsize(join(dir, 'big.json')) / 1024:.0f} KiB, snapshot {os.path.getsize(join(dir, 'big.snap')) / 1024:.0f} KiB")
+        report("  read JSON (dates reparsed)", *measure(JsonReader(json_spec).read_all_records_sync, -1)[:2])
+        report("  read snapshot", *measure(SnapshotReader(snapshot_spec).read_all_records_sync, -1)[:2])
+        report("  open snapshot + first 100 records", *measure(_open_snapshot_page, SnapshotReader(snapshot_spec), 100)[:2])
+
+def _per_value_convert(ds : DataSet, values : list, source_type : COLUMN_TYPE, target_type : COLUMN_TYPE) -> int:
+    ''' The per-value conversion loop change_column_type used before conversion plans. '''
+    out, errors = [], 0
+    for v in values:
+        try:
+            out.append(ds.change_data_type(v, source_type, target_type))
+        except DataError:
+            errors += 1
+            out.append(None)
+    return errors
+
+def bench_convert(parsed : argparse.Namespace):
+    rows = parsed.rows[0] if parsed.rows != None else 1000000
+    start = datetime(2000, 1, 1)
+    columns = {
+        "TEXT -> DATE": ([ (start + timedelta(minutes=i)).isoformat() for i in range(rows) ], COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE),
+        "TEXT -> MULTI_SELECT": ([ f"tag {i % 7},tag {i % 11}" for i in range(rows) ], COLUMN_TYPE.TEXT, COLUMN_TYPE.MULTI_SELECT)
+    }
+    ds = DataSet([])
+    workers = os.cpu_count() or 1
+    print(f"{rows} values")
+    for name, (values, source_type, target_type) in columns.items():
+        print(name)
+        plan = ds.conversion_plan(source_type, target_type)
+        report("  per value (before)", *measure(_per_value_convert, ds, values, source_type, target_type)[:2])
+        report("  conversion plan", *measure(plan.convert, values)[:2])
+        report(f"  conversion plan, {workers} workers", *measure(plan.convert, values, workers)[:2])
+
+def _plain_storage(ds : DataSet) -> DataSet:
+    ''' Copy of ds with select and multi-select columns stored as plain lists, as before dictionary encoding. '''
+    plain = copy.copy(ds)
+    plain._data = [ [ list(v) if isinstance(v, list) else v for v in values ] if isinstance(values, EncodedColumn) else values for values in ds._data ]
+    plain._unique_counts = {}
+    plain._indexes = {}
+    return plain
+
+def bench_encoding(parsed : argparse.Namespace):
+    ds = read_json("chinese_sample_large.json")
+    big = DataSet(ds.columns, format=ds.format)
+    for _ in range(parsed.copies):
+        big.add_records(ds.records)
+    order = list(range(len(big.records)))
+    random.Random(0).shuffle(order)
+    shuffled = DataSet(big.columns, [ big.records[i] for i in order ], format=big.format)
+    print(f"chinese_sample_large.json x{parsed.copies}: {len(big.records)} records")
+
+    for col in big.columns:
+        if col.type not in (COLUMN_TYPE.SELECT, COLUMN_TYPE.MULTI_SELECT): continue
+        values = big.column_to_list(col.name)
+        print(f"{col.name} ({col.type.name}, {len(big._data[big.get_column_index(col.name)].values)} distinct values)")
+        report("  store as lists (before)", *measure(lambda: [ list(v) if isinstance(v, list) else v for v in values ])[:2])
+        report("  store encoded", *measure(EncodedColumn, values)[:2])
+
+    plain, plain_shuffled = _plain_storage(big), _plain_storage(shuffled)
+    print("get_uniques")
+    report("  lists (before)", *measure(plain.get_uniques)[:2])
+    report("  encoded", *measure(big.get_uniques)[:2])
+    print("equivalent_to shuffled copy")
+    report("  lists (before)", *measure(plain.equivalent_to, plain_shuffled)[:2])
+    report("  encoded", *measure(big.equivalent_to, shuffled)[:2])
+
+def bench_schema(parsed : argparse.Namespace):
+    rows = parsed.rows[0] if parsed.rows != None else 1000000
+    ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "id"), DataColumn(COLUMN_TYPE.SELECT, "kind") ])
+    ds._extend_columns([ [ str(i) for i in range(rows) ], [ "a" if i % 2 else "b" for i in range(rows) ] ])
+    print(f"{rows} rows")
+    report("  hold a DataRecord for every row", *measure(lambda: list(ds.records))[:2])
+    report("  rename_column", *measure(ds.rename_column, "id", "key")[:2])
+    report("  add_column (default None)", *measure(ds.add_column, DataColumn(COLUMN_TYPE.TEXT, "notes"))[:2])
+    report("  add_column (select, default 'x')", *measure(ds.add_column, DataColumn(COLUMN_TYPE.SELECT, "status"), "x")[:2])
+    report("  drop_column", *measure(ds.drop_column, "notes")[:2])
+    ds.add_column(DataColumn(COLUMN_TYPE.TEXT, "copy"))
+    ds._set_column_data(ds.get_column_index("copy"), [ f"value {i}" for i in range(rows) ])
+    ds.drop_column("copy")
+    seconds, peak, status = measure(ds.compact)
+    report(f"  compact ({status.op_returns['bytes_reclaimed'] / 1024:.0f} KiB reclaimed)", seconds, peak)
+
+def _notion_sample(rows : int) -> DataSet:
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    return DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.TEXT, "Notes"), DataColumn(COLUMN_TYPE.SELECT, "Kind"),
+        DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags"), DataColumn(COLUMN_TYPE.DATE, "Due") ],
+        [ { "Name": f"record {i}", "Notes": f"notes for record {i}", "Kind": f"kind {i % 5}", "Tags": [ f"tag {i % 7}", f"tag {i % 11}" ],
+            "Due": start + timedelta(hours=i) } for i in range(rows) ])
+
+def bench_notion(parsed : argparse.Namespace):
+    ''' Reads, writes and updates tables of each size through the fake Notion API, and appends the results to a JSON file. '''
+    run = { "benchmark": "notion", "time": datetime.now(timezone.utc).isoformat(), "python": platform.python_version(),
+        "latency": parsed.latency, "concurrency": parsed.concurrency, "results": [] }
+    for rows in parsed.rows or [1000, 10000, 100000]:
+        ds = _notion_sample(rows)
+        changed = DataSet(ds.columns, [ { **r.asdict(), "Notes": "changed" } if i % 20 == 0 else r.asdict() for i, r in enumerate(ds.records) ])
+        changed.add_records([ { "Name": f"new record {i}", "Kind": "kind 0" } for i in range(rows // 100) ])
+        print(f"{rows} records")
+
+        with FakeNotionServer(FakeNotionApi(latency=parsed.latency)) as server:
+            session = server.session(concurrency=parsed.concurrency)
+            writer = NotionWriter(session=session)
+            writer.set_table(writer.create_table(ds, TableSpec(DATA_SOURCE.NOTION, { "parent_id": None }, "benchmark")))
+            reader = NotionReader(session=session)
+            reader.set_table(writer.table)
+            operations = (
+                ("write_records_sync", rows, lambda: writer.write_records_sync(ds)),
+                ("read_all_records_sync", rows, lambda: reader.read_all_records_sync(100)),
+                ("update_table (5% changed, 1% new)", len(changed.records), lambda: writer.update_table(changed, "Name", lambda status: None))
+            )
+            for name, count, fn in operations:
+                requests_before = session.metrics.requests
+                start = time.perf_counter()
+                fn()
+                seconds = time.perf_counter() - start
+                result = { "operation": name, "rows": rows, "seconds": seconds, "records_per_second": count / seconds,
+                    "requests": session.metrics.requests - requests_before }
+                run["results"].append(result)
+                print(f"  {name:<38} {seconds * 1000:>10.1f} ms {result['records_per_second']:>10.0f} records/s {result['requests']:>8} requests")
+            session.close()
+
+    runs = []
+    if exists(parsed.output):
+        with open(parsed.output, encoding="utf-8") as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(parsed.output, "w", encoding="utf-8") as f:
+        json.dump(runs, f, indent=2)
+    print(f"Results appended to {parsed.output}")
+
+parser = argparse.ArgumentParser("Run AnCore benchmarks.")
+parser.add_argument("benchmark", choices=["remap", "equivalent_to", "tsv_read", "snapshot", "notion", "convert", "encoding", "schema"])
+parser.add_argument("--copies", type=int, default=10, help="Number of times to repeat the sample data.")
+parser.add_argument("--rows", type=lambda arg: [ int(n) for n in arg.split(",") ], help="Table sizes for the notion benchmark (default 1000,10000,100000), or column length for convert and schema (default 1000000).")
+parser.add_argument("--latency", type=float, default=0.0, help="Seconds the fake Notion API waits before answering each request.")
+parser.add_argument("--concurrency", type=int, default=3, help="Concurrent requests per Notion session.")
+parser.add_argument("--output", default="notion_benchmark.json", help="JSON file the notion benchmark appends its results to.")
+
+parsed = parser.parse_args(sys.argv[1:])
+
+method_dict = {
+    "remap": bench_remap,
+    "equivalent_to": bench_equivalent_to,
+    "tsv_read": bench_tsv_read,
+    "snapshot": bench_snapshot,
+    "notion": bench_notion,
+    "convert": bench_convert,
+    "encoding": bench_encoding,
+    "schema": bench_schema
+}
+
+method_dict[parsed.benchmark](parsed)
@@ -3,7 +3,10 @@
 from core.sync.sync_notion import *
 from core.sync.sync_tsv import *
 from core.sync.sync_json import *
+from core.sync.sync_ndjson import *
+from core.sync.sync_snapshot import *
 import argparse
+import asyncio
 import sys
 
 def show_progress(prefix : str, current : int, total : int):
@@ -18,6 +21,10 @@ def _setup_input(input_type : str, input, secret : str) -> SourceReader:
         tr = TsvReader(TableSpec(DATA_SOURCE.TSV, {"file_path": input},"tsv_source"))
     elif input_type == "json":
         tr = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": input},"json_source"))
+    elif input_type == "ndjson":
+        tr = NdjsonReader(TableSpec(DATA_SOURCE.NDJSON, {"file_path": input},"ndjson_source"))
+    elif input_type == "snapshot":
+        tr = SnapshotReader(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": input},"snapshot_source"))
     elif input_type == "notion":
         if secret == None:
             sys.exit("Need a valid Notion integration key to read Notion databases.")
@@ -31,11 +38,15 @@ def _setup_output(output_type : str, output : str, secret : str) -> SourceWriter
         tw = TsvWriter(TableSpec(DATA_SOURCE.TSV, {"file_path": output},"tsv_source"))
     elif output_type == "json":
         tw = JsonWriter(TableSpec(DATA_SOURCE.JSON, {"file_path": output},"json_source"))
+    elif output_type == "ndjson":
+        tw = NdjsonWriter(TableSpec(DATA_SOURCE.NDJSON, {"file_path": output},"ndjson_source"))
+    elif output_type == "snapshot":
+        tw = SnapshotWriter(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": output},"snapshot_source"))
     elif output_type == "notion":
         if secret == None:
             sys.exit("Need a valid Notion integration key to write Notion databases.")
         tw = NotionWriter(secret)
-        tr = NotionReader(secret)
+        tr = NotionReader(session=tw.session) # one pool of connections for both
         tw.set_table(tr.get_table(output))
     return tw
 
@@ -66,20 +77,23 @@ def read(parsed : argparse.Namespace):
         for record in ds.records:
             print(record.asdict())
     else:
-        if output[0] == "json" or output[0] == "tsv": # no real write_records methods implemented yet
+        if output[0] in ("json", "tsv", "ndjson", "snapshot"): # no real write_records methods implemented yet
             tw : SourceWriter = _setup_output(output[0], output[1], parsed.secret)
             tw.create_table_sync(ds, None)
         elif output[0] == "notion":
             tw : NotionWriter = _setup_output(output[0], output[1], parsed.secret)
-            handle = tw.write_records_sync(ds,1)
-            cur_record = 1
+            # each batch is written concurrently; batches keep progress reports regular
+            handle = asyncio.run(tw.write_records(ds,100))
+            errors = dict(handle.params["errors"])
             total_records = len(ds.records)
-            show_progress("Writing records: ", cur_record, total_records)
+            show_progress("Writing records: ", handle.params["last_written"] + 1, total_records)
             while not handle.done:
-                handle = tw.write_records_sync(ds,1,handle)
-                cur_record += 1
-                show_progress("Writing records: ",cur_record, total_records)
+                handle = asyncio.run(tw.write_records(ds,100,handle))
+                errors.update(handle.params["errors"])
+                show_progress("Writing records: ", handle.params["last_written"] + 1, total_records)
             print()
+            for i, err in errors.items():
+                print(f"Record {i} not written: {err}")
 
 str_to_type_map = {
     'date' : COLUMN_TYPE.DATE,
@@ -129,8 +143,13 @@ def update(parsed : argparse.Namespace):
 
     tw : NotionWriter = _setup_output(output[0], output[1], parsed.secret)
 
-    tw.update_table(ds, parsed.primary_key, _report_callbacks)
+    result = tw.update_table(ds, parsed.primary_key, _report_callbacks)
     print()
+    print(f"{result.op_returns['created']} created, {result.op_returns['patched']} patched, {result.op_returns['skipped']} unchanged.")
+    for key, err in result.op_returns["errors"].items():
+        print(f"Record {key} not synced: {err}")
+    metrics = tw.session.metrics
+    print(f"{metrics.requests} requests, {metrics.retries} retries, {metrics.throttled_seconds:.1f}s rate limited.")
 
 parser = argparse.ArgumentParser("Interact with Notion Core via a CLI.")
 parser.add_argument("method", choices=["update", "read"])
@@ -0,0 +1,305 @@
+from core.sync.sync_notion import NotionSession, RateLimiter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import dirname, join, realpath
+from datetime import datetime, timezone
+from typing import Callable
+import copy
+import json
+import random
+import ssl
+import threading
+import time
+import uuid
+
+cert_path = join(dirname(realpath(__file__)), "test_input", "localhost.pem") # self-signed, for localhost and 127.0.0.1 only
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+    disable_nagle_algorithm = True # headers and body go out in separate writes
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length)) if length > 0 else None
+        server : FakeNotionServer = self.server.owner
+        with server.lock:
+            server.requests.append((self.command, self.path, { k.lower(): v for k, v in self.headers.items() }, body))
+        server._local.headers = self.headers
+        status, response, headers = server.respond(self.command, self.path, body)
+        data = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PATCH = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+class _CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request = super().get_request()
+        with self.owner.lock:
+            self.owner.connections += 1
+        return request
+
+class FakeNotionServer:
+    ''' Stand-in for the Notion API, served over HTTPS on localhost from a background thread.
+    Records every request (with lower-cased header names) and counts the TCP connections opened to it. Responses come from handler, which is given
+    the method, path (e.g. "/v1/pages/abc") and decoded JSON body, and returns (status, JSON response[, headers]). '''
+
+    def __init__(self, handler : Callable = None):
+        self.handler = handler
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self._server = None
+        self._thread = None
+
+    def respond(self, method : str, path : str, body : dict) -> tuple:
+        if self.handler == None:
+            return 404, { "object": "error", "status": 404, "code": "object_not_found" }, {}
+        out = self.handler(method, path, body)
+        return out if len(out) == 3 else (out[0], out[1], {})
+
+    @property
+    def request_headers(self):
+        ''' Headers of the request being handled, for handlers which need them. '''
+        return self._local.headers
+
+    @property
+    def url(self) -> str:
+        return f"https://localhost:{self._server.server_address[1]}/v1"
+
+    def session(self, api_key : str = "secret_test", **kwargs) -> NotionSession:
+        ''' A NotionSession pointed at this server. Unless a rate_limiter is given, requests aren't rate limited. '''
+        kwargs.setdefault("rate_limiter", RateLimiter(rate=None))
+        return NotionSession(api_key, base_url=self.url, verify=cert_path, **kwargs)
+
+    def start(self) -> "FakeNotionServer":
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path)
+        self._server = _CountingServer(("127.0.0.1", 0), _Handler)
+        self._server.owner = self
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server != None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+def _error(status : int, code : str, message : str = "") -> tuple:
+    return status, { "object": "error", "status": status, "code": code, "message": message }
+
+def _now_minute() -> str:
+    # Notion reports edit times to the minute
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:00.000Z")
+
+def _plain_value(prop : dict):
+    ''' The value of a page property, as a filter or sort on it would see it. '''
+    if prop == None:
+        return None
+    value = prop.get(prop["type"])
+    if prop["type"] in ("title", "rich_text"):
+        return "".join(part.get("plain_text") or "" for part in value or [])
+    if prop["type"] == "select":
+        return None if value == None else value["name"]
+    if prop["type"] == "multi_select":
+        return [ option["name"] for option in value or [] ]
+    if prop["type"] == "date":
+        return None if value == None else value["start"]
+    return value
+
+class FakeNotionApi:
+    ''' An in-memory Notion workspace, to be used as a FakeNotionServer handler. Supports creating, retrieving and updating databases,
+    querying them (with filters, sorts and cursors), creating and updating pages, and search.
+    Every request waits latency seconds first. A fraction error_rate of requests fail with a 500 and throttle_rate with a 429
+    (with a Retry-After of retry_after seconds); which ones is decided by a random generator seeded with seed, so runs repeat.
+    clock gives the edit times stamped on databases and pages. '''
+
+    def __init__(self, latency : float = 0.0, error_rate : float = 0.0, throttle_rate : float = 0.0, retry_after : float = 1, seed : int = 0,
+        clock : Callable[[], str] = _now_minute):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.clock = clock
+        self.databases = {} # database objects by id
+        self.pages = {} # page objects by id
+        self.rows = {} # page ids by database id, in creation order
+        self._archived = 0 # number of archived pages; while there are none, plain queries can page through rows directly
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, method : str, path : str, body : dict) -> tuple:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        with self._lock:
+            roll = self._random.random()
+            if roll < self.throttle_rate:
+                return 429, { "object": "error", "status": 429, "code": "rate_limited" }, { "Retry-After": str(self.retry_after) }
+            if roll < self.throttle_rate + self.error_rate:
+                return _error(500, "internal_server_error")
+            parts = path.split("?")[0].strip("/").split("/")[1:] # without the version
+            route = (method, parts[0] if len(parts) > 0 else "", len(parts), parts[-1] if len(parts) > 2 else "")
+            if route == ("POST", "databases", 1, ""):
+                return self._create_database(body)
+            if route[:3] == ("GET", "databases", 2):
+                return self._database(parts[1], lambda database: (200, copy.deepcopy(database)))
+            if route[:3] == ("PATCH", "databases", 2):
+                return self._database(parts[1], lambda database: self._update_database(database, body))
+            if route == ("POST", "databases", 3, "query"):
+                return self._database(parts[1], lambda database: self._query(database, body or {}))
+            if route == ("POST", "pages", 1, ""):
+                return self._create_page(body)
+            if route[:3] == ("PATCH", "pages", 2):
+                return self._update_page(parts[1], body)
+            if route[:3] == ("GET", "pages", 2) and parts[1] in self.pages:
+                return 200, copy.deepcopy(self.pages[parts[1]])
+            if route == ("POST", "search", 1, ""):
+                return self._search(body or {})
+            return _error(404, "object_not_found", path)
+
+    def _database(self, id : str, then : Callable) -> tuple:
+        database = self.databases.get(id.replace("-", ""))
+        if database == None:
+            return _error(404, "object_not_found", id)
+        return then(database)
+
+    def _set_properties(self, database : dict, properties : dict):
+        for name, config in properties.items():
+            if config == None:
+                database["properties"].pop(name, None)
+                continue
+            type = next(iter(config))
+            existing = database["properties"].get(name)
+            id = existing["id"] if existing != None else ("title" if type == "title" else uuid.uuid4().hex[:4])
+            database["properties"][name] = { "id": id, "name": name, "type": type, type: config[type] }
+
+    def _create_database(self, body : dict) -> tuple:
+        now = self.clock()
+        id = uuid.uuid4().hex
+        database = { "object": "database", "id": id, "created_time": now, "last_edited_time": now, "title": body.get("title", []),
+            "parent": body.get("parent"), "properties": {} }
+        self._set_properties(database, body.get("properties", {}))
+        self.databases[id] = database
+        self.rows[id] = []
+        return 200, copy.deepcopy(database)
+
+    def _update_database(self, database : dict, body : dict) -> tuple:
+        self._set_properties(database, (body or {}).get("properties", {}))
+        if "title" in (body or {}):
+            database["title"] = body["title"]
+        database["last_edited_time"] = self.clock()
+        return 200, copy.deepcopy(database)
+
+    def _set_page_properties(self, database : dict, page : dict, properties : dict) -> tuple:
+        for name, value in properties.items():
+            column = database["properties"].get(name)
+            if column == None:
+                return _error(400, "validation_error", f"{name} is not a property that exists.")
+            page["properties"][name] = { "id": column["id"], "type": column["type"], column["type"]: None if value == None else value.get(column["type"]) }
+        return None
+
+    def _create_page(self, body : dict) -> tuple:
+        database_id = (body.get("parent") or {}).get("database_id", "").replace("-", "")
+        database = self.databases.get(database_id)
+        if database == None:
+            return _error(404, "object_not_found", database_id)
+        now = self.clock()
+        page = { "object": "page", "id": uuid.uuid4().hex, "created_time": now, "last_edited_time": now, "archived": False,
+            "parent": { "type": "database_id", "database_id": database_id }, "properties": {} }
+        for name, column in database["properties"].items():
+            empty = [] if column["type"] in ("title", "rich_text", "multi_select") else None
+            page["properties"][name] = { "id": column["id"], "type": column["type"], column["type"]: empty }
+        error = self._set_page_properties(database, page, body.get("properties", {}))
+        if error != None:
+            return error
+        self.pages[page["id"]] = page
+        self.rows[database_id].append(page["id"])
+        return 200, copy.deepcopy(page)
+
+    def _update_page(self, id : str, body : dict) -> tuple:
+        page = self.pages.get(id.replace("-", ""))
+        if page == None:
+            return _error(404, "object_not_found", id)
+        error = self._set_page_properties(self.databases[page["parent"]["database_id"]], page, (body or {}).get("properties", {}))
+        if error != None:
+            return error
+        if "archived" in (body or {}) and body["archived"] != page["archived"]:
+            page["archived"] = body["archived"]
+            self._archived += 1 if page["archived"] else -1
+        page["last_edited_time"] = self.clock()
+        return 200, copy.deepcopy(page)
+
+    def _matches(self, page : dict, record_filter : dict) -> bool:
+        if "or" in record_filter:
+            return any(self._matches(page, f) for f in record_filter["or"])
+        if "and" in record_filter:
+            return all(self._matches(page, f) for f in record_filter["and"])
+        if "timestamp" in record_filter:
+            value = page[record_filter["timestamp"]]
+            condition = record_filter[record_filter["timestamp"]]
+        else:
+            value = _plain_value(page["properties"].get(record_filter["property"]))
+            condition = next( v for k, v in record_filter.items() if k != "property" )
+        for op, operand in condition.items():
+            if op == "equals" and value != operand: return False
+            if op == "does_not_equal" and value == operand: return False
+            if op == "contains" and (value == None or operand not in value): return False
+            if op == "is_empty" and value not in (None, "", []): return False
+            if op == "is_not_empty" and value in (None, "", []): return False
+            if op in ("on_or_after", "after", "on_or_before", "before") and value == None: return False
+            if op == "on_or_after" and value < operand: return False
+            if op == "after" and value <= operand: return False
+            if op == "on_or_before" and value > operand: return False
+            if op == "before" and value >= operand: return False
+        return True
+
+    def _paginate(self, items : list, body : dict, convert : Callable) -> tuple:
+        start = int(body.get("start_cursor") or 0)
+        end = min(start + min(body.get("page_size", 100), 100), len(items))
+        has_more = end < len(items)
+        return 200, { "object": "list", "results": [ convert(item) for item in items[start:end] ], "has_more": has_more,
+            "next_cursor": str(end) if has_more else None }
+
+    def _query(self, database : dict, body : dict) -> tuple:
+        if body.get("filter") == None and not body.get("sorts") and self._archived == 0:
+            return self._paginate(self.rows[database["id"]], body, lambda id: copy.deepcopy(self.pages[id]))
+        pages = [ self.pages[id] for id in self.rows[database["id"]] if not self.pages[id]["archived"] ]
+        if body.get("filter") != None:
+            pages = [ page for page in pages if self._matches(page, body["filter"]) ]
+        for sort in reversed(body.get("sorts") or []):
+            if "timestamp" in sort:
+                key = lambda page: page[sort["timestamp"]]
+            else:
+                key = lambda page: (_plain_value(page["properties"].get(sort["property"])) or "")
+            pages = sorted(pages, key=key, reverse=sort.get("direction") == "descending")
+        return self._paginate(pages, body, copy.deepcopy)
+
+    def _search(self, body : dict) -> tuple:
+        object_type = (body.get("filter") or {}).get("value")
+        items = []
+        if object_type in (None, "database"):
+            items.extend(self.databases.values())
+        if object_type in (None, "page"):
+            items.extend(page for page in self.pages.values() if not page["archived"])
+        return self._paginate(items, body, copy.deepcopy)
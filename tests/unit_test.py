@@ -2,16 +2,23 @@ from json.encoder import JSONEncoder
 from os import unlink, write
 
 from core.dataset import *
-from core.sync.sync_notion import NotionReader, NotionWriter
+from core.sync.sync_notion import NotionReader, NotionWriter, NotionSession, RateLimiter, RetryPolicy, SchemaCache, TableCatalogue, PageIndex, NotionMirror, notion_version
 from core.sync.sync_types import *
 from core.sync.sync_tsv import *
 from core.sync.sync_json import *
+from core.sync.sync_ndjson import *
+from core.sync.sync_snapshot import *
+from core.tests.fake_notion import FakeNotionApi, FakeNotionServer, cert_path
+import requests
+import threading
 import unittest
 from os.path import dirname, exists, join, realpath
 import json
-from datetime import date, datetime
+from datetime import date, datetime, timedelta, timezone
 import asyncio
 import copy
+import gc
+import warnings
 import time
 import locale
 import math
@@ -264,6 +271,525 @@ class NotionTest(unittest.TestCase):
         nw.update_columns(ds_tsv, col_list)
 
 
+class TestNotionSession(unittest.TestCase):
+    ''' Notion calls against a local stand-in server. '''
+
+    in_flight = 0
+    max_in_flight = 0
+    delay = 0
+
+    def handle_request(self, method, path, body):
+        if path == "/v1/databases/db1" and method in ("GET", "PATCH"):
+            return 200, { "id": "db1", "properties": { "Name": { "id": "title", "type": "title" }, "Tags": { "id": "t", "type": "multi_select" } } }
+        if method == "POST" and path == "/v1/pages":
+            with self.lock:
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(self.delay)
+            with self.lock:
+                self.in_flight -= 1
+            name = body["properties"]["Name"]["title"][0]["plain_text"]
+            if name == "bad":
+                return 400, { "object": "error", "code": "validation_error" }
+            return 200, { "id": "new_" + name }
+        if method == "POST" and path == "/v1/databases/db1/query":
+            results = [ { "id": f"page{i}", "properties": {
+                "Name": { "type": "title", "title": [ { "plain_text": f"name{i}" } ] },
+                "Tags": { "type": "multi_select", "multi_select": [ { "name": "a" } ] } } } for i in range(3) ]
+            return 200, { "results": results, "has_more": False, "next_cursor": None }
+        if method == "PATCH" and path.startswith("/v1/pages/"):
+            return 200, { "id": path.split("/")[-1] }
+        return 404, { "object": "error" }
+
+    def test_pooled_session(self):
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        with FakeNotionServer(self.handle_request) as server:
+            session = server.session(pool_size=2, headers={ "User-Agent": "ancore-test" })
+            reader = NotionReader(session=session)
+            reader.set_table(table)
+            writer = NotionWriter(session=session)
+            writer.set_table(table)
+            for _ in range(3):
+                ds = reader.read_records_sync(10, include_ids=True).records
+            for record in ds.records:
+                writer.update_record_by_id(record, ds, record["notion_page_id"]) # looks up columns through a reader on the same session
+            self.assertEqual(len(ds.records), 3)
+            self.assertEqual(len(server.requests), 7) # the schema is fetched once and cached
+            self.assertEqual(server.connections, 1)
+            for _, _, headers, _ in server.requests:
+                self.assertEqual(headers["authorization"], "Bearer secret_test")
+                self.assertEqual(headers["notion-version"], notion_version)
+                self.assertEqual(headers["user-agent"], "ancore-test")
+
+            # unpooled requests open a connection each
+            for _ in range(3):
+                requests.get(server.url + "/databases/db1", verify=cert_path)
+            self.assertEqual(server.connections, 4)
+            session.close()
+
+    def test_concurrent_writes(self):
+        self.lock = threading.Lock()
+        self.delay = 0.05
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        names = [ f"name{i}" for i in range(20) ]
+        names[5] = "bad"
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name") ], [ { "Name": name } for name in names ])
+        with FakeNotionServer(self.handle_request) as server:
+            writer = NotionWriter(session=server.session(concurrency=4))
+            writer.set_table(table)
+            start = time.perf_counter()
+            handle = asyncio.run(writer.write_records(ds, 12))
+            elapsed = time.perf_counter() - start
+            self.assertEqual(self.max_in_flight, 4)
+            self.assertLess(elapsed, 12 * self.delay)
+            self.assertEqual([ None if r == None else r["id"] for r in handle.records ], [ None if n == "bad" else "new_" + n for n in names[:12] ])
+            self.assertEqual(list(handle.params["errors"].keys()), [5])
+            self.assertFalse(handle.done)
+            handle = asyncio.run(writer.write_records(ds, 12, handle))
+            self.assertTrue(handle.done)
+            self.assertEqual([ r["id"] for r in handle.records ], [ "new_" + n for n in names[12:] ])
+            writer.session.close()
+
+    def test_update_table(self):
+        self.lock = threading.Lock()
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        left = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags") ],
+            [ { "Name": "name0", "Tags": ["b"] }, { "Name": "name1", "Tags": ["a", ""] }, { "Name": "name2", "Tags": ["c"] }, { "Name": "new", "Tags": [] }, { "Name": "bad", "Tags": [] } ])
+        statuses = []
+        with FakeNotionServer(self.handle_request) as server:
+            writer = NotionWriter(session=server.session())
+            writer.set_table(table)
+            result = writer.update_table(left, "Name", statuses.append)
+            patches = sorted((path, body) for method, path, _, body in server.requests if method == "PATCH" and path.startswith("/v1/pages/"))
+            schema_patches = [ path for method, path, _, _ in server.requests if method == "PATCH" and path.startswith("/v1/databases/") ]
+            writer.session.close()
+        self.assertEqual(schema_patches, []) # no new columns, so the schema isn't patched
+        self.assertEqual([ path for path, _ in patches ], ["/v1/pages/page0", "/v1/pages/page2"]) # name1 hasn't changed
+        for _, body in patches:
+            self.assertEqual(list(body["properties"].keys()), ["Tags"])
+        self.assertEqual(result.status, OP_STATUS_CODE.OP_FAILURE)
+        self.assertEqual(result.op_returns["created"], 1)
+        self.assertEqual(result.op_returns["patched"], 2)
+        self.assertEqual(result.op_returns["skipped"], 1)
+        self.assertEqual(list(result.op_returns["errors"].keys()), [4]) # by row, as keys needn't be unique
+        self.assertEqual(statuses[-1], SyncStatus(2, 2, SYNC_STATUS_CODE.UPDATING_SOURCE))
+
+    def test_update_table_pipelined(self):
+        def handle_request(method, path, body):
+            if path == "/v1/databases/db1" and method in ("GET", "PATCH"):
+                return 200, { "id": "db1", "properties": { "Name": { "id": "title", "type": "title" }, "Tags": { "id": "t", "type": "multi_select" } } }
+            if method == "POST" and path == "/v1/databases/db1/query":
+                time.sleep(0.05)
+                start = int(body.get("start_cursor") or 0)
+                end = min(start + body["page_size"], 300)
+                results = [ { "id": f"page{i}", "properties": {
+                    "Name": { "type": "title", "title": [ { "plain_text": f"name{i}" } ] },
+                    "Tags": { "type": "multi_select", "multi_select": [] } } } for i in range(start, end) ]
+                return 200, { "results": results, "has_more": end < 300, "next_cursor": str(end) if end < 300 else None }
+            if method == "POST" and path == "/v1/pages":
+                return 200, { "id": "new" }
+            if method == "PATCH" and path.startswith("/v1/pages/"):
+                return 200, { "id": path.split("/")[-1] }
+            return 404, { "object": "error" }
+
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        left = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags") ],
+            [ { "Name": "name0", "Tags": ["a"] }, { "Name": "name250", "Tags": ["b"] }, { "Name": "name1", "Tags": [] }, { "Name": "new", "Tags": [] } ])
+        statuses = []
+        with FakeNotionServer(handle_request) as server:
+            session = server.session()
+            writer = NotionWriter(session=session)
+            writer.set_table(table)
+            result = writer.update_table(left, "Name", statuses.append)
+            order = [ (method, path) for method, path, _, _ in server.requests ]
+            reader = NotionReader(session=session)
+            reader.set_table(table)
+            server.requests.clear()
+            self.assertEqual(reader.resolve_page_ids("Name", [ "name299", "new" ]), { "name299": [ "page299" ], "new": [ "new" ] }) # indexed while reading
+            self.assertEqual(len(server.requests), 0)
+            session.close()
+        queries = [ i for i, request in enumerate(order) if request[1].endswith("/query") ]
+        self.assertLess(order.index(("PATCH", "/v1/pages/page0")), queries[-1]) # patched while later pages are read
+        self.assertGreater(order.index(("POST", "/v1/pages")), queries[-1]) # creates wait for the whole table
+        self.assertEqual((result.op_returns["created"], result.op_returns["patched"], result.op_returns["skipped"]), (1, 2, 1))
+        self.assertIn(SyncStatus(-1, 300, SYNC_STATUS_CODE.READING_SOURCE), statuses)
+        self.assertEqual(statuses[-2:], [ SyncStatus(1, 1, SYNC_STATUS_CODE.WRITING_SOURCE), SyncStatus(2, 2, SYNC_STATUS_CODE.UPDATING_SOURCE) ])
+
+    def test_rate_limiter(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        limiter = RateLimiter(rate=10, burst=2, clock=lambda: now[0], sleep=sleep)
+        waits = [ limiter.acquire() for _ in range(5) ]
+        self.assertEqual(waits[:2], [0, 0])
+        for wait in waits[2:]:
+            self.assertAlmostEqual(wait, 0.1)
+        limiter.pause(1.0)
+        self.assertAlmostEqual(limiter.acquire(), 1.0)
+        self.assertEqual(RateLimiter(rate=None, clock=lambda: now[0], sleep=sleep).acquire(), 0)
+
+    def test_retry_delay(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4, seed=0)
+        for attempt in range(6):
+            self.assertTrue(0 <= policy.delay(attempt) <= min(4, 2 ** attempt))
+        response = requests.Response()
+        response.status_code = 429
+        response.headers["Retry-After"] = "2"
+        self.assertEqual(policy.delay(0, response), 2.0)
+        self.assertTrue(policy.should_retry("POST", "/pages", response, 0))
+        self.assertFalse(policy.should_retry("POST", "/pages", response, 5))
+        response.status_code = 503
+        self.assertFalse(policy.should_retry("POST", "/pages", response, 0))
+        self.assertTrue(policy.should_retry("POST", "/databases/db1/query", response, 0))
+
+    def test_retries(self):
+        schedule = { 1: (429, "0.05"), 4: (429, "0.05"), 5: (429, None), 7: (503, None) } # by request number
+        count = [0]
+        def handle_request(method, path, body):
+            count[0] += 1
+            if count[0] in schedule:
+                status, retry_after = schedule[count[0]]
+                return status, { "object": "error", "status": status }, { "Retry-After": retry_after } if retry_after else {}
+            return 200, { "object": "list", "results": [] }
+
+        with FakeNotionServer(handle_request) as server:
+            session = server.session(retry=RetryPolicy(base_delay=0.01, seed=0))
+            statuses = [ session.get("/users").status_code for _ in range(4) ]
+            self.assertEqual(statuses, [200] * 4)
+            self.assertEqual(count[0], 8) # every 429 and the 503 was retried
+            self.assertEqual(session.metrics.requests, 8)
+            self.assertEqual(session.metrics.retries, 4)
+            self.assertEqual(session.metrics.throttled_responses, 3)
+            self.assertGreaterEqual(session.metrics.throttled_seconds, 0.1)
+
+            schedule[9] = (503, None)
+            self.assertEqual(session.post("/pages", {}).status_code, 503) # creating a page isn't retried after a server error
+            session.close()
+
+    def test_schema_cache(self):
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        database = { "id": "db1", "last_edited_time": "2022-01-01T00:00:00.000Z", "properties": { "Name": { "id": "title", "type": "title" } } }
+        def handle_request(method, path, body):
+            if path == "/v1/databases/db1" and method == "GET":
+                if server.request_headers.get("If-None-Match") == "v2":
+                    return 304, {}
+                return 200, database, { "ETag": "v2" } if "Tags" in database["properties"] else {}
+            if path == "/v1/databases/db1" and method == "PATCH":
+                database["properties"]["Tags"] = { "id": "t", "type": "multi_select" }
+                database["last_edited_time"] = "2022-01-02T00:00:00.000Z"
+                return 200, database
+            if path == "/v1/databases/db1/query":
+                page = int(body.get("start_cursor") or 0)
+                results = [ { "id": f"page{page}", "properties": { "Name": { "type": "title", "title": [ { "plain_text": f"name{page}" } ] } } } ]
+                return 200, { "results": results, "has_more": page < 9, "next_cursor": str(page + 1) }
+            return 200, {}
+        schema_fetches = lambda: len([ r for r in server.requests if r[0] == "GET" ])
+
+        now = [0.0]
+        with FakeNotionServer(handle_request) as server:
+            session = server.session(schema_cache=SchemaCache(ttl=60, clock=lambda: now[0]))
+            reader = NotionReader(session=session)
+            reader.set_table(table)
+            writer = NotionWriter(session=session)
+            writer.set_table(table)
+
+            ds = reader.read_all_records_sync(1)
+            self.assertEqual(len(ds.records), 10)
+            self.assertEqual(schema_fetches(), 1)
+            for record in ds.records:
+                writer.update_record_by_id(record, ds, record["Name"])
+            self.assertEqual(schema_fetches(), 1)
+
+            columns = reader.get_columns() # cached columns are copies
+            columns[0].name = "changed"
+            self.assertEqual(reader.get_columns()[0].name, "Name")
+
+            now[0] = 61 # expired, but last_edited_time is unchanged
+            self.assertEqual([ c.name for c in reader.get_columns() ], ["Name"])
+            self.assertEqual(schema_fetches(), 2)
+
+            tagged = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags") ])
+            writer.update_columns(tagged, ["Tags"], "Name")
+            self.assertEqual([ c.name for c in reader.get_columns() ], ["Name", "Tags"])
+            self.assertEqual(schema_fetches(), 3)
+
+            now[0] = 200 # expired; the ETag matches so the server answers 304
+            self.assertEqual([ c.name for c in reader.get_columns() ], ["Name", "Tags"])
+            self.assertEqual(schema_fetches(), 4)
+            self.assertEqual(server.requests[-1][2].get("if-none-match"), "v2")
+            session.close()
+
+    def test_get_table(self):
+        def database(i):
+            return { "object": "database", "id": f"0000-{i:04}", "title": [ { "text": { "content": f"table{i}" } } ] if i else [],
+                "properties": { "Name": { "id": "title", "type": "title" }, "Tags": { "id": "t", "type": "multi_select" } } }
+        def handle_request(method, path, body):
+            if method == "POST" and path == "/v1/search":
+                start = int(body.get("start_cursor") or 0)
+                end = min(start + 2, 5)
+                return 200, { "results": [ database(i) for i in range(start, end) ], "has_more": end < 5, "next_cursor": str(end) if end < 5 else None }
+            if method == "GET" and path.startswith("/v1/databases/0000"):
+                i = int(path[-4:])
+                return (200, database(i)) if i < 5 else (404, { "object": "error", "code": "object_not_found" })
+            return 404, { "object": "error" }
+
+        now = [0.0]
+        with FakeNotionServer(handle_request) as server:
+            session = server.session(table_catalogue=TableCatalogue(ttl=60, clock=lambda: now[0]))
+            reader = NotionReader(session=session)
+
+            table = reader.get_table("00000003")
+            self.assertEqual(table.name, "table3")
+            self.assertEqual(table.parameters["primary_key"], "Name")
+            self.assertEqual([ r[:2] for r in server.requests ], [ ("GET", "/v1/databases/00000003") ])
+            reader.set_table(table)
+            self.assertEqual([ c.name for c in reader.get_columns() ], ["Name", "Tags"]) # filled in by get_table
+            self.assertEqual(reader.get_table("0000-0003").name, "table3")
+            self.assertEqual(len(server.requests), 1)
+            self.assertEqual(reader.get_table("0000-0009"), None)
+
+            server.requests.clear()
+            tables = reader.get_tables()
+            self.assertEqual([ t.name for t in tables ], [ "", "table1", "table2", "table3", "table4" ])
+            self.assertEqual(len(server.requests), 3) # one per page of search results
+            reader.get_tables()
+            self.assertEqual(reader.get_table("0000-0004").name, "table4")
+            self.assertEqual(len(server.requests), 3)
+
+            tables[4].parameters["columns"] = {} # callers get copies
+            self.assertEqual(reader.get_table("0000-0004").parameters["columns"], { "Name": "title", "Tags": "t" })
+
+            now[0] = 61
+            reader.get_table("0000-0004")
+            self.assertEqual(server.requests[-1][:2], ("GET", "/v1/databases/0000-0004"))
+            session.close()
+
+    def test_resolve_page_ids(self):
+        names = [ f"name{i}" for i in range(250) ] + [ "name7" ]
+        def matches(record_filter, name):
+            if record_filter == None:
+                return True
+            if "or" in record_filter:
+                return any(matches(f, name) for f in record_filter["or"])
+            return record_filter["text"]["equals"] == name
+        def handle_request(method, path, body):
+            if path == "/v1/databases/db1" and method == "GET":
+                return 200, { "id": "db1", "properties": { "Name": { "id": "title", "type": "title" }, "Tags": { "id": "t", "type": "multi_select" } } }
+            if method == "POST" and path == "/v1/databases/db1/query":
+                matching = [ (i, name) for i, name in enumerate(names) if matches(body.get("filter"), name) ]
+                start = int(body.get("start_cursor") or 0)
+                end = min(start + body["page_size"], len(matching))
+                results = [ { "id": f"page{i}", "properties": { "Name": { "type": "title", "title": [ { "plain_text": name } ] } } } for i, name in matching[start:end] ]
+                return 200, { "results": results, "has_more": end < len(matching), "next_cursor": str(end) if end < len(matching) else None }
+            if method == "PATCH" and path.startswith("/v1/pages/"):
+                return 200, { "id": path.split("/")[-1] }
+            return 404, { "object": "error" }
+
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title", "Tags": "t" } }, "db1")
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags") ],
+            [ { "Name": f"name{i}", "Tags": ["a"] } for i in range(150) ] + [ { "Name": " missing ", "Tags": [] } ])
+        with FakeNotionServer(handle_request) as server:
+            session = server.session()
+            writer = NotionWriter(session=session)
+            writer.set_table(table)
+            result = writer.update_records("Name", ds)
+            queries = [ body for method, path, _, body in server.requests if path.endswith("/query") ]
+            self.assertEqual(len(queries), 3) # 100 keys per query; the first has 101 results (name7 twice), so two pages
+            self.assertEqual(len(queries[0]["filter"]["or"]), 100)
+            self.assertEqual(result.op_returns["updated"], 151) # name7 has two pages
+            self.assertEqual(result.op_returns["not_found"], [ " missing " ])
+            self.assertEqual(result.status, OP_STATUS_CODE.OP_FAILURE)
+
+            server.requests.clear()
+            writer.update_record(ds.records[7], ds, "Name", "name7") # cached
+            self.assertEqual(sorted(path for _, path, _, _ in server.requests), [ "/v1/pages/page250", "/v1/pages/page7" ])
+
+            reader = NotionReader(session=session)
+            reader.set_table(table)
+            server.requests.clear()
+            ids = reader.resolve_page_ids("Name")
+            self.assertEqual(len(ids), 250)
+            self.assertEqual(len(server.requests), 3) # the whole table, 100 pages at a time
+            self.assertEqual(reader.resolve_page_ids("Name", [ "name249", "nope" ]), { "name249": [ "page249" ], "nope": [] })
+            self.assertEqual(len(server.requests), 3)
+            session.close()
+
+        index = PageIndex(ttl=10, clock=lambda: 0)
+        index.store("db-1", "Name", { "a": [ "p1" ] })
+        self.assertEqual(index.get("db1", "Name", [ "a", "b" ]), ({ "a": [ "p1" ] }, [ "b" ]))
+        index.invalidate("db1")
+        self.assertEqual(index.get("db1", "Name", [ "a" ]), ({}, [ "a" ]))
+
+    def test_mirror(self):
+        pages = { f"page{i}": { "name": f"name{i}", "edited": f"2026-01-01T00:0{i}:00.000Z" } for i in range(5) }
+        def handle_request(method, path, body):
+            if path == "/v1/databases/db1" and method == "GET":
+                return 200, { "id": "db1", "properties": { "Name": { "id": "title", "type": "title" } } }
+            if method == "POST" and path == "/v1/databases/db1/query":
+                since = body.get("filter", {}).get("last_edited_time", {}).get("on_or_after", "")
+                matching = sorted(( p for p in pages.items() if p[1]["edited"] >= since ), key=lambda p: p[1]["edited"])
+                start = int(body.get("start_cursor") or 0)
+                end = min(start + body["page_size"], len(matching))
+                results = [ { "id": id, "last_edited_time": page["edited"], "properties": {
+                    "Name": { "type": "title", "title": [ { "plain_text": page["name"] } ] } } } for id, page in matching[start:end] ]
+                return 200, { "results": results, "has_more": end < len(matching), "next_cursor": str(end) if end < len(matching) else None }
+            return 404, { "object": "error" }
+
+        table = TableSpec(DATA_SOURCE.NOTION, { "id": "db1", "primary_key": "Name", "columns": { "Name": "title" } }, "db1")
+        path = "./test_output/notion_mirror.snap"
+        if exists(path):
+            unlink(path)
+        with FakeNotionServer(handle_request) as server:
+            session = server.session()
+            reader = NotionReader(session=session)
+            reader.set_table(table)
+            mirror = NotionMirror(reader, path, page_size=2)
+            self.assertEqual(mirror.records, None)
+
+            result = mirror.pull()
+            self.assertEqual(result.op_returns, { "fetched": 5, "added": 5, "updated": 0, "full": True, "watermark": "2026-01-01T00:04:00.000Z" })
+            self.assertEqual(len(server.requests), 4) # schema, then three pages
+            self.assertNotIn("filter", server.requests[1][3])
+            self.assertEqual(server.requests[1][3]["sorts"], [ { "timestamp": "last_edited_time", "direction": "ascending" } ])
+
+            pages["page1"] = { "name": "renamed", "edited": "2026-01-01T00:05:00.000Z" }
+            pages["page5"] = { "name": "name5", "edited": "2026-01-01T00:05:00.000Z" }
+            server.requests.clear()
+            result = NotionMirror(reader, path, page_size=2).pull() # picks up the saved mirror and its watermark
+            self.assertEqual(result.op_returns, { "fetched": 3, "added": 1, "updated": 1, "full": False, "watermark": "2026-01-01T00:05:00.000Z" })
+            self.assertEqual(server.requests[0][3]["filter"], { "timestamp": "last_edited_time", "last_edited_time": { "on_or_after": "2026-01-01T00:04:00.000Z" } })
+
+            records = NotionMirror(reader, path).records
+            self.assertEqual(len(records.records), 6)
+            self.assertEqual(records.get_index("notion_page_id").records("page1")[0]["Name"], "renamed")
+
+            result = mirror.pull(full=True)
+            self.assertEqual(result.op_returns["fetched"], 6)
+            self.assertEqual(len(mirror.records.records), 6)
+            session.close()
+
+    def test_fake_api(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.SELECT, "Kind"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "Tags"),
+            DataColumn(COLUMN_TYPE.DATE, "Due") ],
+            [ { "Name": f"name{i}", "Kind": ["x", "y"][i % 2], "Tags": ["a", "b"][:i % 3], "Due": datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(days=i) } for i in range(150) ])
+        api = FakeNotionApi()
+        with FakeNotionServer(api) as server:
+            session = server.session()
+            writer = NotionWriter(session=session)
+            table = writer.create_table(ds, TableSpec(DATA_SOURCE.NOTION, { "parent_id": None }, "fake"))
+            writer.set_table(table)
+            self.assertEqual(table.parameters["primary_key"], "Name")
+            handle = writer.write_records_sync(ds)
+            self.assertEqual(len(handle.params["errors"]), 0)
+
+            reader = NotionReader(session=session)
+            reader.set_table(reader.get_table(table.parameters["id"]))
+            self.assertEqual([ (c.name, c.type) for c in reader.get_columns() ], [ (c.name, c.type) for c in ds.columns ])
+            read = reader.read_all_records_sync(100)
+            self.assertTrue(read.equivalent_to(ds, "Name"))
+            self.assertEqual(reader.find_record_ids("Name", "name3"), reader.resolve_page_ids("Name", [ "name3" ])["name3"])
+            self.assertEqual([ t.name for t in reader.get_tables() ], [ "fake" ])
+
+            changed = DataSet(ds.columns, [ { **r.asdict(), "Kind": "z" } if r["Name"] == "name5" else r.asdict() for r in ds.records ])
+            changed.add_record({ "Name": "new", "Kind": "x", "Tags": [], "Due": None })
+            result = writer.update_table(changed, "Name", lambda status: None)
+            self.assertEqual((result.op_returns["created"], result.op_returns["patched"], result.op_returns["skipped"]), (1, 1, 149))
+            self.assertTrue(reader.read_all_records_sync(100).equivalent_to(changed, "Name"))
+            session.close()
+
+    def test_update_table_padded_keys(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.SELECT, "Kind") ], [ { "Name": f"name{i}", "Kind": "x" } for i in range(5) ])
+        with FakeNotionServer(FakeNotionApi()) as server:
+            session = server.session()
+            writer = NotionWriter(session=session)
+            writer.set_table(writer.create_table(ds, TableSpec(DATA_SOURCE.NOTION, { "parent_id": None }, "fake")))
+            writer.write_records_sync(ds)
+
+            padded = DataSet(ds.columns, [ { "Name": f" name{i}  ", "Kind": "y" if i == 1 else "x" } for i in range(5) ])
+            result = writer.update_table(padded, "Name", lambda status: None)
+            self.assertEqual((result.op_returns["created"], result.op_returns["patched"], result.op_returns["skipped"]), (0, 1, 4))
+            self.assertEqual(result.op_returns["errors"], {})
+            self.assertIsNone(padded.get_index("Name")) # no index is left behind on the caller's dataset
+
+            padded.create_index("Name") # but one the caller made is used
+            result = writer.update_table(padded, "Name", lambda status: None)
+            self.assertEqual((result.op_returns["created"], result.op_returns["patched"], result.op_returns["skipped"]), (0, 0, 5))
+            reader = NotionReader(session=session)
+            reader.set_table(reader.get_table(writer.table.parameters["id"]))
+            self.assertEqual(len(reader.read_all_records_sync(100).records), 5)
+
+            duplicated = DataSet(ds.columns, ds.records)
+            duplicated.add_records([ { "Name": "name2", "Kind": k } for k in ["y", "z"] ])
+            result = writer.update_table(duplicated, "Name", lambda status: None)
+            self.assertEqual((result.op_returns["patched"], result.op_returns["errors"]), (3, {})) # name1 and both name2 rows
+            self.assertEqual(reader.find_records("Name", "name2").records.records[0]["Kind"], "z") # patched in row order
+            session.close()
+
+    def test_update_table_with_mirror(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name"), DataColumn(COLUMN_TYPE.SELECT, "Kind") ], [ { "Name": f"name{i}", "Kind": "x" } for i in range(20) ])
+        path = "./test_output/notion_update_mirror.snap"
+        if exists(path):
+            unlink(path)
+        with FakeNotionServer(FakeNotionApi()) as server:
+            session = server.session()
+            writer = NotionWriter(session=session)
+            writer.set_table(writer.create_table(ds, TableSpec(DATA_SOURCE.NOTION, { "parent_id": None }, "fake")))
+            writer.write_records_sync(ds)
+            reader = NotionReader(session=session)
+            reader.set_table(reader.get_table(writer.table.parameters["id"]))
+            mirror = NotionMirror(reader, path)
+
+            ds.records[3]["Kind"] = "y"
+            ds.add_record({ "Name": "new", "Kind": "x" })
+            result = writer.update_table(ds, "Name", lambda status: None, mirror=mirror)
+            self.assertEqual((result.op_returns["created"], result.op_returns["patched"], result.op_returns["skipped"]), (1, 1, 19))
+            self.assertEqual(len(mirror.records.records), 20) # pulled before the update
+            self.assertTrue(reader.read_all_records_sync(100).equivalent_to(ds, "Name"))
+            session.close()
+
+    def test_fake_api_failures(self):
+        api = FakeNotionApi(throttle_rate=0.3, error_rate=0.1, retry_after=0, seed=1)
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "Name") ], [ { "Name": f"name{i}" } for i in range(40) ])
+        with FakeNotionServer(api) as server:
+            session = server.session(retry=RetryPolicy(base_delay=0, max_retries=10))
+            writer = NotionWriter(session=session)
+            api.throttle_rate, api.error_rate = 0, 0
+            writer.set_table(writer.create_table(ds, TableSpec(DATA_SOURCE.NOTION, { "parent_id": None }, "fake")))
+            api.throttle_rate, api.error_rate = 0.3, 0.1
+            handle = writer.write_records_sync(ds)
+            self.assertGreater(session.metrics.throttled_responses, 0)
+            self.assertGreater(len(handle.params["errors"]), 0) # creates aren't retried after a 500, as they might have gone through
+            reader = NotionReader(session=session)
+            reader.set_table(writer.table)
+            self.assertEqual(len(reader.read_all_records_sync(10).records), 40 - len(handle.params["errors"])) # queries are retried
+            session.close()
+
+    def test_default_session(self):
+        reader = NotionReader("secret_a")
+        self.assertIs(reader.session, reader.session)
+        self.assertEqual(reader.session.api_key, "secret_a")
+        closed = []
+        first = reader.session
+        first.close = lambda: closed.append(first)
+        reader.api_key = "secret_b"
+        self.assertEqual(reader.session.api_key, "secret_b")
+        self.assertEqual(closed, [first]) # the replaced session is closed
+        self.assertIs(reader._session_for("secret_c"), reader._session_for("secret_c")) # one session per key
+        self.assertIs(reader._session_for("secret_b"), reader.session)
+
+        with NotionWriter("secret_a") as writer:
+            owned = writer.session
+            owned.close = lambda: closed.append(owned)
+        self.assertEqual(closed, [first, owned]) # closed on leaving the with block
+        self.assertIsNot(writer.session, owned)
+
+        with FakeNotionServer(FakeNotionApi()) as server:
+            session = server.session()
+            with NotionReader(session=session) as reader:
+                self.assertIs(reader.session, session)
+            self.assertIs(reader.session, session) # a session passed in isn't the client's to close
+            session.close()
+
 class TestTsvSync(unittest.TestCase):
     # def test_basic_read(self):
     #     reader = JsonReader({"file_path": "./test_input/json_basic_test.json"})
@@ -374,6 +900,45 @@ class TestTsvSync(unittest.TestCase):
         writer = TsvWriter(TableSpec(DATA_SOURCE.TSV, {"file_path": "./test_output/tsv_it_read_10_test.tsv"}, "tsv_big_read_test"))
         asyncio.run( writer.create_table(ds) )  
 
+    def test_it_read_pages(self):
+        map_cols = {
+            "date": DataColumn(COLUMN_TYPE.DATE, "date"),
+            "id": DataColumn(COLUMN_TYPE.TEXT, "key"),
+            "select": DataColumn(COLUMN_TYPE.SELECT, "select")
+        }
+        dm = DataMap(map_cols, DataSetFormat())
+        reader = TsvReader(TableSpec(DATA_SOURCE.TSV, {"file_path": "./test_input/tsv_basic_test.tsv"}, "read_test"))
+        full = reader.read_records_sync(mapping=dm).records
+
+        # columns are matched by header name, so the mapping needn't follow the file's column order
+        self.assertEqual(full.column_names, ["key", "date", "select"])
+        self.assertEqual(full.column_to_list("date")[0], datetime(1994, 3, 23, 12, 1))
+
+        with reader.read_records_sync(3, mapping=dm) as handle:
+            ds = handle.records
+            while not handle.done:
+                handle = reader.read_records_sync(3, next_iterator=handle) # plan is carried by the handle
+                ds.add_records(handle.records.records)
+        self.assertTrue(ds.equivalent_to(full))
+        self.assertRaises(SyncError, reader.read_records_sync, 3, handle)
+
+    def test_read_conversion_errors(self):
+        reader = TsvReader(TableSpec(DATA_SOURCE.TSV, {"file_path": "./test_input/tsv_basic_test.tsv"}, "read_test"))
+        dm = DataMap({ "bad_data": DataColumn(COLUMN_TYPE.DATE, "bad_data") }, DataSetFormat())
+        handle = reader.read_records_sync(1, mapping=dm)
+        self.assertEqual(handle.conversion_errors, 1) # "xyz"
+        handle = reader.read_records_sync(10, next_iterator=handle)
+        self.assertEqual(handle.conversion_errors, 4) # counted over every page read
+        self.assertEqual(handle.records.column_to_list("bad_data"), [None, None, None])
+
+        # two source columns mapped onto one name fails on the first page, which mustn't leave the file open
+        dm = DataMap({ "id": DataColumn(COLUMN_TYPE.TEXT, "key"), "select": DataColumn(COLUMN_TYPE.TEXT, "key") }, DataSetFormat())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always", ResourceWarning)
+            self.assertRaises(DataError, reader.read_records_sync, 1, None, dm)
+            gc.collect()
+        self.assertEqual([ w for w in caught if issubclass(w.category, ResourceWarning) ], [])
+
     def test_it_read_chunks(self):
 
         if disable_expensive_tests:
@@ -430,6 +995,50 @@ class TestJsonSync(unittest.TestCase):
         ds.change_column_type("date_added", COLUMN_TYPE.TEXT)
         # write_out(ds.records,"./test_output/json_read_test.json")
 
+    def test_paged_read(self):
+        reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": "./test_input/chinese_sample.json"}, "test"))
+        with open("./test_input/chinese_sample.json", "r", encoding="utf-8") as f:
+            raw_json = json.load(f)
+
+        chunk_size = JsonRecordStream.chunk_size
+        JsonRecordStream.chunk_size = 7 # force records and strings to straddle chunk boundaries
+        try:
+            with reader.read_records_sync(50) as handle:
+                ds = handle.records
+                self.assertEqual(len(ds.records), 50)
+                while not handle.done:
+                    handle = reader.read_records_sync(50, handle)
+                    ds.add_records(handle.records.records)
+        finally:
+            JsonRecordStream.chunk_size = chunk_size
+
+        self.assertEqual(len(ds.records), len(raw_json["records"]))
+        self.assertTrue(ds.equivalent_to(reader.read_all_records_sync(-1)))
+        self.assertEqual(ds.get_column("Timestamp").type, COLUMN_TYPE.DATE)
+        self.assertRaises(SyncError, reader.read_records_sync, 50, handle)
+
+        # records before the header still read correctly
+        reordered = { "records": raw_json["records"], "header": raw_json["header"] }
+        with open("./test_output/json_reordered.json", "w", encoding="utf-8") as f:
+            json.dump(reordered, f)
+        reordered_reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": "./test_output/json_reordered.json"}, "test"))
+        self.assertTrue(ds.equivalent_to(reordered_reader.read_all_records_sync(100)))
+
+    def test_paged_date_format(self):
+        # the first page is only day-first; the second is ambiguous and must be read the same way
+        header = { "columns": { "id": 0, "date": 3 }, "format": { "multiselect_delimiter": ",", "time_formats": ["%m/%d/%Y", "%d/%m/%Y"] } }
+        records = [ { "id": str(i), "date": "13/02/2020" if i < 2 else "05/06/2020" } for i in range(4) ]
+        with open("./test_output/json_paged_dates.json", "w", encoding="utf-8") as f:
+            json.dump({ "header": header, "records": records }, f)
+        reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": "./test_output/json_paged_dates.json"}, "test"))
+        self.assertEqual(reader.read_all_records_sync(2).column_to_list("date")[2:], [ datetime(2020, 6, 5) ] * 2)
+        self.assertEqual(reader.read_all_records_sync(-1).column_to_list("date")[2:], [ datetime(2020, 6, 5) ] * 2)
+
+        with open("./test_output/ndjson_paged_dates.ndjson", "w", encoding="utf-8") as f:
+            f.write("\n".join(json.dumps(line) for line in [ header ] + records) + "\n")
+        ndjson_reader = NdjsonReader(TableSpec(DATA_SOURCE.NDJSON, {"file_path": "./test_output/ndjson_paged_dates.ndjson"}, "test"))
+        self.assertEqual(ndjson_reader.read_all_records_sync(2).column_to_list("date")[2:], [ datetime(2020, 6, 5) ] * 2)
+
     def test_basic_write(self):
 
         cols = [
@@ -505,6 +1114,120 @@ class TestJsonSync(unittest.TestCase):
         asyncio.run( writer.create_table(ds) )
 
 
+class TestNdjsonSync(unittest.TestCase):
+
+    def test_write_and_read(self):
+        json_reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": "./test_input/chinese_sample.json"}, "test"))
+        source = json_reader.read_all_records_sync(-1)
+
+        writer = NdjsonWriter(TableSpec(DATA_SOURCE.NDJSON, {"file_path": "./test_output/ndjson_write.ndjson"}, "test"))
+        writer.create_table_sync(source)
+        reader = NdjsonReader(TableSpec(DATA_SOURCE.NDJSON, {"file_path": "./test_output/ndjson_write.ndjson"}, "test"))
+        self.assertEqual([ (c.name, c.type) for c in reader.get_columns() ], [ (c.name, c.type) for c in source.columns ])
+
+        with reader.read_records_sync(50) as handle:
+            ds = handle.records
+            self.assertEqual(len(ds.records), 50)
+            while not handle.done:
+                handle = reader.read_records_sync(50, handle)
+                ds.add_records(handle.records.records)
+        self.assertTrue(ds.equivalent_to(source))
+        self.assertEqual(ds.get_column("Timestamp").type, COLUMN_TYPE.DATE)
+        self.assertRaises(SyncError, reader.read_records_sync, 50, handle)
+
+        self.assertTrue(reader.read_all_records_parallel(workers=2, chunk_count=5).equivalent_to(source))
+
+    def test_append_and_resume(self):
+        json_reader = JsonReader(TableSpec(DATA_SOURCE.JSON, {"file_path": "./test_input/chinese_sample.json"}, "test"))
+        source = json_reader.read_all_records_sync(-1)
+        first = DataSet(source.columns, source.records[:100], format=source.format)
+        second = DataSet(source.columns, source.records[100:], format=source.format)
+
+        if exists("./test_output/ndjson_append.ndjson"):
+            unlink("./test_output/ndjson_append.ndjson")
+        writer = NdjsonWriter(TableSpec(DATA_SOURCE.NDJSON, {"file_path": "./test_output/ndjson_append.ndjson"}, "test"))
+        writer.append_records_sync(source.records[:100], source)
+        reader = NdjsonReader(TableSpec(DATA_SOURCE.NDJSON, {"file_path": "./test_output/ndjson_append.ndjson"}, "test"))
+        handle = reader.read_records_sync(-1)
+        self.assertTrue(handle.done)
+        self.assertTrue(handle.records.equivalent_to(first))
+
+        # a saved offset picks up only the records appended since
+        writer.append_records_sync(second.records, second)
+        resumed = reader.read_records_sync(-1, offset=handle.offset)
+        self.assertTrue(resumed.records.equivalent_to(second))
+        self.assertTrue(reader.read_all_records_sync(30).equivalent_to(source))
+
+        mismatched = DataSet([DataColumn(COLUMN_TYPE.TEXT, "other")], [{"other": "x"}])
+        self.assertRaises(SyncError, writer.append_records_sync, mismatched.records, mismatched)
+        other_format = DataSet(source.columns, source.records[:1], format=DataSetFormat(multiselect_delimiter=";", time_formats=source.format.time_formats))
+        self.assertRaises(SyncError, writer.append_records_sync, other_format.records, other_format)
+        other_times = DataSet(source.columns, source.records[:1], format=DataSetFormat(time_formats=["%d/%m/%Y"]))
+        self.assertRaises(SyncError, writer.append_records_sync, other_times.records, other_times)
+        self.assertEqual(len(reader.read_all_records_sync(-1).records), len(source.records))
+
+class TestSnapshotSync(unittest.TestCase):
+
+    def test_write_and_read(self):
+        cols = [
+            DataColumn(COLUMN_TYPE.TEXT, "id"),
+            DataColumn(COLUMN_TYPE.DATE, "date"),
+            DataColumn(COLUMN_TYPE.DATE, "date_tz"),
+            DataColumn(COLUMN_TYPE.MULTI_SELECT, "multiselect"),
+            DataColumn(COLUMN_TYPE.SELECT, "select"),
+            DataColumn(COLUMN_TYPE.TEXT, "mixed")
+        ]
+        ds = DataSet(cols, format=DataSetFormat(multiselect_delimiter=";", time_formats=["%Y-%m-%d"]))
+        for i in range(25):
+            ds.add_record({
+                "id": "汉字" + str(i) if i % 2 else str(i),
+                "date": None if i == 3 else datetime(1994, 3, 23, 12, 1) + timedelta(days=i, microseconds=i),
+                "date_tz": datetime(2021, 1, 1, tzinfo=timezone(timedelta(hours=i % 5))) if i % 4 else datetime(2021, 1, 1),
+                "multiselect": None if i == 7 else [ str(x) for x in range(i % 4) ],
+                "select": None if i == 5 else "abc"[i % 3],
+                "mixed": i if i % 3 else ("" if i % 2 else None)
+            })
+
+        writer = SnapshotWriter(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": "./test_output/snapshot.snap"}, "test"))
+        writer.create_table_sync(ds)
+        reader = SnapshotReader(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": "./test_output/snapshot.snap"}, "test"))
+        self.assertEqual([ (c.name, c.type) for c in reader.get_columns() ], [ (c.name, c.type) for c in cols ])
+
+        read = reader.read_all_records_sync(-1)
+        self.assertTrue(read.equivalent_to(ds))
+        self.assertEqual(read.format.multiselect_delimiter, ";")
+        self.assertEqual(read.format.time_formats, ["%Y-%m-%d"])
+        self.assertEqual(read.records[3]["date_tz"].utcoffset(), timedelta(hours=3))
+        self.assertEqual(read.records[4]["date_tz"].utcoffset(), None)
+
+        with reader.read_records_sync(10) as handle:
+            paged = handle.records
+            self.assertEqual(len(paged.records), 10)
+            while not handle.done:
+                handle = reader.read_records_sync(10, handle)
+                paged.add_records(handle.records.records)
+        self.assertTrue(paged.equivalent_to(ds))
+        self.assertRaises(SyncError, reader.read_records_sync, 10, handle)
+
+        empty = DataSet(cols)
+        writer.create_table_sync(empty)
+        self.assertEqual(len(reader.read_all_records_sync(-1).records), 0)
+
+        days = DataSet([ DataColumn(COLUMN_TYPE.DATE, "day") ], [ { "day": None if i == 2 else date(1969, 12, 25) + timedelta(days=i) } for i in range(10) ])
+        writer.create_table_sync(days)
+        read = reader.read_all_records_sync(-1)
+        self.assertEqual(read.column_to_list("day"), days.column_to_list("day")) # read back as dates, not strings
+        self.assertIs(type(read.records[0]["day"]), date)
+
+        mixed = DataSet([ DataColumn(COLUMN_TYPE.DATE, "day") ], [ { "day": date(2020, 1, 1) }, { "day": datetime(2020, 1, 1, 12) } ])
+        self.assertRaises(DataError, writer.create_table_sync, mixed)
+        self.assertEqual(reader.read_all_records_sync(-1).column_to_list("day"), days.column_to_list("day")) # the old snapshot is kept
+
+        with open("./test_output/not_a_snapshot.snap", "wb") as f:
+            f.write(b"{}")
+        not_snapshot = SnapshotReader(TableSpec(DATA_SOURCE.SNAPSHOT, {"file_path": "./test_output/not_a_snapshot.snap"}, "test"))
+        self.assertRaises(SyncError, not_snapshot.read_all_records_sync, -1)
+
 class TestRemap(unittest.TestCase):
     def setUp(self) -> None:
         self.cols = [
@@ -652,6 +1375,23 @@ class TestRemap(unittest.TestCase):
 
         self.assertTrue( ds_remap_1.equivalent_to(result_1) )
 
+    def test_remap_copy_on_write(self):
+        mapping = DataMap({ "id": DataColumn(COLUMN_TYPE.TEXT, "new_id"), "select": DataColumn(COLUMN_TYPE.SELECT, "select") }, DataSetFormat())
+        ds = DataSet(self.cols, self.records)
+        remapped = ds.remap(mapping).op_returns["remapped_data"]
+        self.assertEqual(remapped.column_to_list("new_id"), ["0", "1", "2", "3"])
+
+        # writes to either side must not leak into the other
+        ds.records[0]["id"] = "changed"
+        ds.add_record(self.records[0])
+        remapped.records[1]["select"] = "changed"
+        self.assertEqual(remapped.column_to_list("new_id"), ["0", "1", "2", "3"])
+        self.assertEqual(ds.column_to_list("select"), ["0", "1", "2", "3", "0"])
+        self.assertEqual(len(remapped.records), 4)
+
+        remapped.add_record({"new_id": "4", "select": "4"})
+        self.assertEqual(ds.column_to_list("id"), ["changed", "1", "2", "3", "0"])
+
 class TestComplexTransforms(unittest.TestCase):
     def setUp(self) -> None:
         self.source_cols = [
@@ -1155,8 +1895,12 @@ class TestDataSet(unittest.TestCase):
         ds = DataSet(self.cols)
         ds.add_records(self.records)
         self.assertEqual(ds._columns[0],DataColumn(COLUMN_TYPE.TEXT,"title"))
+        held = ds.records[0]
         ds.rename_column("title","name")
         self.assertEqual(ds._columns[0],DataColumn(COLUMN_TYPE.TEXT,"name"))
+        self.assertEqual(held["name"], "record_1") # records share the dataset's column names
+        self.assertEqual(held["title"], None)
+        self.assertFalse(hasattr(held, "__dict__"))
         cols2 = [
             DataColumn(COLUMN_TYPE.TEXT, "name"),
             DataColumn(COLUMN_TYPE.TEXT, "description"),
@@ -1175,6 +1919,18 @@ class TestDataSet(unittest.TestCase):
         ds = DataSet(self.cols)
         ds.add_record(self.records[0])
 
+    def test_record_views(self):
+        ds = DataSet(self.cols)
+        ds.add_records(self.records[0:3])
+        self.assertEqual(len(ds.records), 3)
+        self.assertEqual(ds.records[-1]["title"], "too many fields")
+        self.assertEqual(ds.records[1:], [ds.records[1], ds.records[2]])
+
+        # records are views onto the column storage, so writes are visible everywhere
+        ds.records[0]["title"] = "renamed"
+        self.assertEqual(ds.column_to_list("title"), ["renamed", "record_2", "too many fields"])
+        self.assertRaises(IndexError, ds.records.__getitem__, 3)
+
     def test_append_records(self):
         ds = DataSet(self.cols)
         ds2 = DataSet(self.cols)
@@ -1308,6 +2064,9 @@ class TestDataSet(unittest.TestCase):
         self.assertEqual(ds.records[0], ds2.records[0])
         self.assertEqual(ds.records[1], ds2.records[1])
 
+        ds.records[0]["test_column"] = [4] # rows don't share the default
+        self.assertEqual(ds.records[1]["test_column"], [0,1,2,3])
+
     def test_column_to_list(self):
         title_list = [ record["title"] for record in self.records ]
         ds = DataSet(self.cols)
@@ -1412,6 +2171,202 @@ class TestDataSet(unittest.TestCase):
         self.assertEqual(report.non_critical_errors,1)
         self.assertEqual(ds_internal_2.column_to_list("date"),ds_text_3.column_to_list("date_modified"))
 
+    def test_conversion_plan(self):
+        ds = DataSet([], format=DataSetFormat(multiselect_delimiter=";"))
+        plan = ds.conversion_plan(COLUMN_TYPE.TEXT, COLUMN_TYPE.MULTI_SELECT)
+        self.assertEqual(plan.convert(["a;b", "c"]), ([["a", "b"], ["c"]], 0))
+        self.assertEqual(plan.convert(["a;b", None, "c"]), ([["a", "b"], None, ["c"]], 1))
+        with self.assertRaises(DataError):
+            plan.convert_value(None)
+        self.assertEqual(ds.conversion_plan(COLUMN_TYPE.MULTI_SELECT, COLUMN_TYPE.TEXT).convert([["a", "b"]]), (["a;b"], 0))
+        with self.assertRaises(ColumnError):
+            ds.conversion_plan(COLUMN_TYPE.DATE, COLUMN_TYPE.SELECT)
+
+        dates = [ (datetime(2000, 1, 1) + timedelta(hours=i)).isoformat() for i in range(500) ] + [ "not a date" ]
+        plan = ds.conversion_plan(COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE)
+        plan.parallel_threshold = 100
+        serial = plan.convert(dates)
+        self.assertEqual(plan.convert(dates, workers=3), serial)
+        self.assertEqual(serial[1], 1)
+
+        column = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "date") ], [ { "date": d } for d in dates ])
+        report = column.change_column_type("date", COLUMN_TYPE.DATE, workers=2)
+        self.assertEqual(report.non_critical_errors, 1)
+        self.assertEqual(column.column_to_list("date"), serial[0])
+
+        # the format is inferred once for the column, not per chunk
+        ambiguous = [ "13/02/2020" ] * 150 + [ "05/06/2020" ] * 150
+        plan = DataSet([], format=DataSetFormat(time_formats=["%m/%d/%Y", "%d/%m/%Y"])).conversion_plan(COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE)
+        plan.parallel_threshold = 100
+        parallel, errors = plan.convert(ambiguous, workers=2)
+        self.assertEqual(errors, 0)
+        self.assertEqual(parallel[-1], datetime(2020, 6, 5))
+        self.assertEqual(parallel, plan.convert(ambiguous)[0])
+
+    def test_date_parser(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "date") ], [ { "date": "Mar 23, 1994 12:01 PM" }, { "date": "Mar 23, 1994 12:01 PM" },
+            { "date": "1994-03-24T08:00:00" }, { "date": "Apr 1, 1994 9:30 AM" } ], format=DataSetFormat(time_formats=["%d/%m/%Y", "%b %d, %Y %I:%M %p"]))
+        parser = ds.date_parser()
+        self.assertEqual(parser.infer(ds.column_to_list("date")), "%b %d, %Y %I:%M %p")
+        report = ds.change_column_type("date", COLUMN_TYPE.DATE)
+        self.assertEqual(report.non_critical_errors, 0)
+        dates = ds.column_to_list("date")
+        self.assertEqual(dates, [ datetime(1994, 3, 23, 12, 1), datetime(1994, 3, 23, 12, 1), datetime(1994, 3, 24, 8), datetime(1994, 4, 1, 9, 30) ])
+        self.assertIs(dates[0], dates[1]) # memoised
+        self.assertEqual(parser.failed_attempts, 2) # only the ISO date was tried against both formats
+        self.assertEqual(parser.iso_parses, 1)
+        self.assertIs(ds.date_parser(), parser)
+        ds.format = DataSetFormat(time_formats=["%Y"])
+        self.assertIsNot(ds.date_parser(), parser)
+
+        formatter = DataSet([], format=DataSetFormat(time_formats=["%H:%M"])).date_formatter()
+        utc = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)
+        self.assertEqual(formatter.format(utc), "12:00")
+        self.assertEqual(formatter.format(utc.astimezone(timezone(timedelta(hours=1)))), "13:00") # equal times, different zones
+
+    def test_date_parser_ambiguous(self):
+        us_first = DataSetFormat(time_formats=["%m/%d/%Y", "%d/%m/%Y"])
+        parser = DataSet([], format=us_first).date_parser()
+        self.assertEqual(parser.parse("13/02/2020"), datetime(2020, 2, 13))
+        self.assertEqual(parser.parse("05/06/2020"), datetime(2020, 5, 6)) # earlier values don't change the format order
+        self.assertEqual(parser.parse("05/06/2020", "%d/%m/%Y"), datetime(2020, 6, 5))
+
+        # each column gets its own inferred format, whatever other columns looked like
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "uk"), DataColumn(COLUMN_TYPE.TEXT, "us") ],
+            [ { "uk": "13/02/2020", "us": "05/06/2020" }, { "uk": "05/06/2020", "us": "02/13/2020" } ], format=us_first)
+        ds.change_column_type("uk", COLUMN_TYPE.DATE)
+        ds.change_column_type("us", COLUMN_TYPE.DATE)
+        self.assertEqual(ds.column_to_list("uk"), [ datetime(2020, 2, 13), datetime(2020, 6, 5) ])
+        self.assertEqual(ds.column_to_list("us"), [ datetime(2020, 5, 6), datetime(2020, 2, 13) ])
+
+    def test_text_to_date_uses_inferred_format(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.TEXT, "a"), DataColumn(COLUMN_TYPE.TEXT, "b") ], [ { "a": "13/02/2020", "b": "14/02/2020" } ],
+            format=DataSetFormat(time_formats=["%m/%d/%Y", "%d/%m/%Y"]))
+        self.assertEqual(ds.change_data_type("05/06/2020", COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE), datetime(2020, 5, 6)) # nothing inferred yet
+        self.assertEqual(ds.change_column_type("a", COLUMN_TYPE.DATE).op_returns["first_format"], "%d/%m/%Y")
+        self.assertEqual(ds.change_data_type("05/06/2020", COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE), datetime(2020, 6, 5))
+        ds.add_column(DataColumn(COLUMN_TYPE.TEXT, "c"), "02/13/2020")
+        ds.change_column_type("c", COLUMN_TYPE.DATE)
+        self.assertEqual(ds.change_data_type("05/06/2020", COLUMN_TYPE.TEXT, COLUMN_TYPE.DATE), datetime(2020, 5, 6)) # columns disagree
+
+    def test_date_formatter_plain_dates(self):
+        ds = DataSet([ DataColumn(COLUMN_TYPE.DATE, "date") ], [ { "date": date(2020, 1, 2) }, { "date": datetime(2020, 1, 2, 3) } ])
+        report = ds.change_column_type("date", COLUMN_TYPE.TEXT)
+        self.assertEqual(report.non_critical_errors, 0)
+        self.assertEqual(ds.column_to_list("date"), [ "2020-01-02", "2020-01-02T03:00:00" ])
+        formatter = DataSet([], format=DataSetFormat(time_formats=["%d.%m.%Y"])).date_formatter()
+        self.assertEqual(formatter.format(date(2020, 1, 2)), "02.01.2020")
+
+    def test_encoded_columns(self):
+        cols = [ DataColumn(COLUMN_TYPE.TEXT, "id"), DataColumn(COLUMN_TYPE.SELECT, "select"), DataColumn(COLUMN_TYPE.MULTI_SELECT, "tags") ]
+        records = [ { "id": str(i), "select": ["a", "b", None][i % 3], "tags": [["x", "y"], [], None, ["y", "x"]][i % 4] } for i in range(12) ]
+        ds = DataSet(cols, records)
+        tags = ds._data[ds.get_column_index("tags")]
+        self.assertIsInstance(tags, EncodedColumn)
+        self.assertEqual(len(tags.values), 4) # each distinct combination stored once
+        self.assertEqual(ds.column_to_list("tags"), [ r["tags"] for r in records ])
+        self.assertEqual(ds.get_value_counts("tags"), { "x": 6, "y": 6, None: 3 })
+        self.assertEqual(ds.get_uniques()["select"], { "a", "b", None })
+
+        # values read from a record are copies, but changing one in place writes it back to the row
+        record = ds.records[0]
+        record["tags"].append("z")
+        self.assertEqual(record["tags"], ["x", "y", "z"])
+        self.assertEqual(ds.records[4]["tags"], ["x", "y"]) # rows sharing the stored value are left alone
+        self.assertEqual(ds.get_value_counts("tags")["z"], 1)
+        tags = record["tags"]
+        tags += ["w"]
+        del tags[-1]
+        self.assertEqual(record["tags"], ["x", "y", "z"])
+        self.assertIs(type(copy.deepcopy(record["tags"])), list)
+        ds.column_to_list("tags")[0].append("v") # whole columns are plain copies
+        self.assertEqual(record["tags"], ["x", "y", "z"])
+
+        shuffled = DataSet(cols, list(reversed(ds.records)))
+        self.assertTrue(ds.equivalent_to(shuffled))
+        shuffled.records[0]["select"] = "c"
+        self.assertFalse(ds.equivalent_to(shuffled))
+
+        clone = ds.remap(DataMap({ "tags": DataColumn(COLUMN_TYPE.TEXT, "tags") }, ds.format)).op_returns["remapped_data"]
+        self.assertEqual(clone.column_to_list("tags")[:4], ["x,y,z", "", None, "y,x"])
+        ds.records[1]["tags"] = ["w"] # copy-on-write leaves the clone alone
+        self.assertEqual(clone.records[1]["tags"], "")
+
+    def test_write_safe_view(self):
+        ds = DataSet(self.type_change_records_internal_cols)
+        ds.add_records(self.type_change_records_internal)
+        ds.add_record({"id": "4", "date": None, "multiselect": None, "select": None})
+        text = DataSet(self.type_change_records_text_cols)
+        text.add_records(self.type_change_records_text)
+
+        view = ds.write_safe_view({ COLUMN_TYPE.DATE: COLUMN_TYPE.TEXT, COLUMN_TYPE.MULTI_SELECT: COLUMN_TYPE.TEXT })
+        rows = list(view)
+
+        self.assertEqual(view.converted_columns, ["date", "multiselect"])
+        self.assertEqual([r["date"] for r in rows[:-1]], text.column_to_list("date"))
+        self.assertEqual([r["multiselect"] for r in rows[:-1]], text.column_to_list("multiselect"))
+        self.assertIsNone(rows[-1]["date"])
+        self.assertEqual(view.non_critical_errors, 2)
+        # the source dataset is left untouched
+        self.assertEqual(ds.get_column("date").type, COLUMN_TYPE.DATE)
+        self.assertEqual(ds.column_to_list("multiselect")[:-1], [r["multiselect"] for r in self.type_change_records_internal])
+
+    def test_get_uniques(self):
+        ds = DataSet(self.cols)
+        ds.add_records(self.records[0:4])
+        self.assertEqual(ds.get_uniques(), ds.calculate_uniques())
+        self.assertEqual(ds.get_value_counts("tags"), {"0": 1, "1": 1, "2": 1, "3": 2, "5": 3, "6": 2, "7": 2})
+
+        # cache is maintained incrementally
+        ds.add_record(self.records[7])
+        ds.records[0]["tags"] = ["8"]
+        ds.records[1]["title"] = "record_1"
+        self.assertEqual(ds.get_uniques(), ds.calculate_uniques())
+        self.assertEqual(ds.get_value_counts("title"), {"record_1": 2, "too many fields": 2, "merge_2": 1})
+        self.assertNotIn("0", ds.get_value_counts("tags"))
+
+        ds.rename_column("tags", "labels")
+        ds.change_column_type("labels", COLUMN_TYPE.TEXT)
+        self.assertEqual(ds.get_uniques(), ds.calculate_uniques())
+        ds.drop_column("labels")
+        self.assertNotIn("labels", ds.get_uniques())
+
+    def test_create_index(self):
+        ds = DataSet(self.cols)
+        ds.add_records(self.records[0:4])
+        index = ds.create_index("title")
+        self.assertEqual(index.records("too many fields"), [ds.records[2], ds.records[3]])
+
+        # maintained as records change
+        ds.add_record(self.records[6])
+        ds.records[0]["title"] = "merge_1"
+        self.assertNotIn("record_1", index)
+        self.assertEqual(index.rows["merge_1"], [0, 4])
+        ds.rename_column("title", "name")
+        self.assertIs(ds.get_index("name"), index)
+        ds.change_column_type("name", COLUMN_TYPE.SELECT)
+        self.assertEqual(ds.get_index("name").rows["merge_1"], [0, 4])
+        ds.drop_column("name")
+        ds.add_column(DataColumn(COLUMN_TYPE.TEXT, "name"))
+        self.assertIsNone(ds.get_index("name"))
+        self.assertRaises(ColumnError, ds.create_index, "tags")
+
+        # unique indexes reject duplicate keys and leave the dataset unchanged
+        unique = DataSet(self.cols, self.records[0:2])
+        unique.create_index("title", unique=True)
+        self.assertRaises(DataError, unique.add_record, self.records[0])
+        self.assertRaises(DataError, unique.records[1].__setitem__, "title", "record_1")
+        self.assertEqual(unique.column_to_list("title"), ["record_1", "record_2"])
+        self.assertEqual(len(unique.records), 2)
+
+        # merges give the same result with or without an index
+        left = DataSet(self.cols, self.merge_left_records)
+        right = DataSet(self.cols, self.records[6:9])
+        unindexed = merge(left, right, "title", "title")
+        left.create_index("title")
+        right.create_index("title")
+        self.assertTrue(merge(left, right, "title", "title").equivalent_to(unindexed))
+
     def test_drop_column(self):
 
         cols = [
@@ -1461,6 +2416,22 @@ class TestDataSet(unittest.TestCase):
         for i in range(len(ds.records)):
             self.assertEqual(ds.records[i],dropped_set.records[i])
 
+        ds.create_index("id")
+        status = ds.compact()
+        self.assertEqual(status.op_returns["columns_removed"], 1)
+        self.assertGreater(status.op_returns["bytes_reclaimed"], 0)
+        self.assertEqual(len(ds._data), 3)
+        self.assertEqual(ds.records[1], dropped_set.records[1])
+        self.assertEqual(len(ds.get_index("id").records("0")), 2)
+        self.assertEqual(ds.compact().op_returns, { "columns_removed": 0, "bytes_reclaimed": 0 })
+
+        # dropping most of the columns compacts automatically
+        ds.drop_column("date")
+        ds.drop_column("multiselect")
+        self.assertEqual(ds._columns, [ DataColumn(COLUMN_TYPE.TEXT, "id") ])
+        self.assertEqual(ds._deleted_column_ids, [])
+        self.assertEqual(ds.records[0].asdict(), { "id": "0" })
+
     def test_equivalent_to_correct(self):
         ''' Check that equivalent_to function works when it should work. '''
         cols = [
@@ -1644,6 +2615,32 @@ class TestDataSet(unittest.TestCase):
         self.assertFalse(ds.equivalent_to(ds_disordered, "select") ) # with a different designated key
         self.assertFalse(ds.equivalent_to(ds_disordered)) # without designated key
 
+    def test_compare_to(self):
+        cols = [
+            DataColumn(COLUMN_TYPE.TEXT, "id"),
+            DataColumn(COLUMN_TYPE.MULTI_SELECT, "multiselect"),
+            DataColumn(COLUMN_TYPE.SELECT, "select") 
+        ]
+        records = [
+            { "id": "0", "multiselect": ['0','1'], "select": "a" },
+            { "id": "1", "multiselect": ['1','2'], "select": "a" },
+            { "id": "1", "multiselect": ['1','2'], "select": "a" }
+        ]
+        ds = DataSet(cols, records)
+        same = DataSet(cols, [records[2], records[0], records[1]])
+        extra = DataSet(cols, records + [{ "id": "2", "multiselect": [], "select": "b" }])
+        fewer_duplicates = DataSet(cols, [records[0], records[1], { "id": "2", "multiselect": ['1','2'], "select": "a" }])
+
+        self.assertTrue(ds.compare_to(same).op_returns["equivalent"])
+        self.assertFalse(ds.equivalent_to(extra, "id"))
+        self.assertFalse(extra.equivalent_to(ds, "id"))
+
+        report = ds.compare_to(fewer_duplicates).op_returns
+        self.assertFalse(report["equivalent"])
+        self.assertEqual(report["only_in_self"], [records[2]])
+        self.assertEqual(report["only_in_other"], [{ "id": "2", "multiselect": ['1','2'], "select": "a" }])
+        self.assertEqual(len(ds.compare_to(fewer_duplicates, max_differences=0).op_returns["only_in_self"]), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file